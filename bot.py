@@ -3,30 +3,46 @@ import re
 import uuid
 import json
 import asyncio
-import hashlib
-import hmac
+import signal
+import time
+import functools
+import html
+from contextvars import ContextVar
 from datetime import datetime
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.request import BaseRequest, HTTPXRequest
 import gspread
 from google.oauth2.service_account import Credentials
-import yookassa
-from yookassa import Payment
 from config import *
-
-# Безопасная инициализация ЮKassa
-yookassa.Configuration.account_id = YOOKASSA_SHOP_ID
-yookassa.Configuration.secret_key = YOOKASSA_SECRET_KEY
+from logging_setup import setup_logging, mask_phone, SAMPLED
+from sheets_gateway import SheetsGateway
+from storage import SQLiteStorage, SheetsStorage
+from sheets_exporter import SheetsExporter
+from sheet_sync import SheetSync
+from web_server import start_web_server
+from payment_reconciler import PaymentReconciler
+from broadcast import BroadcastManager
+from inventory import TicketInventory, HoldReaper
+from reports import SalesStats, FUNNEL_STEPS, format_stats, export_csv, amount_value
+from tickets import (
+    TicketIndex, TicketRenderer, ticket_code, CHECKIN_PREFIX, CHECKIN_OK, CHECKIN_UNPAID,
+)
+from event_catalog import EventCatalog, REGISTER_PREFIX
+from yookassa_client import YooKassaClient, YooKassaError, YooKassaUnavailable, idempotence_key
+from circuit_breaker import CircuitBreaker, STATE_CLOSED
+from sqlite_persistence import SQLitePersistence
+from session import RegistrationSession, SessionReaper
+from shared_state import SharedPersistence, LeaderElection, open_shared_store
+from update_processor import PerUserUpdateProcessor
+from update_timing import UpdateProfiler, stage, staged, timed_update
+from metrics import (
+    UPDATES_TOTAL, UPDATES_IN_FLIGHT, HANDLER_LATENCY, HANDLER_ERRORS, FUNNEL, callback_type,
+)
 
 # Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO, # Установите на DEBUG для более подробного лога
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log')
-    ]
-)
+# (очередь + фоновый поток записи, JSON-файл с ротацией; уровень - LOG_LEVEL)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Определение констант состояний
@@ -35,53 +51,259 @@ USER_STATE_WAITING_FOR_NAME = 'waiting_for_name'
 USER_STATE_WAITING_FOR_PHONE = 'waiting_for_phone'
 USER_STATE_WAITING_FOR_PAYMENT_CONFIRMATION = 'waiting_for_payment_confirmation'
 
-GS_HEADERS = [
-    'User ID', 'Username', 'Имя', 'Номер телефона', # Изменил
-    'Количество билетов', 'Сумма', 'Когда куплено', 'Статус', 'Payment ID' # Добавил Payment ID
-]
-# И соответственно обновите индексы столбцов:
-GS_COL_NAME = 3
-GS_COL_PHONE = 4
-GS_COL_DATE = 7
-GS_COL_STATUS = 8
-GS_COL_PAYMENT_ID = 9 # Новый столбец
+SOLD_OUT_TEXT = "😔 К сожалению, все билеты уже проданы."
+PAYMENTS_UNAVAILABLE_TEXT = "⏳ Оплата временно недоступна. Попробуйте нажать кнопку через пару минут."
+PAYMENT_CHECK_UNAVAILABLE_TEXT = (
+    "⏳ Сейчас не удается проверить оплату. Если вы уже оплатили, бот пришлет подтверждение автоматически."
+)
+TICKET_CAPTION = "🎟️ <b>Ваш билет</b>\n\nПокажите этот QR-код на входе. Код билета: <code>{code}</code>"
+OWN_TICKET_TEXT = "🎟️ Это ваш билет. Покажите QR-код на входе, его отсканирует организатор."
+
+# Состояние готовности бота (для обработчиков и health check)
+READINESS_STARTING = 'starting'
+READINESS_READY = 'ready'
+READINESS_DEGRADED = 'degraded'
+
+# Имя обработчика текущего апдейта (метка bot_handler_errors_total)
+current_handler = ContextVar('current_handler', default='other')
+
+
+def log_handler_error(message):
+    """
+    Пишет в лог ошибку, перехваченную обработчиком, и учитывает ее в
+    bot_handler_errors_total: до обертки instrumented такие исключения не доходят.
+    """
+    HANDLER_ERRORS.inc(handler=current_handler.get())
+    logger.error(message, exc_info=True, stacklevel=2)
 
 class MatrixBot:
     def __init__(self):
+        # Конструктор не делает сетевых вызовов: Google Sheets подключается
+        # в фоне после запуска (см. on_startup / initialize_google_sheets)
         self.sheet = None
-        self.initialize_google_sheets()
+        self.sheets = None
+        # Хранилище регистраций (storage.py): None, пока не открыто
+        self.storage = None
+        self.exporter = None
+        # Перенос ручных правок из таблицы в SQLite (только при STORAGE_BACKEND=sqlite)
+        self.sheet_sync = None
+        self.application = None
+        self.web_runner = None
+        self.readiness = READINESS_STARTING
+        self.startup_timings = {}
+        self._init_task = None
+        # Предохранители: при недоступности сервиса обработчики отвечают сразу,
+        # а не ждут таймаутов (деградированный режим, см. degraded_dependencies)
+        self.sheets_breaker = CircuitBreaker('sheets')
+        self.yookassa_breaker = CircuitBreaker('yookassa')
+        self.yookassa = YooKassaClient(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, breaker=self.yookassa_breaker)
+        self.reconciler = PaymentReconciler(self)
+        self.broadcasts = None
+        self.catalog = EventCatalog()
+        self.inventory = TicketInventory(self.catalog.capacity)
+        self.stats = SalesStats()
+        # Электронные билеты: индекс оплаченных заказов для входа (БД открывается в attach_storage)
+        self.tickets = TicketIndex()
+        self.ticket_renderer = TicketRenderer()
+        # Профилирование следующих N апдейтов по команде /profile
+        self.profiler = UpdateProfiler()
+        # В режиме реплик заказы создают и другие экземпляры: перед обходом броней счетчики пересчитываются
+        self.hold_reaper = HoldReaper(self, self.inventory, reload_inventory=REPLICA_MODE)
+        # Удаление брошенных сессий регистрации (на каждом экземпляре)
+        self.session_reaper = SessionReaper(self)
+        # Общее хранилище и выбор ведущего в режиме нескольких реплик (REPLICA_MODE)
+        self.shared_store = None
+        self.leader = None
     
-    def initialize_google_sheets(self):
-        """Инициализация подключения к Google Sheets"""
-        try:
-            if GOOGLE_SERVICE_ACCOUNT:
-                credentials_info = json.loads(GOOGLE_SERVICE_ACCOUNT)
-                credentials = Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-                gc = gspread.authorize(credentials)
-                self.sheet = gc.open_by_key(SPREADSHEET_ID).sheet1
-                
-                # Проверяем, есть ли заголовки, если нет - добавляем
-                first_cell_value = self.sheet.cell(1, 1).value
-                if not first_cell_value:
-                    logger.info("Заголовки в Google Sheets не найдены, добавляем новые.")
-                    self.sheet.append_row(GS_HEADERS)
-                else:
-                    # Проверяем, совпадают ли заголовки
-                    existing_headers = self.sheet.row_values(1)
-                    if existing_headers != GS_HEADERS:
-                        logger.warning(f"Заголовки в таблице не совпадают. Ожидалось: {GS_HEADERS}, Получено: {existing_headers}")
-                        # Можно либо выдать ошибку, либо попытаться адаптироваться
-                        # Пока просто предупреждение
-                    else:
-                        logger.info("Заголовки в Google Sheets проверены и совпадают.")
-                logger.info("Google Sheets инициализирован успешно")
-            else:
-                logger.error("GOOGLE_SERVICE_ACCOUNT не найден в конфигурации!")
-                self.sheet = None
-        except Exception as e:
-            logger.error(f"Критическая ошибка подключения к Google Sheets: {e}", exc_info=True)
-            self.sheet = None
+    async def initialize_google_sheets(self):
+        """
+        Инициализация подключения к Google Sheets.
+        Блокирующие шаги gspread выполняются в пуле потоков; время каждого
+        шага сохраняется в self.startup_timings. Возвращает True при успехе.
+        """
+        if not GOOGLE_SERVICE_ACCOUNT:
+            logger.error("GOOGLE_SERVICE_ACCOUNT не найден в конфигурации!")
+            return False
+
+        timings = {}
+        started = step_started = time.perf_counter()
+
+        def mark(step):
+            nonlocal step_started
+            now = time.perf_counter()
+            timings[step] = round(now - step_started, 3)
+            step_started = now
+
+        credentials_info = json.loads(GOOGLE_SERVICE_ACCOUNT)
+        credentials = Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
+        gc = gspread.authorize(credentials)
+        mark('credentials')
+
+        sheet = await asyncio.wait_for(
+            asyncio.to_thread(lambda: gc.open_by_key(SPREADSHEET_ID).sheet1), SHEETS_CALL_TIMEOUT
+        )
+        mark('open_spreadsheet')
+
+        sheets = SheetsGateway(sheet, breaker=self.sheets_breaker)
+        if STORAGE_BACKEND == 'sheets':
+            # Таблица - само хранилище: читаем ее целиком в локальный индекс
+            storage = SheetsStorage(sheets)
+            await storage.start()
+            await self.attach_storage(storage)
+        else:
+            # Таблица - копия SQLite, заполняется в фоне
+            exporter = SheetsExporter(self.storage, sheets)
+            await exporter.start()
+            self.exporter = exporter
+            # Импорт заказов из таблицы мог добавить проданные билеты
+            await self.reload_storage_views()
+            self.sheet_sync = SheetSync(self.storage, exporter, on_bulk_change=self.reload_storage_views)
+            self.sheet_sync.start()
+        mark('load_sheet')
+
+        self.sheet = sheet
+        self.sheets = sheets
+
+        timings['total'] = round(time.perf_counter() - started, 3)
+        self.startup_timings.update(timings)
+        logger.info(f"Google Sheets инициализирован успешно за {timings['total']} сек.: {timings}")
+        return True
+
+    async def _initialize_in_background(self):
+        """Подключение к Google Sheets с повторами; пока не готово - бот в состоянии starting/degraded"""
+        delay = 5
+        while True:
+            try:
+                if await self.initialize_google_sheets():
+                    self.readiness = READINESS_READY
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Критическая ошибка подключения к Google Sheets: {e}", exc_info=True)
+            self.readiness = READINESS_DEGRADED
+            if not GOOGLE_SERVICE_ACCOUNT:
+                return
+            logger.info(f"Повторное подключение к Google Sheets через {delay} сек.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+
+    async def open_storage(self):
+        """Открывает локальное хранилище регистраций (для STORAGE_BACKEND=sqlite)"""
+        started = time.perf_counter()
+        storage = SQLiteStorage()
+        await storage.start()
+        await self.attach_storage(storage)
+        self.startup_timings['open_storage'] = round(time.perf_counter() - started, 3)
+
+    async def attach_storage(self, storage):
+        """Делает хранилище доступным обработчикам и подключает к нему учет билетов, сводку продаж и индекс входа"""
+        self.inventory.load(storage)
+        storage.add_listener(self.inventory.on_storage_change)
+        storage.add_listener(self.stats.on_storage_change)
+        storage.add_listener(self.tickets.on_storage_change)
+        await self.stats.load(storage)
+        await self.tickets.load(storage)
+        self.storage = storage
+
+    async def reload_storage_views(self):
+        """
+        Пересчитывает учет билетов, сводку продаж и индекс входа после импорта
+        или удаления заказов. Учет билетов - запросы по индексам SQLite, обход
+        всех заказов для сводки и индекса входа идет в фоновых потоках.
+        """
+        self.inventory.load(self.storage)
+        await self.stats.load(self.storage)
+        await self.tickets.load(self.storage)
+
+    async def on_startup(self, application: Application):
+        """Запуск фоновых задач после инициализации Application"""
+        self.application = application
+        # HTTP-сервер поднимаем первым, чтобы health check отвечал сразу
+        self.web_runner = await start_web_server(self)
+        # Каталог нужен до хранилища: из него берется вместимость мероприятий
+        self.catalog.start()
+        self.ticket_renderer.start()
+        if self.shared_store:
+            await self.shared_store.start()
+        if STORAGE_BACKEND != 'sheets':
+            # Локальная БД открывается за миллисекунды: бот готов, не дожидаясь Google
+            await self.open_storage()
+        self.broadcasts = BroadcastManager(application.bot)
+        self.session_reaper.start()
+        if self.shared_store:
+            # Экземпляр обслуживает пользователей сразу; фоновые задачи - только у ведущего
+            self.readiness = READINESS_READY
+            self.leader = LeaderElection(self.shared_store, self.start_leader_jobs, self.stop_leader_jobs)
+            self.leader.start()
+        else:
+            await self.start_leader_jobs()
+
+    async def start_leader_jobs(self):
+        """Фоновые задачи, которые должны выполняться только в одном экземпляре бота"""
+        self._init_task = asyncio.create_task(self._initialize_in_background())
+        self.reconciler.start()
+        self.hold_reaper.start()
+        self.broadcasts.start()
+
+    async def stop_leader_jobs(self, resigned=True):
+        """
+        Останавливает фоновые задачи ведущего. resigned=False - аренда уже
+        потеряна и новый ведущий мог начать выгрузку, поэтому остаток в
+        Google Sheets не выгружаем: его выгрузит он.
+        """
+        if self._init_task and not self._init_task.done():
+            self._init_task.cancel()
+        await self.reconciler.stop()
+        await self.hold_reaper.stop()
+        if self.sheet_sync:
+            await self.sheet_sync.stop()
+            self.sheet_sync = None
+        if self.exporter:
+            await self.exporter.stop(flush=resigned)
+            self.exporter = None
+        if self.shared_store:
+            # Google Sheets нужен только ведущему; хранилище экземпляра продолжает работать
+            if self.sheets:
+                self.sheets.shutdown()
+                self.sheet = self.sheets = None
+            self.readiness = READINESS_READY
+
+    async def on_shutdown(self, application: Application):
+        """Остановка фоновых задач: выгружаем остаток изменений в Google Sheets"""
+        if self.web_runner:
+            await self.web_runner.cleanup()
+        if self.leader:
+            # Снимает полномочия ведущего (stop_leader_jobs) и отдает аренду
+            await self.leader.stop()
+        else:
+            await self.stop_leader_jobs()
+        await self.session_reaper.stop()
+        await self.catalog.stop()
+        if self.broadcasts:
+            await self.broadcasts.stop()
+        await self.yookassa.close()
+        if self.storage:
+            await self.storage.stop()
+        self.tickets.close()
+        self.ticket_renderer.shutdown()
+        if self.shared_store:
+            await self.shared_store.stop()
+        if self.sheets:
+            self.sheets.shutdown()
+
+    async def reply_if_starting(self, update: Update):
+        """
+        Пока хранилище не открыто, проверки регистрации дали бы неверный ответ,
+        поэтому просим пользователя подождать. Возвращает True, если ответили.
+        """
+        if self.storage is not None:
+            return False
+        if update.effective_message:
+            await update.effective_message.reply_text("⏳ Бот запускается, попробуйте через минуту.")
+        return True
     
+    @staged('validate_phone')
     def is_valid_phone(self, phone):
         """
         Проверяет, является ли строка валидным телефоном.
@@ -106,83 +328,64 @@ class MatrixBot:
         
         return False
 
-    def find_row_by_payment_id(self, payment_id):
-        """Находит номер строки по Payment ID. Возвращает -1, если не найдено."""
-        if not self.sheet:
-            logger.error("Google Sheets не инициализирован для поиска строки.")
-            return -1
-        try:
-            # Получаем все значения, включая заголовки
-            all_values = self.sheet.get_all_values()
-            if not all_values:
-                logger.warning("Таблица пуста.")
-                return -1
-            
-            headers = all_values[0] # Первая строка - заголовки
-            try:
-                payment_id_col_index = headers.index('Payment ID') + 1 # gspread использует 1-based индекс
-            except ValueError:
-                logger.error("Столбец 'Payment ID' не найден в заголовках таблицы.")
-                return -1
-
-            # Поиск строки с нужным payment_id
-            for i, row in enumerate(all_values[1:], start=2): # Начинаем с 2, т.к. первая строка - заголовки
-                if len(row) >= payment_id_col_index and row[payment_id_col_index - 1] == str(payment_id):
-                    logger.info(f"Найдена строка с Payment ID {payment_id} в строке {i}.")
-                    return i
-            logger.info(f"Строка с Payment ID {payment_id} не найдена.")
-            return -1
-        except Exception as e:
-            logger.error(f"Ошибка при поиске строки по Payment ID: {e}", exc_info=True)
-            return -1
+    def degraded_dependencies(self):
+        """
+        Сервисы, отключенные предохранителями. Бот продолжает работать без
+        них: заказы копятся в локальном хранилище до восстановления Google
+        Sheets, а кнопка оплаты сразу сообщает о недоступности ЮKassa.
+        """
+        return [breaker.name for breaker in (self.sheets_breaker, self.yookassa_breaker) if breaker.state != STATE_CLOSED]
 
-    def user_already_registered(self, user_id):
-        """Проверяет, зарегистрирован ли пользователь с успешной оплатой"""
-        if not self.sheet:
-            logger.warning("Google Sheets не инициализирован для проверки регистрации.")
-            return False
-        try:
-            records = self.sheet.get_all_records()
-            logger.debug(f"Проверка регистрации для User ID: {user_id}. Всего записей: {len(records)}")
-            for record in records:
-                # Проверяем ID пользователя и статус оплаты
-                if str(record.get('User ID', '')) == str(user_id) and str(record.get('Статус оплаты', '')) == 'Оплачено':
-                    logger.info(f"Пользователь {user_id} уже зарегистрирован и оплатил.")
-                    return True
-            logger.info(f"Пользователь {user_id} не найден как оплативший.")
-            return False
-        except Exception as e:
-            logger.error(f"Ошибка проверки регистрации для User ID {user_id}: {e}", exc_info=True)
-            return False
+    def is_admin(self, user_id):
+        """Администраторы перечислены в ADMIN_IDS"""
+        return user_id in ADMIN_IDS
+
+    def is_staff(self, user_id):
+        """Проверять билеты на входе могут сотрудники из STAFF_IDS и администраторы"""
+        return user_id in STAFF_IDS or self.is_admin(user_id)
+
+    @staged('registration_check')
+    def user_already_registered(self, user_id, event_id=None):
+        """Проверяет, зарегистрирован ли пользователь с успешной оплатой (на мероприятие event_id)"""
+        if self.storage.is_paid(user_id, event_id or self.catalog.default_id):
+            logger.info(f"Пользователь {user_id} уже зарегистрирован и оплатил.", extra=SAMPLED)
+            return True
+        logger.debug(f"Пользователь {user_id} не найден как оплативший.")
+        return False
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         try:
             user_id = update.effective_user.id
-            logger.info(f"Пользователь {user_id} запустил бота (/start).")
-            
-            # Проверяем, не зарегистрирован ли уже пользователь
-            if self.user_already_registered(user_id):
-                await update.message.reply_text("✅ Вы уже зарегистрированы на мероприятии!")
+            logger.info(f"Пользователь {user_id} запустил бота (/start).", extra=SAMPLED)
+            if await self.reply_if_starting(update):
+                return
+
+            if context.args and context.args[0].startswith(CHECKIN_PREFIX):
+                # Ссылка из QR-кода билета: сотрудник отмечает проход, участник видит подсказку
+                if self.is_staff(user_id):
+                    await self.check_in_ticket(update, context.args[0])
+                else:
+                    await update.message.reply_text(OWN_TICKET_TEXT)
                 return
             
-            # Новое приветственное сообщение
-            welcome_text = (
-                "🎲 <b>Дорогой друг!</b>\n\n"
-                "🔮 Приглашаю тебя на Трансформационную игру\n"
-                "✨ <b>«Выход из Матрицы»</b> ✨\n\n"
-                "📅 <b>Дата проведения:</b> 27 сентября \n"
-                "🎟️ <b>Стоимость билета:</b> <code>{price} руб.</code>\n\n"
-                "Здесь ты откроешь новые горизонты своего сознания, найдешь путь к внутренним ресурсам и сделаешь первые шаги к осознанному изменению своей жизни🎯\n\n"
-                "Пусть игра станет началом твоего вдохновляющего путешествия к мечте и счастью!💌"
-            ).format(price=TICKET_PRICE)
-            
-            keyboard = [[InlineKeyboardButton("🎟️ Зарегистрироваться", callback_data='register')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            events = self.catalog.open_events()
+            if len(events) == 1:
+                # Проверяем, не зарегистрирован ли уже пользователь
+                if self.user_already_registered(user_id, events[0].id):
+                    await update.message.reply_text("✅ Вы уже зарегистрированы на мероприятии!")
+                    return
+
+                if self.inventory.sold_out(events[0].id):
+                    await update.message.reply_text(SOLD_OUT_TEXT)
+                    return
             
+            FUNNEL.inc(step='start')
+            # Приглашение или выбор мероприятия - текст и клавиатура подготовлены каталогом заранее
+            welcome_text, reply_markup = self.catalog.start_message()
             await update.message.reply_text(welcome_text, parse_mode='HTML', reply_markup=reply_markup)
         except Exception as e:
-            logger.error(f"Ошибка в start handler для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в start handler для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}")
             await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
     async def button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -191,15 +394,30 @@ class MatrixBot:
             query = update.callback_query
             await query.answer()
             user_id = query.from_user.id
-            logger.info(f"Пользователь {user_id} нажал кнопку: {query.data}")
+            logger.info(f"Пользователь {user_id} нажал кнопку: {query.data}", extra=SAMPLED)
+            if await self.reply_if_starting(update):
+                return
             
-            if query.data == 'register':
+            if query.data == 'register' or query.data.startswith(REGISTER_PREFIX):
+                # 'register' - кнопка из сообщений до появления каталога
+                event_id = query.data[len(REGISTER_PREFIX):] if query.data != 'register' else self.catalog.default_id
+                event = self.catalog.get(event_id)
+                if event is None or not event.on_sale():
+                    await query.edit_message_text("📭 Регистрация на это мероприятие закрыта.\n\nВведите /start, чтобы увидеть открытые игры.")
+                    return
+
                 # Проверяем, не зарегистрирован ли уже пользователь
-                if self.user_already_registered(user_id):
+                if self.user_already_registered(user_id, event.id):
                     await query.edit_message_text("✅ Вы уже зарегистрированы на мероприятии!")
                     return
+
+                if self.inventory.sold_out(event.id):
+                    await query.edit_message_text(SOLD_OUT_TEXT)
+                    return
                     
                 # Начинаем регистрацию - спрашиваем количество билетов
+                FUNNEL.inc(step='register')
+                context.user_data['event_id'] = event.id
                 context.user_data['state'] = USER_STATE_WAITING_FOR_TICKET_COUNT
                 await query.edit_message_text(
                     "🎟️ <b>Сколько билетов вы хотите приобрести?</b>\n\n"
@@ -230,7 +448,7 @@ class MatrixBot:
                 await self.cancel_payment(update, context)
                 
         except Exception as e:
-            logger.error(f"Ошибка в button handler для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в button handler для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}")
             try:
                 await update.callback_query.answer("⚠️ Произошла ошибка. Попробуйте позже.", show_alert=True)
             except:
@@ -242,17 +460,28 @@ class MatrixBot:
             user_id = update.effective_user.id
             text = update.message.text.strip()
             state = context.user_data.get('state')
-            logger.info(f"Пользователь {user_id} отправил сообщение в состоянии {state}: '{text}'")
+            # Сам текст не логируем: это имена и номера телефонов
+            logger.info(f"Пользователь {user_id} отправил сообщение в состоянии {state} ({len(text)} симв.)", extra=SAMPLED)
+            if await self.reply_if_starting(update):
+                return
 
+            event_id = context.user_data.get('event_id', self.catalog.default_id)
             # Проверяем, не зарегистрирован ли уже пользователь (кроме ввода количества билетов)
-            if self.user_already_registered(user_id) and state != USER_STATE_WAITING_FOR_TICKET_COUNT:
+            if self.user_already_registered(user_id, event_id) and state != USER_STATE_WAITING_FOR_TICKET_COUNT:
                 await update.message.reply_text("✅ Вы уже зарегистрированы на мероприятии!")
                 return
             
             if state == USER_STATE_WAITING_FOR_TICKET_COUNT:
                 try:
                     ticket_count = int(text)
-                    if 1 <= ticket_count <= 10:
+                    available = self.inventory.available(event_id)
+                    if available is not None and 1 <= ticket_count <= 10 and ticket_count > available:
+                        if available == 0:
+                            await update.message.reply_text(SOLD_OUT_TEXT)
+                            context.user_data.clear()
+                        else:
+                            await update.message.reply_text(f"⚠️ Осталось только {available} билет(ов). Введите число поменьше.")
+                    elif 1 <= ticket_count <= 10:
                         context.user_data['ticket_count'] = ticket_count
                         context.user_data['state'] = USER_STATE_WAITING_FOR_NAME
                         await update.message.reply_text("👤 <b>Введите ваше имя:</b>", parse_mode='HTML')
@@ -270,7 +499,7 @@ class MatrixBot:
                 await update.message.reply_text("📱 <b>Введите ваш номер телефона:</b>\nПример: +79001234567", parse_mode='HTML')
                 
             elif state == USER_STATE_WAITING_FOR_PHONE:
-                logger.info(f"Проверка введенного номера: {text}")
+                logger.debug(f"Проверка введенного номера: {mask_phone(text)}", extra=SAMPLED)
                 if not self.is_valid_phone(text):
                     await update.message.reply_text(
                         "⚠️ Пожалуйста, введите корректный номер телефона.\n"
@@ -278,6 +507,7 @@ class MatrixBot:
                     )
                     return
                 context.user_data['phone'] = text
+                FUNNEL.inc(step='phone')
                 # Регистрация завершена, показываем кнопку оплаты
                 await self.show_payment_button(update, context)
             else:
@@ -286,7 +516,7 @@ class MatrixBot:
                 await update.message.reply_text("Что-то пошло не так. Введите /start, чтобы начать заново.")
                 
         except Exception as e:
-            logger.error(f"Ошибка в handle_message для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в handle_message для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}")
             await update.message.reply_text("⚠️ Произошла ошибка. Попробуйте позже.")
 
     async def show_payment_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -297,8 +527,13 @@ class MatrixBot:
                 'phone': context.user_data.get('phone', ''),
                 'ticket_count': context.user_data.get('ticket_count', 1)
             }
+            event = self.catalog.get(context.user_data.get('event_id'))
+            if event is None:
+                await update.message.reply_text("📭 Мероприятие больше недоступно. Введите /start, чтобы начать заново.")
+                context.user_data.clear()
+                return
             
-            total_amount = user_data['ticket_count'] * TICKET_PRICE
+            total_amount = user_data['ticket_count'] * event.price
             
             # Генерируем уникальный ID для платежа
             payment_id = str(uuid.uuid4())
@@ -309,6 +544,7 @@ class MatrixBot:
             # Сообщение с деталями заказа
             order_text = (
                 "📄 <b>Подтверждение заказа:</b>\n\n"
+                f"🎲 Игра: <b>«{event.title}»</b>, {event.date}\n"
                 f"👤 Имя: <code>{user_data['name']}</code>\n"
                 f"📱 Телефон: <code>{user_data['phone']}</code>\n"
                 f"🎟️ Количество билетов: <b>{user_data['ticket_count']}</b>\n"
@@ -321,7 +557,7 @@ class MatrixBot:
             
             await update.message.reply_text(order_text, parse_mode='HTML', reply_markup=reply_markup)
         except Exception as e:
-            logger.error(f"Ошибка в show_payment_button для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в show_payment_button для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}")
             await update.message.reply_text("⚠️ Произошла ошибка при создании заказа.")
 
     async def process_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
@@ -342,16 +578,69 @@ class MatrixBot:
                 'phone': context.user_data.get('phone', ''),
                 'ticket_count': context.user_data.get('ticket_count', 1)
             }
+            event_id = context.user_data.get('event_id', self.catalog.default_id)
+            event = self.catalog.get(event_id)
+            event_title = event.title if event else EVENT_TITLE
             
             if total_amount <= 0:
                 logger.error(f"Неверная сумма для оплаты: {total_amount}")
                 await query.answer("⚠️ Ошибка: неверная сумма.", show_alert=True)
                 return
 
+            if not self.yookassa_breaker.available():
+                # ЮKassa недоступна: отвечаем сразу, не бронируя билеты и не дожидаясь таймаутов
+                # Ответ отдельным сообщением: на нажатие кнопки уже ответил button(), а кнопка оплаты остается
+                logger.info(f"Оплата недоступна (предохранитель ЮKassa) для User ID: {user_id}, Payment ID: {payment_id}")
+                await query.message.reply_text(PAYMENTS_UNAVAILABLE_TEXT)
+                return
+
+            # Заказ "Ожидание оплаты" с бронью билетов записывается до запроса к ЮKassa:
+            # медленная ЮKassa не держит ни проверку остатка, ни другие заказы
+            record = self.storage.get(payment_id)
+            if record is not None and record['Статус'] == PAYMENT_STATUS_PAID:
+                await query.edit_message_text("✅ Этот заказ уже оплачен.")
+                return
+            if record is not None and record['Статус'] != PAYMENT_STATUS_PENDING:
+                # Бронь заказа уже снята (HoldReaper, отмена): прежний платеж ЮKassa
+                # повторно не выдаем, а оформляем новый заказ с новым payment_id,
+                # его бронь проверяет остаток заново
+                if event is None or not event.on_sale():
+                    await query.edit_message_text("📭 Регистрация на это мероприятие закрыта.\n\nВведите /start, чтобы увидеть открытые игры.")
+                    context.user_data.clear()
+                    return
+                logger.info(f"Заказ {payment_id} в статусе '{record['Статус']}', оформляется новый заказ для User ID: {user_id}")
+                payment_id = str(uuid.uuid4())
+                context.user_data['payment_id'] = payment_id
+                context.user_data.pop('yookassa_payment_id', None)
+                record = None
+            if record is not None:
+                logger.info(f"Заказ {payment_id} уже записан, повторное нажатие оплаты.")
+            else:
+                new_row_data = [
+                    user_id,
+                    query.from_user.username or '',
+                    user_data['name'],
+                    user_data['phone'],
+                    user_data['ticket_count'],
+                    f"{total_amount} руб.",
+                    datetime.now().strftime("%d.%m.%Y %H:%M"),
+                    PAYMENT_STATUS_PENDING,
+                    payment_id,
+                    event_id
+                ]
+                if not await self.reserve_order(payment_id, new_row_data, event_id, user_data['ticket_count']):
+                    logger.info(f"Недостаточно билетов для User ID: {user_id}, Payment ID: {payment_id}")
+                    await query.edit_message_text(SOLD_OUT_TEXT)
+                    return
+                logger.info(f"Данные 'Ожидание оплаты' сохранены для Payment ID: {payment_id}")
+
             logger.info(f"Создание платежа в ЮKassa для User ID: {user_id}, Payment ID: {payment_id}, Сумма: {total_amount}")
 
-            # Создаем платеж через ЮKassa
-            payment = Payment.create({
+            # Создаем платеж через ЮKassa. Idempotence-Key выводится из нашего payment_id,
+            # поэтому повторное нажатие или повтор запроса вернет тот же платеж.
+            # Если запрос не удался, заказ остается в ожидании: повторное нажатие
+            # создаст платеж для него же, а брошенный заказ отменит HoldReaper
+            payment = await self.yookassa.create_payment({
                 "amount": {
                     "value": f"{total_amount:.2f}", # Форматирование до 2 знаков после запятой
                     "currency": "RUB"
@@ -361,43 +650,25 @@ class MatrixBot:
                     "return_url": f"https://t.me/{context.bot.username}" # Используем имя бота из контекста
                 },
                 "capture": True,
-                "description": f"Оплата за участие в игре 'Выход из Матрицы'. Билетов: {user_data['ticket_count']}",
+                "description": f"Оплата за участие в игре '{event_title}'. Билетов: {user_data['ticket_count']}",
                 "metadata": {
                     "payment_id": payment_id,
+                    "event_id": event_id,
                     "user_id": str(user_id),
                     "name": user_data['name'],
                     "phone": user_data['phone'],
                     "ticket_count": str(user_data['ticket_count'])
                 }
-            })
+            }, idempotence_key=idempotence_key(payment_id))
+            self.inventory.attach_payment(payment_id, payment['id'])
+            # Бронь с этим платежом может отменять ведущий другого экземпляра
+            await self.storage.set_yookassa_payment_id(payment_id, payment['id'])
             
             # Сохраняем ID платежа ЮKassa
-            context.user_data['yookassa_payment_id'] = payment.id
-            logger.info(f"Платеж в ЮKassa создан. ЮKassa Payment ID: {payment.id}")
-            
-            # Сохраняем предварительные данные в Google Sheets со статусом "Ожидание оплаты"
-            if self.sheet:
-                try:
-                    new_row_data = [
-                        user_id,
-                        query.from_user.username or '',
-                        user_data['name'],
-                        user_data['phone'],
-                        user_data['ticket_count'],
-                        f"{total_amount} руб.",
-                        datetime.now().strftime("%d.%m.%Y %H:%M"),
-                        "Ожидание оплаты",
-                        payment_id
-                    ]
-                    logger.debug(f"Подготовленные данные для записи в Google Sheets: {new_row_data}")
-                    append_result = self.sheet.append_row(new_row_data)
-                    logger.debug(f"Результат добавления строки в Google Sheets: {append_result}")
-                    logger.info(f"Данные 'Ожидание оплаты' добавлены в Google Sheets для Payment ID: {payment_id}")
-                except Exception as e:
-                    logger.error(f"КРИТИЧЕСКАЯ ОШИБКА записи 'Ожидание оплаты' в Google Sheets: {e}", exc_info=True)
-                    # Можно также попробовать отправить сообщение пользователю об ошибке записи
-            else:
-                logger.error("Google Sheets не инициализирован для записи 'Ожидание оплаты'")
+            if context.user_data.get('yookassa_payment_id') != payment['id']:
+                FUNNEL.inc(step='pay')
+            context.user_data['yookassa_payment_id'] = payment['id']
+            logger.info(f"Платеж в ЮKassa создан. ЮKassa Payment ID: {payment['id']}")
             
             # Создаем кнопку для перехода к оплате
             payment_text = (
@@ -409,7 +680,7 @@ class MatrixBot:
             )
             
             keyboard = [
-                [InlineKeyboardButton("💳 Перейти к оплате", url=payment.confirmation.confirmation_url)],
+                [InlineKeyboardButton("💳 Перейти к оплате", url=payment['confirmation']['confirmation_url'])],
                 [InlineKeyboardButton("✅ Проверить оплату", callback_data=f'check_payment_{payment_id}')],
                 [InlineKeyboardButton("❌ Отменить", callback_data='cancel_payment')]
             ]
@@ -417,19 +688,43 @@ class MatrixBot:
             
             await query.edit_message_text(payment_text, parse_mode='HTML', reply_markup=reply_markup)
             
-        except yookassa.Error as ye:
+        except YooKassaUnavailable:
+            try:
+                await update.callback_query.message.reply_text(PAYMENTS_UNAVAILABLE_TEXT)
+            except:
+                pass
+        except YooKassaError as ye:
             logger.error(f"Ошибка API ЮKassa: {ye}", exc_info=True)
             try:
                 await update.callback_query.answer("⚠️ Ошибка при создании платежа в ЮKassa.", show_alert=True)
             except:
                 pass
         except Exception as e:
-            logger.error(f"Ошибка в process_payment для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в process_payment для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}")
             try:
                 await update.callback_query.answer("⚠️ Ошибка при создании платежа.", show_alert=True)
             except:
                 pass
 
+    async def reserve_order(self, payment_id, row_values, event_id, count):
+        """
+        Записывает заказ "Ожидание оплаты" и бронирует под него билеты.
+        Возвращает False, если билетов не хватает. Один экземпляр проверяет
+        остаток по учету в памяти (reserve без await), в режиме реплик -
+        общая SQLite одной транзакцией вместе с записью заказа.
+        """
+        if self.shared_store:
+            return await self.storage.add_registration_within(row_values, self.catalog.capacity(event_id))
+        if not self.inventory.reserve(payment_id, count, event_id):
+            return False
+        try:
+            await self.storage.add_registration(row_values)
+        except Exception:
+            # Заказ не записан - возвращаем билеты в продажу
+            self.inventory.release(payment_id)
+            raise
+        return True
+
     async def check_payment_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
         """Проверка статуса платежа"""
         try:
@@ -437,6 +732,12 @@ class MatrixBot:
             user_id = query.from_user.id
             logger.info(f"Проверка статуса платежа для User ID: {user_id}, Payment ID: {payment_id}")
 
+            # Оплата могла быть уже подтверждена уведомлением ЮKassa - отвечаем без запроса к API
+            record = self.storage.get(payment_id)
+            if record is not None and record['Статус'] == PAYMENT_STATUS_PAID and str(record['User ID']) == str(user_id):
+                await query.answer("✅ Оплата уже подтверждена. До встречи на игре!", show_alert=True)
+                return
+
             # Проверка, что это тот же пользователь, который инициировал платеж
             if context.user_data.get('payment_id') != payment_id:
                 logger.warning(f"Попытка проверки чужого платежа. User ID: {user_id}, Payment ID: {payment_id}")
@@ -451,13 +752,14 @@ class MatrixBot:
             
             logger.info(f"Запрос статуса платежа у ЮKassa: {yookassa_payment_id}")
             # Получаем статус платежа из ЮKassa
-            payment = Payment.find_one(yookassa_payment_id)
-            logger.info(f"Статус платежа от ЮKassa: {payment.status}")
+            payment = await self.yookassa.get_payment(yookassa_payment_id)
+            payment_status = payment['status']
+            logger.info(f"Статус платежа от ЮKassa: {payment_status}")
             
-            if payment.status == 'succeeded':
+            if payment_status == 'succeeded':
                 # Платеж успешен
                 await self.confirm_payment_success(update, context, payment_id)
-            elif payment.status == 'canceled':
+            elif payment_status == 'canceled':
                 # Платеж отменен
                 await self.cancel_payment(update, context)
             else:
@@ -466,15 +768,17 @@ class MatrixBot:
                     'pending': '⏳ Платеж еще не подтвержден. Пожалуйста, дождитесь подтверждения оплаты.',
                     'waiting_for_capture': '⏳ Платеж ожидает захвата. Обычно это происходит автоматически.',
                     'canceled': '❌ Платеж был отменен.',
-                }.get(payment.status, f'⏳ Статус платежа: {payment.status}. Пожалуйста, дождитесь подтверждения.')
+                }.get(payment_status, f'⏳ Статус платежа: {payment_status}. Пожалуйста, дождитесь подтверждения.')
                 
                 await query.answer(status_message, show_alert=True)
                 
-        except yookassa.Error as ye:
+        except YooKassaUnavailable:
+            await query.message.reply_text(PAYMENT_CHECK_UNAVAILABLE_TEXT)
+        except YooKassaError as ye:
             logger.error(f"Ошибка API ЮKassa при проверке статуса: {ye}", exc_info=True)
             await query.answer("⚠️ Ошибка при проверке статуса платежа в ЮKassa", show_alert=True)
         except Exception as e:
-            logger.error(f"Ошибка при проверке статуса платежа для Payment ID {payment_id}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка при проверке статуса платежа для Payment ID {payment_id}: {e}")
             await query.answer("⚠️ Ошибка при проверке статуса платежа", show_alert=True)
 
     async def confirm_payment_success(self, update: Update, context: ContextTypes.DEFAULT_TYPE, payment_id):
@@ -489,48 +793,23 @@ class MatrixBot:
                 'phone': context.user_data.get('phone', ''),
                 'ticket_count': context.user_data.get('ticket_count', 1),
                 'total_amount': context.user_data.get('total_amount', 0),
-                'payment_id': payment_id
+                'payment_id': payment_id,
+                'event_id': context.user_data.get('event_id')
             }
             
             logger.info(f"Подтверждение успешной оплаты для User ID: {user_id}, Payment ID: {payment_id}")
             
-            # Обновляем статус в Google Sheets
-            update_success = False
-            if self.sheet:
-                try:
-                    row_index = self.find_row_by_payment_id(payment_id)
-                    if row_index != -1:
-                        self.sheet.update_cell(row_index, GS_COL_STATUS, "Оплачено")
-                        logger.info(f"Статус в Google Sheets обновлен на 'Оплачено' для строки {row_index}, Payment ID: {payment_id}")
-                        update_success = True
-                    else:
-                        logger.error(f"Строка с Payment ID {payment_id} не найдена в Google Sheets для обновления статуса.")
-                except Exception as e:
-                    logger.error(f"Ошибка обновления статуса 'Оплачено' в Google Sheets: {e}", exc_info=True)
-            else:
-                logger.error("Google Sheets не инициализирован для обновления статуса 'Оплачено'")
+            # Обновляем статус заказа
+            update_success = await self.mark_payment_status(payment_id, PAYMENT_STATUS_PAID)
             
             # Сообщение об успешной оплате
-            success_text = (
-                "🎉 <b>Поздравляем!</b>\n\n"
-                "✅ <b>Оплата успешно выполнена!</b>\n\n"
-                "🔮 Вы успешно зарегистрировались на Трансформационную игру\n"
-                "✨ <b>«Выход из Матрицы»</b> ✨\n\n"
-                "📄 <b>Детали заказа:</b>\n"
-                f"👤 Имя: <code>{user_data['name']}</code>\n"
-                f"📱 Телефон: <code>{user_data['phone']}</code>\n"
-                f"🎟️ Количество билетов: <b>{user_data['ticket_count']}</b>\n"
-                f"💰 Сумма: <b>{user_data['total_amount']} руб.</b>\n"
-                f"🆔 Номер платежа: <code>{user_data['payment_id']}</code>\n"
-                f"📅 Дата: <code>{datetime.now().strftime('%d.%m.%Y %H:%M')}</code>\n\n"
-                f"💳 <b>Статус:</b> <code>{'Оплачено' if update_success else 'Ошибка обновления статуса'}</code>\n\n"
-                "Спасибо за регистрацию! До встречи на игре! 🎊"
-            )
-            
+            success_text = self.build_success_text(user_data, update_success)
             await query.edit_message_text(success_text, parse_mode='HTML')
+            if update_success:
+                await self.send_ticket(query.message.chat_id, payment_id)
             
         except Exception as e:
-            logger.error(f"Ошибка в confirm_payment_success для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}, Payment ID {payment_id}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в confirm_payment_success для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}, Payment ID {payment_id}: {e}")
             try:
                 error_text = "⚠️ Ошибка при подтверждении оплаты. Пожалуйста, свяжитесь с администратором."
                 # Проверяем, можно ли редактировать сообщение
@@ -547,6 +826,175 @@ class MatrixBot:
             context.user_data.clear()
             logger.info(f"Сессия пользователя {user_id} очищена после успешной оплаты.")
 
+    async def mark_payment_status(self, payment_id, status):
+        """
+        Записывает статус заказа в хранилище (в Google Sheets он попадет в фоне).
+        Повторная запись того же статуса ничего не делает.
+        Возвращает True, если заказ в итоге имеет этот статус.
+        """
+        if not self.storage:
+            logger.error(f"Хранилище не инициализировано для обновления статуса '{status}'")
+            return False
+        record = self.storage.get(payment_id)
+        if record is None:
+            logger.error(f"Заказ с Payment ID {payment_id} не найден для обновления статуса.")
+            return False
+        if record['Статус'] == status:
+            return True
+        try:
+            if not await self.storage.set_status(payment_id, status):
+                # Статус успел изменить параллельный обработчик
+                record = self.storage.get(payment_id)
+                return record is not None and record['Статус'] == status
+            if status == PAYMENT_STATUS_PAID:
+                FUNNEL.inc(step='paid')
+            logger.info(f"Статус '{status}' сохранен, Payment ID: {payment_id}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления статуса '{status}': {e}", exc_info=True)
+            return False
+
+    def build_success_text(self, user_data, update_success):
+        """Текст сообщения об успешной оплате"""
+        event = self.catalog.get(user_data.get('event_id'))
+        return (
+            "🎉 <b>Поздравляем!</b>\n\n"
+            "✅ <b>Оплата успешно выполнена!</b>\n\n"
+            "🔮 Вы успешно зарегистрировались на Трансформационную игру\n"
+            f"✨ <b>«{event.title if event else EVENT_TITLE}»</b> ✨\n"
+            f"📅 {event.date if event else EVENT_DATE}\n\n"
+            "📄 <b>Детали заказа:</b>\n"
+            f"👤 Имя: <code>{user_data['name']}</code>\n"
+            f"📱 Телефон: <code>{user_data['phone']}</code>\n"
+            f"🎟️ Количество билетов: <b>{user_data['ticket_count']}</b>\n"
+            f"💰 Сумма: <b>{user_data['total_amount']} руб.</b>\n"
+            f"🆔 Номер платежа: <code>{user_data['payment_id']}</code>\n"
+            f"📅 Дата: <code>{datetime.now().strftime('%d.%m.%Y %H:%M')}</code>\n\n"
+            f"💳 <b>Статус:</b> <code>{'Оплачено' if update_success else 'Ошибка обновления статуса'}</code>\n\n"
+            "Спасибо за регистрацию! До встречи на игре! 🎊"
+        )
+
+    async def handle_payment_notification(self, event, payment, verified=False):
+        """
+        Обработка уведомления ЮKassa (payment.succeeded / payment.canceled).
+        Уведомления могут приходить повторно и параллельно с нажатием
+        "Проверить оплату", поэтому уже обработанный заказ пропускаем.
+        verified=False - тело пришло на webhook и могло быть подделано:
+        платеж запрашивается у ЮKassa заново, и дальше используется только
+        ее ответ. Сверка передает платежи из API ЮKassa с verified=True.
+        """
+        if self.storage is None:
+            # Хранилище заказов еще не открыто: ошибка заставит ЮKassa повторить уведомление
+            raise RuntimeError("Бот еще запускается, уведомление будет обработано при повторе")
+        if not verified:
+            yookassa_payment_id = payment.get('id')
+            if not yookassa_payment_id:
+                logger.warning("Уведомление ЮKassa без ID платежа, пропускаем.")
+                return
+            try:
+                payment = await self.yookassa.get_payment(yookassa_payment_id)
+            except YooKassaError as e:
+                if e.status != 404:
+                    raise
+                logger.warning(f"Уведомление ЮKassa о несуществующем платеже {yookassa_payment_id}, пропускаем.")
+                return
+            event = f"payment.{payment.get('status')}"
+        metadata = payment.get('metadata') or {}
+        payment_id = metadata.get('payment_id')
+        user_id = metadata.get('user_id')
+        if not payment_id or not user_id:
+            logger.warning(f"Уведомление ЮKassa без metadata заказа, ЮKassa Payment ID: {payment.get('id')}")
+            return
+        if not payment_matches_order(payment, self.storage.get(payment_id)):
+            logger.warning(f"Платеж ЮKassa {payment.get('id')} не совпадает с заказом {payment_id} "
+                           f"(пользователь или сумма), уведомление не применено.")
+            return
+        if self.shared_store:
+            # Та же блокировка, что у апдейтов пользователя на любом экземпляре:
+            # уведомление и "Проверить оплату" не подтвердят заказ дважды
+            async with self.shared_store.lock(f'user:{user_id}'):
+                await self.apply_payment_notification(event, payment, payment_id, user_id)
+        else:
+            # Один экземпляр: та же блокировка пользователя, что у его апдейтов
+            async with self.application.update_processor.user_lock(int(user_id)):
+                await self.apply_payment_notification(event, payment, payment_id, user_id)
+
+    async def apply_payment_notification(self, event, payment, payment_id, user_id):
+        """Применяет уведомление ЮKassa к заказу и сообщает пользователю"""
+        metadata = payment.get('metadata') or {}
+        record = self.storage.get(payment_id)
+        if event == 'payment.succeeded':
+            if record is not None and record['Статус'] == PAYMENT_STATUS_PAID:
+                logger.info(f"Повторное уведомление об оплате для Payment ID {payment_id}, пропускаем.")
+                return
+            update_success = await self.mark_payment_status(payment_id, PAYMENT_STATUS_PAID)
+            amount = float((payment.get('amount') or {}).get('value', 0))
+            user_data = {
+                'name': metadata.get('name', ''),
+                'phone': metadata.get('phone', ''),
+                'ticket_count': metadata.get('ticket_count', 1),
+                'total_amount': int(amount) if amount.is_integer() else amount,
+                'payment_id': payment_id,
+                'event_id': metadata.get('event_id')
+            }
+            text = self.build_success_text(user_data, update_success)
+            logger.info(f"Оплата подтверждена уведомлением ЮKassa для User ID: {user_id}, Payment ID: {payment_id}")
+        elif event == 'payment.canceled':
+            if record is not None and record['Статус'] != PAYMENT_STATUS_PENDING:
+                return
+            await self.mark_payment_status(payment_id, PAYMENT_STATUS_CANCELED)
+            text = "❌ Оплата не прошла или была отменена.\n\nВведите /start для новой регистрации"
+            logger.info(f"Платеж отменен по уведомлению ЮKassa для User ID: {user_id}, Payment ID: {payment_id}")
+        else:
+            logger.info(f"Уведомление ЮKassa '{event}' не обрабатывается.")
+            return
+
+        await self.clear_user_session(int(user_id), payment_id)
+        await self.application.bot.send_message(chat_id=int(user_id), text=text, parse_mode='HTML')
+        if event == 'payment.succeeded' and update_success:
+            await self.send_ticket(int(user_id), payment_id)
+
+    def ticket_link(self, payment_id):
+        """Ссылка для QR-кода: камера телефона сотрудника откроет бота с /start t_<код>"""
+        return f"https://t.me/{self.application.bot.username}?start={CHECKIN_PREFIX}{ticket_code(payment_id)}"
+
+    async def send_ticket(self, chat_id, payment_id):
+        """
+        Отправляет QR-билет оплаченного заказа. Первая отправка отрисовывает
+        QR в пуле процессов, повторные идут по file_id Telegram.
+        Ошибка отправки не мешает подтверждению оплаты: билет можно
+        получить командой /ticket.
+        """
+        caption = TICKET_CAPTION.format(code=ticket_code(payment_id))
+        try:
+            photo = self.ticket_renderer.file_id(payment_id)
+            if photo is None:
+                photo = await self.ticket_renderer.render(payment_id, self.ticket_link(payment_id))
+            message = await self.application.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, parse_mode='HTML')
+            if message.photo:
+                self.ticket_renderer.remember_file_id(payment_id, message.photo[-1].file_id)
+        except Exception as e:
+            logger.error(f"Ошибка отправки билета для Payment ID {payment_id}: {e}", exc_info=True)
+
+    async def clear_user_session(self, user_id, payment_id):
+        """Сбрасывает сессию пользователя, если она относится к этому заказу"""
+        persistence = self.application.persistence
+        if isinstance(persistence, SharedPersistence):
+            # Актуальная сессия - в общем хранилище, локальная копия могла устареть
+            user_data = await persistence.peek_user_data(user_id)
+        elif isinstance(persistence, SQLitePersistence) and user_id not in self.application.user_data:
+            # Сессия пользователя еще не загружена из хранилища после перезапуска
+            user_data = await persistence.peek_user_data(user_id)
+        else:
+            user_data = self.application.user_data.get(user_id)
+        if user_data and user_data.get('payment_id') == payment_id:
+            if isinstance(persistence, SharedPersistence):
+                await self.shared_store.save_session(user_id, None)
+            else:
+                self.application.drop_user_data(user_id)
+                await persistence.drop_user_data(user_id)
+            logger.info(f"Сессия пользователя {user_id} очищена после уведомления ЮKassa.")
+
     async def confirm_payment(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Подтверждение оплаты (для обратной совместимости)"""
         payment_id = context.user_data.get('payment_id', '')
@@ -567,22 +1015,220 @@ class MatrixBot:
             logger.info(f"Отмена оплаты для User ID: {user_id}, Payment ID: {payment_id}")
             
             # Пытаемся обновить статус в таблице на "Отменено"
-            if self.sheet and payment_id:
-                try:
-                    row_index = self.find_row_by_payment_id(payment_id)
-                    if row_index != -1:
-                        self.sheet.update_cell(row_index, GS_COL_STATUS, "Отменено")
-                        logger.info(f"Статус в Google Sheets обновлен на 'Отменено' для строки {row_index}, Payment ID: {payment_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка обновления статуса 'Отменено' в Google Sheets: {e}", exc_info=True)
+            if payment_id:
+                await self.mark_payment_status(payment_id, PAYMENT_STATUS_CANCELED)
             
             await query.edit_message_text("❌ Оплата отменена.\n\nВведите /start для новой регистрации")
         except Exception as e:
-            logger.error(f"Ошибка в cancel_payment для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в cancel_payment для User ID {update.callback_query.from_user.id if update.callback_query and update.callback_query.from_user else 'unknown'}: {e}")
         finally:
             context.user_data.clear()
             logger.info("Сессия пользователя очищена после отмены оплаты.")
 
+    async def broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /broadcast <текст>: рассылка всем оплатившим участникам"""
+        user_id = update.effective_user.id
+        if not self.is_admin(user_id):
+            logger.warning(f"Пользователь {user_id} без прав администратора вызвал /broadcast.")
+            return
+        if await self.reply_if_starting(update):
+            return
+        # Текст берем целиком, с переносами строк, а не из context.args
+        parts = update.message.text.split(None, 1)
+        if len(parts) < 2 or not parts[1].strip():
+            await update.message.reply_text("Использование: /broadcast <текст сообщения>")
+            return
+        recipients = self.storage.paid_user_ids()
+        if not recipients:
+            await update.message.reply_text("Нет оплативших участников для рассылки.")
+            return
+        try:
+            await self.broadcasts.create(parts[1].strip(), recipients, update.effective_chat.id)
+        except Exception as e:
+            log_handler_error(f"Ошибка создания рассылки администратором {user_id}: {e}")
+            await update.message.reply_text("⚠️ Не удалось создать рассылку.")
+
+    async def broadcast_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /broadcast_status [номер]: прогресс рассылки"""
+        if not self.is_admin(update.effective_user.id):
+            return
+        broadcast_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+        progress = self.broadcasts.status(broadcast_id)
+        if progress is None:
+            await update.message.reply_text("Рассылка не найдена.")
+            return
+        await update.message.reply_text(self.broadcasts.format_status(progress))
+
+    async def broadcast_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /broadcast_cancel <номер>: остановка рассылки"""
+        if not self.is_admin(update.effective_user.id):
+            return
+        if not context.args or not context.args[0].isdigit():
+            await update.message.reply_text("Использование: /broadcast_cancel <номер рассылки>")
+            return
+        broadcast_id = int(context.args[0])
+        if not await self.broadcasts.cancel(broadcast_id):
+            await update.message.reply_text("Рассылка не найдена.")
+            return
+        await update.message.reply_text(self.broadcasts.format_status(self.broadcasts.status(broadcast_id)))
+
+    async def sales_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /stats: сводка продаж и воронка"""
+        if not self.is_admin(update.effective_user.id):
+            return
+        if await self.reply_if_starting(update):
+            return
+        if self.shared_store:
+            # Слушатель видит только изменения этого экземпляра: берем итоги общей SQLite,
+            # которые триггеры ведут при каждой записи (запрос по нескольким строкам)
+            await self.stats.load(self.storage)
+        funnel = {step: FUNNEL.value(step=step) for step, _ in FUNNEL_STEPS}
+        await update.message.reply_text(format_stats(self.stats, self.catalog, funnel), parse_mode='HTML')
+
+    async def export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /export [мероприятие]: CSV со всеми заказами"""
+        user_id = update.effective_user.id
+        if not self.is_admin(user_id):
+            return
+        if await self.reply_if_starting(update):
+            return
+        event_id = context.args[0] if context.args else None
+        started = time.perf_counter()
+        try:
+            # Файл собирается генератором в фоновом потоке, event loop продолжает обслуживать пользователей
+            output, count = await asyncio.to_thread(export_csv, self.storage.iter_records(), event_id)
+        except Exception as e:
+            log_handler_error(f"Ошибка выгрузки заказов администратором {user_id}: {e}")
+            await update.message.reply_text("⚠️ Не удалось выгрузить заказы.")
+            return
+        logger.info(f"Выгрузка {count} заказов для администратора {user_id} за {time.perf_counter() - started:.2f} сек.")
+        with output:
+            await update.message.reply_document(
+                document=output,
+                filename=f"registrations_{event_id or 'all'}_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                caption=f"📄 Заказов: {count}",
+            )
+
+    async def ticket(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /ticket: повторная отправка билетов пользователя"""
+        if await self.reply_if_starting(update):
+            return
+        payment_ids = self.tickets.paid_orders(update.effective_user.id)
+        if not payment_ids:
+            await update.message.reply_text("У вас нет оплаченных билетов.\n\nВведите /start для регистрации")
+            return
+        for payment_id in payment_ids:
+            await self.send_ticket(update.effective_chat.id, payment_id)
+
+    async def checkin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /checkin <код>: проверка билета на входе"""
+        user_id = update.effective_user.id
+        if not self.is_staff(user_id):
+            logger.warning(f"Пользователь {user_id} без прав сотрудника вызвал /checkin.")
+            return
+        if await self.reply_if_starting(update):
+            return
+        if not context.args:
+            await update.message.reply_text("Использование: /checkin <код билета или ссылка из QR-кода>")
+            return
+        await self.check_in_ticket(update, context.args[0])
+
+    async def check_in_ticket(self, update: Update, code):
+        """Проверяет код билета, отмечает проход и отвечает сотруднику"""
+        staff_id = update.effective_user.id
+        try:
+            result, record, used_at = await self.tickets.check_in(code, staff_id)
+        except Exception as e:
+            log_handler_error(f"Ошибка отметки прохода сотрудником {staff_id}: {e}")
+            await update.message.reply_text("⚠️ Проход не отмечен из-за ошибки. Отсканируйте билет еще раз.")
+            return
+        if result == CHECKIN_UNPAID:
+            text = "❌ Заказ не найден или не оплачен."
+        elif record is None:
+            text = "❌ Недействительный код билета."
+        else:
+            event = self.catalog.get(record['Мероприятие'])
+            details = (
+                f"👤 {record['Имя']}\n"
+                f"🎟️ Билетов: <b>{record['Количество билетов']}</b>\n"
+                f"✨ {event.title + ', ' + event.date if event else record['Мероприятие']}"
+            )
+            if result == CHECKIN_OK:
+                text = f"✅ <b>Проходите!</b>\n\n{details}"
+            else:
+                used = datetime.fromtimestamp(used_at).strftime('%d.%m %H:%M:%S')
+                text = f"⛔ <b>Билет уже использован</b> ({used})\n\n{details}"
+        logger.info(f"Проверка билета сотрудником {staff_id}: {result}"
+                    + (f", Payment ID {record['Payment ID']}" if record else ''))
+        await update.message.reply_text(text, parse_mode='HTML')
+
+    async def profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /profile <N> | off: cProfile следующих N апдейтов"""
+        if not self.is_admin(update.effective_user.id):
+            return
+        arg = context.args[0].lower() if context.args else ''
+        if arg == 'off':
+            self.profiler.disarm()
+            await update.message.reply_text("Профилирование остановлено.")
+            return
+        if not arg.isdigit() or not 0 < int(arg) <= PROFILE_MAX_UPDATES:
+            status = (f"идет, осталось апдейтов: {self.profiler.remaining}" if self.profiler.armed else "не идет")
+            await update.message.reply_text(
+                f"Использование: /profile <1-{PROFILE_MAX_UPDATES}> | off\nПрофилирование {status}."
+            )
+            return
+        if not self.profiler.arm(int(arg), update.effective_chat.id):
+            await update.message.reply_text(f"Профилирование уже идет, осталось апдейтов: {self.profiler.remaining}.")
+            return
+        logger.info(f"Администратор {update.effective_user.id} включил профилирование {arg} апдейтов.")
+        await update.message.reply_text(f"🔬 Профилирую следующие {arg} апдейтов. Отчет придет в этот чат.")
+
+    async def send_profile_report(self, report):
+        """Отправляет администратору сводку и файл pstats (открывается pstats/snakeviz)"""
+        try:
+            summary = report.summary.strip()
+            if len(summary) > 3500:
+                summary = summary[:3500] + '\n...'
+            await self.application.bot.send_message(
+                chat_id=report.chat_id,
+                text=f"🔬 Профиль {report.updates} апдейтов за {report.duration:.1f} сек.\n\n<pre>{html.escape(summary)}</pre>",
+                parse_mode='HTML',
+            )
+            await self.application.bot.send_document(
+                chat_id=report.chat_id,
+                document=report.data,
+                filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof",
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки профиля: {e}", exc_info=True)
+
+    async def resync(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /resync: перенос ручных правок из Google Sheets сейчас"""
+        user_id = update.effective_user.id
+        if not self.is_admin(user_id):
+            return
+        if self.sheet_sync is None:
+            if STORAGE_BACKEND == 'sheets':
+                text = "При STORAGE_BACKEND=sheets таблица и есть хранилище, синхронизация не нужна."
+            elif self.leader and not self.leader.is_leader:
+                text = "Синхронизацию с Google Sheets выполняет ведущий экземпляр бота, повторите команду."
+            else:
+                text = "⏳ Google Sheets еще не подключен, попробуйте позже."
+            await update.message.reply_text(text)
+            return
+        try:
+            changes = await self.sheet_sync.sync(full=True)
+        except Exception as e:
+            log_handler_error(f"Ошибка синхронизации с Google Sheets по команде администратора {user_id}: {e}")
+            await update.message.reply_text("⚠️ Не удалось прочитать Google Sheets.")
+            return
+        await update.message.reply_text(
+            "🔄 Синхронизация с Google Sheets выполнена.\n"
+            f"Изменено заказов: {changes['edited']}\n"
+            f"Добавлено из таблицы: {changes['imported']}\n"
+            f"Удалено: {changes['deleted']}"
+        )
+
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /cancel"""
         try:
@@ -591,38 +1237,251 @@ class MatrixBot:
             context.user_data.clear()
             await update.message.reply_text("❌ Регистрация отменена.\n\nВведите /start для новой регистрации")
         except Exception as e:
-            logger.error(f"Ошибка в cancel handler для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}", exc_info=True)
+            log_handler_error(f"Ошибка в cancel handler для User ID {update.effective_user.id if update.effective_user else 'unknown'}: {e}")
 
 
 # Создаем экземпляр бота
 matrix_bot = MatrixBot()
 
+def payment_matches_order(payment, record):
+    """Платеж ЮKassa относится к заказу record: тот же пользователь и сумма в рублях"""
+    if record is None:
+        return False
+    metadata = payment.get('metadata') or {}
+    amount = payment.get('amount') or {}
+    try:
+        value = float(amount.get('value'))
+    except (TypeError, ValueError):
+        return False
+    return (
+        str(metadata.get('user_id')) == str(record['User ID'])
+        and amount.get('currency') == 'RUB'
+        and abs(value - amount_value(record)) < 0.01
+    )
+
+def instrumented(handler_name):
+    """
+    Считает апдейты, время обработки и апдейты в работе для обработчика.
+    Медленные апдейты пишутся в лог с разбивкой по этапам (update_timing.py),
+    при включенном /profile апдейт попадает в профиль.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            callback = callback_type(update.callback_query.data) if update.callback_query else ''
+            UPDATES_TOTAL.inc(handler=handler_name)
+            UPDATES_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            handler_token = current_handler.set(handler_name)
+            matrix_bot.profiler.begin_update()
+            if update.effective_user:
+                # Отсчет SESSION_TTL_MINUTES до удаления брошенной сессии
+                context.user_data.touch()
+            try:
+                with timed_update(f"{handler_name}/{callback}" if callback else handler_name,
+                                  update.effective_user.id if update.effective_user else None):
+                    await func(update, context)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=handler_name)
+                raise
+            finally:
+                current_handler.reset(handler_token)
+                UPDATES_IN_FLIGHT.dec()
+                HANDLER_LATENCY.observe(time.perf_counter() - started, handler=handler_name, callback=callback)
+                report = matrix_bot.profiler.end_update()
+                if report:
+                    context.application.create_task(matrix_bot.send_profile_report(report))
+        return wrapper
+    return decorator
+
+@instrumented('start')
 async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await matrix_bot.start(update, context)
 
+@instrumented('button')
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await matrix_bot.button(update, context)
 
+@instrumented('message')
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await matrix_bot.handle_message(update, context)
 
+@instrumented('cancel')
 async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await matrix_bot.cancel(update, context)
 
-def main():
-    """Основная функция для запуска бота"""
-    logger.info("Запуск бота...")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+@instrumented('admin')
+async def broadcast_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.broadcast(update, context)
+
+@instrumented('admin')
+async def broadcast_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.broadcast_status(update, context)
+
+@instrumented('admin')
+async def broadcast_cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.broadcast_cancel(update, context)
+
+@instrumented('admin')
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.sales_stats(update, context)
+
+@instrumented('admin')
+async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.export(update, context)
+
+@instrumented('admin')
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.profile(update, context)
+
+@instrumented('admin')
+async def resync_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.resync(update, context)
+
+@instrumented('ticket')
+async def ticket_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.ticket(update, context)
+
+@instrumented('checkin')
+async def checkin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await matrix_bot.checkin(update, context)
+
+class TimedRequest(BaseRequest):
+    """Транспорт Bot API, относящий время запросов к Telegram к этапу 'telegram' разбивки апдейта"""
+
+    def __init__(self, request):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return getattr(self._request, 'read_timeout', None)
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        with stage('telegram'):
+            return await self._request.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+
+async def post_init(application: Application):
+    await matrix_bot.on_startup(application)
+
+async def post_shutdown(application: Application):
+    await matrix_bot.on_shutdown(application)
+
+def build_application(request=None):
+    """
+    Создает Application с обработчиками и хуками жизненного цикла.
+    request - свой транспорт Bot API (BaseRequest), например заглушка в loadtest.py
+    """
+    if TELEGRAM_MODE == 'webhook' and not TELEGRAM_WEBHOOK_SECRET:
+        # Без секрета любой, кто узнал адрес, может прислать апдейт от имени администратора
+        raise ValueError("Для TELEGRAM_MODE=webhook нужен TELEGRAM_WEBHOOK_SECRET")
+    if REPLICA_MODE:
+        if TELEGRAM_MODE != 'webhook' or STORAGE_BACKEND != 'sqlite':
+            # Polling из нескольких процессов Telegram не допускает, а Google Sheets
+            # как хранилище держит индекс и очередь записи в памяти одного процесса
+            raise ValueError("REPLICA_MODE работает только с TELEGRAM_MODE=webhook и STORAGE_BACKEND=sqlite")
+        matrix_bot.shared_store = open_shared_store()
+        persistence = SharedPersistence(matrix_bot.shared_store)
+        processor = PerUserUpdateProcessor(CONCURRENT_UPDATES, shared=persistence)
+    else:
+        persistence = SQLitePersistence()
+        processor = PerUserUpdateProcessor(CONCURRENT_UPDATES)
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(processor)
+        .context_types(ContextTypes(user_data=RegistrationSession))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    else:
+        request = HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE)
+    builder = builder.request(TimedRequest(request))
+    if TELEGRAM_MODE == 'webhook':
+        # Апдейты принимает общий HTTP-сервер (web_server.py), Updater не нужен
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", start_handler))
     application.add_handler(CommandHandler("cancel", cancel_handler))
+    application.add_handler(CommandHandler("broadcast", broadcast_handler))
+    application.add_handler(CommandHandler("broadcast_status", broadcast_status_handler))
+    application.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_handler))
+    application.add_handler(CommandHandler("stats", stats_handler))
+    application.add_handler(CommandHandler("export", export_handler))
+    application.add_handler(CommandHandler("profile", profile_handler))
+    application.add_handler(CommandHandler("resync", resync_handler))
+    application.add_handler(CommandHandler("ticket", ticket_handler))
+    application.add_handler(CommandHandler("checkin", checkin_handler))
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    return application
+
+async def run_webhook(application: Application):
+    """
+    Работа в режиме webhook: апдейты Telegram приходят на общий HTTP-сервер
+    (вместе с health check и уведомлениями ЮKassa) и кладутся в очередь
+    Application. Повторяет жизненный цикл run_polling, но без Updater.
+    """
+    if not WEBHOOK_URL:
+        raise ValueError("Для TELEGRAM_MODE=webhook нужен WEBHOOK_URL (или RENDER_EXTERNAL_URL)")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + TELEGRAM_WEBHOOK_PATH,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"Webhook Telegram установлен на {WEBHOOK_URL.rstrip('/')}{TELEGRAM_WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def run_application(application: Application):
+    """Запуск бота в режиме, выбранном TELEGRAM_MODE"""
+    if TELEGRAM_MODE == 'webhook':
+        logger.info("Запуск в режиме webhook...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Запуск polling...")
+        application.run_polling()
+
+def main():
+    """Основная функция для запуска бота"""
+    logger.info("Запуск бота...")
+    application = build_application()
     
-    logger.info("Обработчики добавлены. Запуск polling...")
+    logger.info("Обработчики добавлены.")
     # Запускаем бота
-    application.run_polling()
+    run_application(application)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
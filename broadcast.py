@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from config import (
+    BROADCAST_PATH, BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL, BROADCAST_WORKERS, BROADCAST_PROGRESS_INTERVAL,
+)
+from rate_limiter import TelegramRateLimiter
+
+logger = logging.getLogger(__name__)
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_CANCELED = 'canceled'
+
+RECIPIENT_PENDING = 'pending'
+RECIPIENT_SENT = 'sent'
+RECIPIENT_FAILED = 'failed'
+
+# Сколько раз повторять отправку одному получателю после сетевой ошибки
+MAX_ATTEMPTS = 3
+
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after в разных версиях PTB - число или timedelta"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class BroadcastManager:
+    """
+    Рассылки сообщений участникам.
+    Рассылка и список получателей сохраняются в SQLite до начала отправки,
+    статус каждого получателя - сразу после отправки, поэтому после
+    перезапуска бота рассылка продолжается с неотправленных.
+    Отправка идет фоновыми задачами через общий TelegramRateLimiter,
+    не мешая обработке апдейтов; прогресс раз в BROADCAST_PROGRESS_INTERVAL
+    секунд обновляется в сообщении администратору.
+    БД - как в SQLiteStorage: чтения идут по отдельному соединению в event
+    loop, все записи - по своему соединению в одном фоновом потоке.
+    """
+
+    def __init__(self, bot, path=BROADCAST_PATH, rate=BROADCAST_RATE,
+                 per_chat_interval=BROADCAST_PER_CHAT_INTERVAL, workers=BROADCAST_WORKERS):
+        self.bot = bot
+        self.workers = workers
+        self.limiter = TelegramRateLimiter(rate, per_chat_interval)
+        self._tasks = {}  # broadcast_id -> asyncio.Task
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='broadcast')
+        # Соединение записи создается здесь, до запуска потока, и дальше
+        # используется только в нем (_run_db)
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        with self._writer:
+            self._writer.execute(
+                'CREATE TABLE IF NOT EXISTS broadcasts ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, status TEXT NOT NULL, '
+                'admin_chat_id INTEGER, progress_message_id INTEGER, created_at REAL NOT NULL, finished_at REAL)'
+            )
+            self._writer.execute(
+                'CREATE TABLE IF NOT EXISTS broadcast_recipients ('
+                'broadcast_id INTEGER NOT NULL, user_id INTEGER NOT NULL, state TEXT NOT NULL, error TEXT, '
+                'PRIMARY KEY (broadcast_id, user_id))'
+            )
+        self._reader = sqlite3.connect(path)
+        self._reader.execute('PRAGMA query_only=ON')
+
+    async def _run_db(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def start(self):
+        """Возобновляет рассылки, прерванные перезапуском"""
+        rows = self._reader.execute('SELECT id FROM broadcasts WHERE status = ?', (STATUS_RUNNING,)).fetchall()
+        for (broadcast_id,) in rows:
+            if broadcast_id in self._tasks:
+                # Рассылка уже идет в этом процессе
+                continue
+            logger.info(f"Возобновление рассылки #{broadcast_id}.")
+            self._launch(broadcast_id)
+
+    async def stop(self):
+        """Приостанавливает рассылки (продолжатся после запуска) и закрывает БД"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._run_db(self._writer.close)
+        self._executor.shutdown(wait=True)
+        self._reader.close()
+
+    def _launch(self, broadcast_id):
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    # --- Команды администратора ---
+
+    async def create(self, text, recipients, admin_chat_id):
+        """Сохраняет рассылку со списком получателей и запускает ее. Возвращает id."""
+        progress = await self.bot.send_message(
+            chat_id=admin_chat_id, text=f"📣 Рассылка создана, получателей: {len(recipients)}. Начинаю отправку…"
+        )
+        broadcast_id = await self._run_db(self._insert, text, recipients, admin_chat_id, progress.message_id)
+        logger.info(f"Рассылка #{broadcast_id} создана администратором {admin_chat_id}, получателей: {len(recipients)}.")
+        self._launch(broadcast_id)
+        return broadcast_id
+
+    def _insert(self, text, recipients, admin_chat_id, progress_message_id):
+        with self._writer:
+            cursor = self._writer.execute(
+                'INSERT INTO broadcasts (text, status, admin_chat_id, progress_message_id, created_at) VALUES (?, ?, ?, ?, ?)',
+                (text, STATUS_RUNNING, admin_chat_id, progress_message_id, time.time())
+            )
+            broadcast_id = cursor.lastrowid
+            self._writer.executemany(
+                'INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id, state) VALUES (?, ?, ?)',
+                [(broadcast_id, int(user_id), RECIPIENT_PENDING) for user_id in recipients]
+            )
+        return broadcast_id
+
+    async def cancel(self, broadcast_id):
+        """Останавливает рассылку; неотправленные сообщения не будут отправлены"""
+        if self.status(broadcast_id) is None:
+            return False
+        await self._run_db(self._finish, broadcast_id, STATUS_CANCELED)
+        task = self._tasks.get(broadcast_id)
+        if task:
+            task.cancel()
+        logger.info(f"Рассылка #{broadcast_id} отменена.")
+        return True
+
+    def status(self, broadcast_id=None):
+        """Прогресс рассылки (по умолчанию последней) или None"""
+        if broadcast_id is None:
+            row = self._reader.execute('SELECT id FROM broadcasts ORDER BY id DESC LIMIT 1').fetchone()
+            if row is None:
+                return None
+            broadcast_id = row[0]
+        row = self._reader.execute('SELECT status FROM broadcasts WHERE id = ?', (broadcast_id,)).fetchone()
+        if row is None:
+            return None
+        counts = dict(self._reader.execute(
+            'SELECT state, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY state', (broadcast_id,)
+        ).fetchall())
+        return {
+            'id': broadcast_id,
+            'status': row[0],
+            'total': sum(counts.values()),
+            'sent': counts.get(RECIPIENT_SENT, 0),
+            'failed': counts.get(RECIPIENT_FAILED, 0),
+            'pending': counts.get(RECIPIENT_PENDING, 0),
+        }
+
+    @staticmethod
+    def format_status(progress):
+        status = {
+            STATUS_RUNNING: '⏳ идет',
+            STATUS_DONE: '✅ завершена',
+            STATUS_CANCELED: '❌ отменена',
+        }.get(progress['status'], progress['status'])
+        return (
+            f"📣 Рассылка #{progress['id']}: {status}\n"
+            f"Отправлено: {progress['sent']} из {progress['total']}\n"
+            f"Не доставлено: {progress['failed']}\n"
+            f"Осталось: {progress['pending']}"
+        )
+
+    # --- Отправка ---
+
+    async def _run(self, broadcast_id):
+        text, admin_chat_id, progress_message_id = self._reader.execute(
+            'SELECT text, admin_chat_id, progress_message_id FROM broadcasts WHERE id = ?', (broadcast_id,)
+        ).fetchone()
+        queue = asyncio.Queue()
+        for (user_id,) in self._reader.execute(
+            'SELECT user_id FROM broadcast_recipients WHERE broadcast_id = ? AND state = ?', (broadcast_id, RECIPIENT_PENDING)
+        ):
+            queue.put_nowait(user_id)
+
+        progress_task = asyncio.create_task(self._report_progress(broadcast_id, admin_chat_id, progress_message_id))
+        workers = [asyncio.create_task(self._worker(broadcast_id, text, queue)) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*workers)
+            await self._run_db(self._finish, broadcast_id, STATUS_DONE)
+            logger.info(f"Рассылка #{broadcast_id} завершена.")
+        finally:
+            for task in workers:
+                task.cancel()
+            progress_task.cancel()
+            await asyncio.gather(*workers, progress_task, return_exceptions=True)
+        await self._update_progress(broadcast_id, admin_chat_id, progress_message_id)
+
+    async def _worker(self, broadcast_id, text, queue):
+        while not queue.empty():
+            user_id = queue.get_nowait()
+            state, error = await self._send(user_id, text)
+            await self._run_db(self._set_state, broadcast_id, user_id, state, error)
+
+    async def _send(self, user_id, text):
+        """Отправляет сообщение одному получателю. Возвращает (состояние, ошибка)."""
+        attempts = 0
+        while True:
+            await self.limiter.acquire(user_id)
+            try:
+                await self.bot.send_message(chat_id=user_id, text=text)
+                return RECIPIENT_SENT, None
+            except RetryAfter as e:
+                # Флуд-лимит относится ко всему боту: тормозим все воркеры
+                delay = retry_after_seconds(e)
+                logger.warning(f"Telegram просит паузу {delay} сек. при рассылке.")
+                self.limiter.retry_after(delay)
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат не существует - повтор не поможет
+                return RECIPIENT_FAILED, str(e)
+            except TelegramError as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.error(f"Не удалось отправить сообщение рассылки пользователю {user_id}: {e}")
+                    return RECIPIENT_FAILED, str(e)
+                await asyncio.sleep(attempts)
+
+    def _set_state(self, broadcast_id, user_id, state, error):
+        with self._writer:
+            self._writer.execute(
+                'UPDATE broadcast_recipients SET state = ?, error = ? WHERE broadcast_id = ? AND user_id = ?',
+                (state, error, broadcast_id, user_id)
+            )
+
+    def _finish(self, broadcast_id, status):
+        with self._writer:
+            self._writer.execute(
+                'UPDATE broadcasts SET status = ?, finished_at = ? WHERE id = ? AND status = ?',
+                (status, time.time(), broadcast_id, STATUS_RUNNING)
+            )
+
+    async def _report_progress(self, broadcast_id, admin_chat_id, progress_message_id):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._update_progress(broadcast_id, admin_chat_id, progress_message_id)
+
+    async def _update_progress(self, broadcast_id, admin_chat_id, progress_message_id):
+        progress = self.status(broadcast_id)
+        if progress is None or not admin_chat_id or not progress_message_id:
+            return
+        try:
+            await self.bot.edit_message_text(
+                chat_id=admin_chat_id, message_id=progress_message_id, text=self.format_status(progress)
+            )
+        except BadRequest:
+            # "message is not modified" - прогресс не изменился
+            pass
+        except TelegramError as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки #{broadcast_id}: {e}")
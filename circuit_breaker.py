@@ -0,0 +1,101 @@
+import logging
+import time
+from config import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT
+from metrics import CIRCUIT_STATE, CIRCUIT_REJECTED
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = 'closed'
+STATE_HALF_OPEN = 'half_open'
+STATE_OPEN = 'open'
+# Значения метрики bot_circuit_state
+STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Зависимость отключена предохранителем: вызов отклонен без обращения к ней"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса.
+    После failure_threshold сбоев подряд размыкается: вызовы сразу
+    получают CircuitOpenError, не дожидаясь таймаутов. Через reset_timeout
+    секунд пропускает один пробный вызов (half-open): успех замыкает
+    предохранитель, сбой снова размыкает его на reset_timeout.
+    Сбоем считается только недоступность сервиса (таймаут, сеть, 5xx,
+    429) - это решает is_failure вызывающего; ответ с ошибкой в запросе
+    означает, что сервис работает.
+    """
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._probe_in_flight = False
+        CIRCUIT_STATE.set(STATE_VALUES[self.state], dependency=name)
+
+    def available(self):
+        """Пройдет ли вызов сейчас (проверка без изменения состояния)"""
+        if self.state == STATE_CLOSED:
+            return True
+        if self._probe_in_flight:
+            return False
+        return self.state == STATE_HALF_OPEN or time.monotonic() - self._opened_at >= self.reset_timeout
+
+    async def call(self, func, *args, is_failure=lambda error: True, **kwargs):
+        """Выполняет await func(...) через предохранитель"""
+        self._before_call()
+        probe = self.state == STATE_HALF_OPEN
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if is_failure(e):
+                self._record_failure()
+            else:
+                self._record_success()
+            raise
+        except BaseException:
+            # Отмена вызова ничего не говорит о сервисе: пробный вызов можно повторить
+            if probe:
+                self._probe_in_flight = False
+            raise
+        self._record_success()
+        return result
+
+    def _before_call(self):
+        if self.state == STATE_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._set_state(STATE_HALF_OPEN)
+        if self.state == STATE_OPEN or (self.state == STATE_HALF_OPEN and self._probe_in_flight):
+            self.rejected += 1
+            CIRCUIT_REJECTED.inc(dependency=self.name)
+            raise CircuitOpenError(f"{self.name} временно недоступен")
+        if self.state == STATE_HALF_OPEN:
+            self._probe_in_flight = True
+
+    def _record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        if self.state != STATE_CLOSED:
+            self._set_state(STATE_CLOSED)
+            logger.warning(f"Предохранитель {self.name} замкнут: сервис снова отвечает.")
+
+    def _record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self._set_state(STATE_OPEN)
+            logger.error(f"Предохранитель {self.name} разомкнут после {self.failures} сбоев подряд: "
+                         f"вызовы отклоняются {self.reset_timeout} сек.")
+
+    def _set_state(self, state):
+        self.state = state
+        CIRCUIT_STATE.set(STATE_VALUES[state], dependency=self.name)
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures, 'rejected': self.rejected}
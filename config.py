@@ -25,4 +25,181 @@ USER_STATE_WAITING_FOR_PHONE = 'waiting_for_phone'
 USER_STATE_WAITING_FOR_TICKET_COUNT = 'waiting_for_ticket_count'
 
 # Google Sheets Scopes
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
\ No newline at end of file
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+# Google Sheets Layout
+GS_HEADERS = [
+    'User ID', 'Username', 'Имя', 'Номер телефона',
+    'Количество билетов', 'Сумма', 'Когда куплено', 'Статус', 'Payment ID', 'Мероприятие'
+]
+GS_COL_USER_ID = 1
+GS_COL_NAME = 3
+GS_COL_PHONE = 4
+GS_COL_DATE = 7
+GS_COL_STATUS = 8
+GS_COL_PAYMENT_ID = 9
+GS_COL_EVENT = 10
+
+# Payment Statuses (значения столбца 'Статус')
+PAYMENT_STATUS_PENDING = 'Ожидание оплаты'
+PAYMENT_STATUS_PAID = 'Оплачено'
+PAYMENT_STATUS_CANCELED = 'Отменено'
+
+# Google Sheets Gateway
+SHEETS_MAX_WORKERS = int(os.getenv('SHEETS_MAX_WORKERS', 4))
+SHEETS_CALL_TIMEOUT = float(os.getenv('SHEETS_CALL_TIMEOUT', 15))
+
+# Отложенная пакетная запись в Google Sheets
+SHEETS_JOURNAL_PATH = os.getenv('SHEETS_JOURNAL_PATH', 'sheets_journal.db')
+SHEETS_FLUSH_INTERVAL_MS = int(os.getenv('SHEETS_FLUSH_INTERVAL_MS', 2000))
+SHEETS_FLUSH_BATCH = int(os.getenv('SHEETS_FLUSH_BATCH', 50))
+
+# Перенос ручных правок из Google Sheets (sheet_sync.py): раз в SHEETS_SYNC_INTERVAL
+# сек. читается столбец Payment ID и окно из SHEETS_SYNC_WINDOW строк; за минуту
+# проверяются 60 / SHEETS_SYNC_INTERVAL * SHEETS_SYNC_WINDOW строк
+SHEETS_SYNC_INTERVAL = float(os.getenv('SHEETS_SYNC_INTERVAL', 20))
+SHEETS_SYNC_WINDOW = int(os.getenv('SHEETS_SYNC_WINDOW', 500))
+# Больше удаленных за раз строк не применяем: похоже на ошибку, а не на чистку тестовых заказов
+SHEETS_SYNC_MAX_DELETES = int(os.getenv('SHEETS_SYNC_MAX_DELETES', 20))
+
+# HTTP-сервер (health check и уведомления ЮKassa)
+PORT = int(os.getenv('PORT', 10000))
+YOOKASSA_WEBHOOK_PATH = os.getenv('YOOKASSA_WEBHOOK_PATH', '/yookassa/webhook')
+# Секрет, который добавляется к URL уведомлений в личном кабинете ЮKassa: ...?token=<секрет>
+YOOKASSA_WEBHOOK_SECRET = os.getenv('YOOKASSA_WEBHOOK_SECRET')
+# Принимать уведомления только с адресов ЮKassa. По умолчанию выключено: за прокси
+# (Render) без верного WEBHOOK_PROXY_HOPS адрес клиента - адрес прокси, и все
+# уведомления отклонялись бы; платеж из уведомления бот все равно перезапрашивает у ЮKassa
+YOOKASSA_WEBHOOK_CHECK_IP = os.getenv('YOOKASSA_WEBHOOK_CHECK_IP', 'false').lower() == 'true'
+# Сколько прокси (Render и т.п.) стоит перед ботом и дописывает X-Forwarded-For.
+# По умолчанию 0: без прокси заголовок подделывает сам клиент. На Render - 1.
+WEBHOOK_PROXY_HOPS = int(os.getenv('WEBHOOK_PROXY_HOPS', 0))
+# Токен для /status: GET /status?token=<токен> или заголовок Authorization: Bearer <токен>.
+# Без токена /status не обслуживается - он раскрывает заказы, квоты и реплики
+STATUS_TOKEN = os.getenv('STATUS_TOKEN')
+
+# Фоновая сверка платежей с ЮKassa
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', 60))
+RECONCILE_MAX_AGE_HOURS = int(os.getenv('RECONCILE_MAX_AGE_HOURS', 48))
+RECONCILE_MAX_BACKOFF = int(os.getenv('RECONCILE_MAX_BACKOFF', 900))
+
+# HTTP-клиент ЮKassa
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3')
+YOOKASSA_TIMEOUT = float(os.getenv('YOOKASSA_TIMEOUT', 10))
+YOOKASSA_MAX_RETRIES = int(os.getenv('YOOKASSA_MAX_RETRIES', 3))
+YOOKASSA_POOL_SIZE = int(os.getenv('YOOKASSA_POOL_SIZE', 20))
+
+# Хранение сессий пользователей (context.user_data) между перезапусками
+PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_state.db')
+PERSISTENCE_DEBOUNCE_MS = int(os.getenv('PERSISTENCE_DEBOUNCE_MS', 500))
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', 2))
+
+# Режим получения апдейтов Telegram: polling или webhook
+TELEGRAM_MODE = os.getenv('TELEGRAM_MODE', 'polling').lower()
+# Публичный адрес сервиса; Render передает его в RENDER_EXTERNAL_URL
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL')
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram')
+# Обязателен в режиме webhook: Telegram присылает его в заголовке каждого апдейта
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+# Сколько апдейтов обрабатывать одновременно; апдейты одного пользователя
+# всегда выполняются по очереди (update_processor.py)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 32))
+# Соединений к Bot API (как по умолчанию у python-telegram-bot)
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', 256))
+# Окно (сек.), в котором повторные одинаковые нажатия кнопки схлопываются
+CALLBACK_DEDUP_WINDOW = float(os.getenv('CALLBACK_DEDUP_WINDOW', 2))
+
+# Логирование
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# Доля сохраняемых "болтливых" записей (по одной на каждое сообщение пользователя) по уровням
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'DEBUG=0.01,INFO=0.1')
+
+# Хранилище регистраций: sqlite (источник истины - локальная БД, Google Sheets
+# получает копию в фоне) или sheets (все в Google Sheets, как раньше)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite').lower()
+STORAGE_PATH = os.getenv('STORAGE_PATH', 'registrations.db')
+
+# Администраторы бота: Telegram user_id через запятую
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if user_id}
+
+# Рассылки участникам
+BROADCAST_PATH = os.getenv('BROADCAST_PATH', 'broadcasts.db')
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат;
+# оставляем запас для ответов обычным пользователям
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 20))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv('BROADCAST_PER_CHAT_INTERVAL', 1))
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', 8))
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv('BROADCAST_PROGRESS_INTERVAL', 15))
+
+# Квоты Google Sheets API (по умолчанию 60 запросов в минуту на пользователя
+# для чтения и для записи; держимся в пределах меньшей из них)
+SHEETS_QUOTA_PER_MINUTE = int(os.getenv('SHEETS_QUOTA_PER_MINUTE', 60))
+SHEETS_QUOTA_BURST = int(os.getenv('SHEETS_QUOTA_BURST', 10))
+# Повторы при 429 и 5xx с экспоненциальной паузой
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', 5))
+SHEETS_BACKOFF_BASE = float(os.getenv('SHEETS_BACKOFF_BASE', 1))
+SHEETS_MAX_BACKOFF = float(os.getenv('SHEETS_MAX_BACKOFF', 64))
+
+# Билеты: вместимость мероприятия (0 - без ограничения) и время брони
+# неоплаченного заказа, после которого билеты возвращаются в продажу
+EVENT_CAPACITY = int(os.getenv('EVENT_CAPACITY', 0))
+HOLD_TTL_MINUTES = int(os.getenv('HOLD_TTL_MINUTES', 30))
+HOLD_SWEEP_INTERVAL = int(os.getenv('HOLD_SWEEP_INTERVAL', 60))
+HOLD_CANCEL_BATCH = int(os.getenv('HOLD_CANCEL_BATCH', 20))
+
+# Сессии регистрации (context.user_data): сессия без апдейтов дольше
+# SESSION_TTL_MINUTES удаляется из памяти и хранилища, ее неоплаченный заказ
+# отменяется. Срок не должен быть меньше HOLD_TTL_MINUTES, иначе заказы
+# будут отменяться раньше окончания брони.
+SESSION_TTL_MINUTES = int(os.getenv('SESSION_TTL_MINUTES', 120))
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 300))
+# Сообщать пользователю, что его неоплаченный заказ отменен
+SESSION_EXPIRED_NOTIFY = os.getenv('SESSION_EXPIRED_NOTIFY', 'false').lower() == 'true'
+
+# Каталог мероприятий: JSON-файл со списком игр (id, title, date, price,
+# capacity, active, sales_until). Перечитывается при изменении файла.
+# Без файла каталог состоит из одного мероприятия из настроек ниже.
+EVENTS_PATH = os.getenv('EVENTS_PATH', 'events.json')
+EVENTS_RELOAD_INTERVAL = int(os.getenv('EVENTS_RELOAD_INTERVAL', 10))
+# Часовой пояс для sales_until без смещения (сервер на Render работает в UTC)
+EVENTS_TIMEZONE = os.getenv('EVENTS_TIMEZONE', 'Europe/Moscow')
+# Мероприятие по умолчанию (и для заказов, записанных до появления каталога)
+DEFAULT_EVENT_ID = os.getenv('DEFAULT_EVENT_ID', 'default')
+EVENT_TITLE = os.getenv('EVENT_TITLE', 'Выход из Матрицы')
+EVENT_DATE = os.getenv('EVENT_DATE', '27 сентября')
+
+# Несколько экземпляров бота (реплик) за балансировщиком в режиме webhook.
+# Сессии пользователей и блокировки - в общем хранилище, фоновые задачи
+# (сверка платежей, брони, выгрузка в Google Sheets) - только у ведущего.
+REPLICA_MODE = os.getenv('REPLICA_MODE', 'false').lower() == 'true'
+SHARED_STORE_BACKEND = os.getenv('SHARED_STORE_BACKEND', 'sqlite').lower()
+SHARED_STORE_PATH = os.getenv('SHARED_STORE_PATH', 'shared_state.db')
+# Уникальное имя экземпляра (по умолчанию hostname:pid)
+REPLICA_ID = os.getenv('REPLICA_ID')
+USER_LOCK_TTL = float(os.getenv('USER_LOCK_TTL', 30))
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', 15))
+
+# Предохранители Google Sheets и ЮKassa: после стольких сбоев подряд вызовы
+# отклоняются сразу, через BREAKER_RESET_TIMEOUT сек. - пробный вызов
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', 30))
+
+# Электронные билеты: QR-код с подписанным кодом заказа и проверка на входе.
+# Ключ подписи лучше задать явно: по умолчанию это токен бота, и при его
+# смене выданные билеты перестанут проходить проверку.
+TICKET_SECRET = os.getenv('TICKET_SECRET') or TELEGRAM_TOKEN
+# Сотрудники на входе (user_id через запятую), администраторы - тоже
+STAFF_IDS = {int(user_id) for user_id in os.getenv('STAFF_IDS', '').replace(' ', '').split(',') if user_id}
+CHECKIN_PATH = os.getenv('CHECKIN_PATH', 'checkins.db')
+TICKET_RENDER_WORKERS = int(os.getenv('TICKET_RENDER_WORKERS', 2))
+TICKET_CACHE_SIZE = int(os.getenv('TICKET_CACHE_SIZE', 500))
+
+# Апдейты дольше стольких секунд пишутся в лог с разбивкой по этапам (0 - отключено)
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 2))
+# Максимум апдейтов для /profile
+PROFILE_MAX_UPDATES = int(os.getenv('PROFILE_MAX_UPDATES', 1000))
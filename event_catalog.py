@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from config import (
+    EVENTS_PATH, EVENTS_RELOAD_INTERVAL, EVENTS_TIMEZONE, DEFAULT_EVENT_ID, EVENT_TITLE, EVENT_DATE, TICKET_PRICE, EVENT_CAPACITY,
+)
+
+logger = logging.getLogger(__name__)
+
+REGISTER_PREFIX = 'register_'
+# callback_data в Telegram ограничена 64 байтами
+MAX_EVENT_ID_LENGTH = 64 - len(REGISTER_PREFIX)
+
+WELCOME_TEXT = (
+    "🎲 <b>Дорогой друг!</b>\n\n"
+    "🔮 Приглашаю тебя на Трансформационную игру\n"
+    "✨ <b>«{title}»</b> ✨\n\n"
+    "📅 <b>Дата проведения:</b> {date} \n"
+    "🎟️ <b>Стоимость билета:</b> <code>{price} руб.</code>\n\n"
+    "Здесь ты откроешь новые горизонты своего сознания, найдешь путь к внутренним ресурсам и сделаешь первые шаги к осознанному изменению своей жизни🎯\n\n"
+    "Пусть игра станет началом твоего вдохновляющего путешествия к мечте и счастью!💌"
+)
+CATALOG_TEXT = (
+    "🎲 <b>Дорогой друг!</b>\n\n"
+    "🔮 Приглашаю тебя на Трансформационные игры. Выбери ту, на которую хочешь зарегистрироваться:\n\n"
+    "{events}"
+)
+CATALOG_LINE = "✨ <b>«{title}»</b>\n📅 {date} · 🎟️ <code>{price} руб.</code>"
+NO_EVENTS_TEXT = "📭 Сейчас нет открытых регистраций. Загляните позже!"
+
+
+def parse_sales_until(value, tz=ZoneInfo(EVENTS_TIMEZONE)):
+    """
+    sales_until из каталога -> datetime в UTC. Время без смещения
+    ('2025-10-11T12:00') считается временем EVENTS_TIMEZONE, а не сервера.
+    """
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=tz)
+    return moment.astimezone(timezone.utc)
+
+
+class Event:
+    """Мероприятие каталога с заранее подготовленными текстом и клавиатурой"""
+
+    __slots__ = ('id', 'title', 'date', 'price', 'capacity', 'active', 'sales_until',
+                 'welcome_text', 'welcome_markup', 'catalog_line', 'catalog_button')
+
+    def __init__(self, id, title, date, price, capacity=0, active=True, sales_until=None):
+        self.id = str(id)
+        self.title = title
+        self.date = date
+        self.price = int(price)
+        self.capacity = int(capacity or 0)
+        self.active = bool(active)
+        # Ошибка здесь оставляет прежний каталог (EventCatalog.load)
+        self.sales_until = parse_sales_until(sales_until) if sales_until else None
+        if not self.id or len(self.id.encode('utf-8')) > MAX_EVENT_ID_LENGTH:
+            raise ValueError(f"Некорректный id мероприятия: {self.id!r}")
+        # Все, что не зависит от пользователя, строится один раз при загрузке
+        self.welcome_text = WELCOME_TEXT.format(title=title, date=date, price=self.price)
+        self.welcome_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("🎟️ Зарегистрироваться", callback_data=REGISTER_PREFIX + self.id)]]
+        )
+        self.catalog_line = CATALOG_LINE.format(title=title, date=date, price=self.price)
+        self.catalog_button = InlineKeyboardButton(f"🎟️ {title} · {date}", callback_data=REGISTER_PREFIX + self.id)
+
+    def on_sale(self, now=None):
+        if not self.active:
+            return False
+        return self.sales_until is None or (now or datetime.now(timezone.utc)) < self.sales_until
+
+
+def default_events():
+    """Каталог из одного мероприятия по настройкам окружения (как до появления каталога)"""
+    return [Event(DEFAULT_EVENT_ID, EVENT_TITLE, EVENT_DATE, TICKET_PRICE, EVENT_CAPACITY)]
+
+
+class EventCatalog:
+    """
+    Каталог мероприятий из EVENTS_PATH.
+    Файл читается при запуске и перечитывается фоновой задачей, когда
+    меняется его mtime; при ошибке в файле остается прежний каталог.
+    Сообщение /start для текущего набора открытых мероприятий кешируется.
+    """
+
+    def __init__(self, path=EVENTS_PATH, reload_interval=EVENTS_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.default_id = DEFAULT_EVENT_ID
+        self._events = {event.id: event for event in default_events()}
+        self._mtime = None
+        self._start_cache = {}  # кортеж id открытых мероприятий -> (текст, клавиатура)
+        self._task = None
+
+    def load(self):
+        """Читает файл каталога, если он изменился. Возвращает True, если каталог обновлен."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        if mtime is None:
+            events = default_events()
+        else:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    events = [Event(**item) for item in json.load(f)]
+            except (OSError, ValueError, TypeError) as e:
+                logger.error(f"Ошибка в каталоге мероприятий {self.path}, оставлен прежний каталог: {e}")
+                self._mtime = mtime
+                return False
+        self._events = {event.id: event for event in events}
+        self._mtime = mtime
+        self._start_cache = {}
+        logger.info(f"Каталог мероприятий загружен: {', '.join(self._events) or 'пусто'}.")
+        return True
+
+    def start(self):
+        self.load()
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                self.load()
+            except Exception as e:
+                logger.error(f"Ошибка перечитывания каталога мероприятий: {e}", exc_info=True)
+
+    def get(self, event_id):
+        """Мероприятие по id (пустой id - мероприятие по умолчанию) или None"""
+        return self._events.get(event_id or self.default_id)
+
+    def capacity(self, event_id):
+        event = self.get(event_id)
+        return event.capacity if event else 0
+
+    def open_events(self):
+        now = datetime.now(timezone.utc)
+        return [event for event in self._events.values() if event.on_sale(now)]
+
+    def start_message(self):
+        """Текст и клавиатура /start: одно мероприятие - приглашение, несколько - выбор"""
+        events = self.open_events()
+        key = tuple(event.id for event in events)
+        cached = self._start_cache.get(key)
+        if cached is None:
+            if not events:
+                cached = (NO_EVENTS_TEXT, None)
+            elif len(events) == 1:
+                cached = (events[0].welcome_text, events[0].welcome_markup)
+            else:
+                text = CATALOG_TEXT.format(events='\n\n'.join(event.catalog_line for event in events))
+                cached = (text, InlineKeyboardMarkup([[event.catalog_button] for event in events]))
+            self._start_cache[key] = cached
+        return cached
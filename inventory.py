@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from config import (
+    EVENT_CAPACITY, HOLD_TTL_MINUTES, HOLD_SWEEP_INTERVAL, HOLD_CANCEL_BATCH,
+    PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_CANCELED,
+)
+from payment_reconciler import parse_order_time
+from yookassa_client import YooKassaError, idempotence_key
+
+logger = logging.getLogger(__name__)
+
+
+def ticket_count(record):
+    try:
+        return int(record['Количество билетов'])
+    except (KeyError, ValueError):
+        return 0
+
+
+class Hold:
+    __slots__ = ('event_id', 'count', 'expires_at', 'yookassa_payment_id')
+
+    def __init__(self, event_id, count, expires_at, yookassa_payment_id=None):
+        self.event_id = event_id
+        self.count = count
+        self.expires_at = expires_at
+        self.yookassa_payment_id = yookassa_payment_id
+
+
+class TicketInventory:
+    """
+    Учет проданных и забронированных билетов в памяти, по мероприятиям.
+    Все методы синхронные и выполняются в event loop без await, поэтому
+    проверка остатка и бронь в reserve() атомарны относительно других
+    обработчиков: два одновременных нажатия "Оплатить" не продадут
+    последний билет дважды.
+    Проданные билеты и брони восстанавливаются из хранилища через load(),
+    дальше счетчики меняются по событиям хранилища (on_storage_change).
+    capacity_for(event_id) - вместимость мероприятия (0 - без ограничения).
+    """
+
+    def __init__(self, capacity_for=lambda event_id: EVENT_CAPACITY, hold_ttl_minutes=HOLD_TTL_MINUTES):
+        self.capacity_for = capacity_for
+        self.hold_ttl = hold_ttl_minutes * 60
+        self.sold = Counter()   # мероприятие -> продано билетов
+        self.held = Counter()   # мероприятие -> забронировано билетов
+        self._holds = {}        # payment_id -> Hold
+
+    def available(self, event_id):
+        """Сколько билетов мероприятия еще можно забронировать (None - без ограничения)"""
+        capacity = self.capacity_for(event_id)
+        if capacity <= 0:
+            return None
+        return max(capacity - self.sold[event_id] - self.held[event_id], 0)
+
+    def sold_out(self, event_id):
+        return self.available(event_id) == 0
+
+    def load(self, storage):
+        """Пересчитывает счетчики по хранилищу (после открытия или импорта заказов)"""
+        known_ids = {payment_id: hold.yookassa_payment_id for payment_id, hold in self._holds.items()}
+        # Платежи броней, созданных другими экземплярами бота
+        known_ids.update(storage.yookassa_payment_ids())
+        self.sold = Counter(storage.tickets_sold())
+        self.held = Counter()
+        self._holds.clear()
+        now = time.time()
+        for payment_id, record in storage.pending_payments().items():
+            created = parse_order_time(record['Когда куплено'])
+            created_at = created.timestamp() if created else now
+            hold = Hold(record['Мероприятие'], ticket_count(record), created_at + self.hold_ttl, known_ids.get(payment_id))
+            self._holds[payment_id] = hold
+            self.held[hold.event_id] += hold.count
+        logger.info(f"Билеты: продано {dict(self.sold)}, в брони {dict(self.held)}.")
+
+    def reserve(self, payment_id, count, event_id):
+        """Бронирует билеты под заказ. Возвращает False, если билетов не хватает."""
+        if payment_id in self._holds:
+            return True
+        available = self.available(event_id)
+        if available is not None and count > available:
+            return False
+        self.hold(payment_id, count, event_id)
+        return True
+
+    def hold(self, payment_id, count, event_id):
+        """Бронь без проверки остатка: его уже проверило хранилище (режим реплик)"""
+        if payment_id not in self._holds:
+            self._holds[payment_id] = Hold(event_id, count, time.time() + self.hold_ttl)
+            self.held[event_id] += count
+
+    def attach_payment(self, payment_id, yookassa_payment_id):
+        """Запоминает платеж ЮKassa брони, чтобы отменить его по истечении брони"""
+        hold = self._holds.get(payment_id)
+        if hold:
+            hold.yookassa_payment_id = yookassa_payment_id
+
+    def release(self, payment_id):
+        """Возвращает билеты брони в продажу"""
+        hold = self._holds.pop(payment_id, None)
+        if hold:
+            self.held[hold.event_id] -= hold.count
+
+    def expired(self):
+        """Брони, срок которых истек: {payment_id: Hold}"""
+        now = time.time()
+        return {payment_id: hold for payment_id, hold in self._holds.items() if hold.expires_at <= now}
+
+    def on_storage_change(self, record, previous_status):
+        """Слушатель хранилища: оплата переводит бронь в проданные, отмена - освобождает"""
+        payment_id = record['Payment ID']
+        event_id = record['Мероприятие']
+        status = record['Статус']
+        if status == previous_status:
+            return
+        if previous_status is None and status == PAYMENT_STATUS_PENDING:
+            # Новый заказ: бронь уже создана reserve() или записью в общую SQLite
+            self.hold(payment_id, ticket_count(record), event_id)
+        elif status == PAYMENT_STATUS_PAID:
+            hold = self._holds.get(payment_id)
+            self.release(payment_id)
+            self.sold[event_id] += hold.count if hold else ticket_count(record)
+            capacity = self.capacity_for(event_id)
+            if 0 < capacity < self.sold[event_id]:
+                # Платеж прошел уже после истечения брони
+                logger.warning(f"Продано {self.sold[event_id]} билетов на {event_id} при вместимости {capacity} (Payment ID {payment_id}).")
+        elif previous_status == PAYMENT_STATUS_PAID:
+            self.sold[event_id] -= ticket_count(record)
+        elif status != PAYMENT_STATUS_PENDING:
+            self.release(payment_id)
+
+    def stats(self):
+        events = set(self.sold) | set(self.held)
+        return {
+            event_id: {'capacity': self.capacity_for(event_id), 'sold': self.sold[event_id], 'held': self.held[event_id]}
+            for event_id in sorted(events)
+        }
+
+
+class HoldReaper:
+    """
+    Периодически отменяет просроченные брони: платежи ЮKassa отменяются
+    пачками по HOLD_CANCEL_BATCH параллельных запросов, статусы заказов
+    записываются в хранилище одной пачкой, билеты возвращаются в продажу.
+    ЮKassa отменяет через API только платежи в статусе waiting_for_capture;
+    неоплаченный платеж в статусе pending она отменит сама по истечении
+    срока подтверждения, а если он все же будет оплачен, заказ станет
+    оплаченным через уведомление или сверку (PaymentReconciler сверяет и
+    недавно отмененные заказы).
+    reload_inventory=True - перед обходом брони пересчитываются по
+    хранилищу (заказы создают и другие экземпляры бота).
+    """
+
+    def __init__(self, matrix_bot, inventory, interval=HOLD_SWEEP_INTERVAL, batch_size=HOLD_CANCEL_BATCH,
+                 reload_inventory=False):
+        self.matrix_bot = matrix_bot
+        self.inventory = inventory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.reload_inventory = reload_inventory
+        self.total_expired = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отмены просроченных броней: {e}", exc_info=True)
+
+    async def run_once(self):
+        """Отменяет все просроченные брони. Возвращает их число."""
+        storage = self.matrix_bot.storage
+        if storage is None:
+            return 0
+        if self.reload_inventory:
+            self.inventory.load(storage)
+        expired = self.inventory.expired()
+        await self.cancel_orders({payment_id: hold.yookassa_payment_id for payment_id, hold in expired.items()})
+        if expired:
+            self.total_expired += len(expired)
+            logger.info(f"Отменено просроченных броней: {len(expired)}.")
+        return len(expired)
+
+    async def cancel_orders(self, orders):
+        """
+        Отменяет неоплаченные заказы {payment_id: yookassa_payment_id или None}
+        пачками по batch_size. Возвращает Payment ID заказов, переведенных
+        в статус "Отменено".
+        """
+        storage = self.matrix_bot.storage
+        orders = list(orders.items())
+        canceled = []
+        for start in range(0, len(orders), self.batch_size):
+            batch = orders[start:start + self.batch_size]
+            await asyncio.gather(*(self._cancel_payment(payment_id, yookassa_payment_id)
+                                   for payment_id, yookassa_payment_id in batch))
+            statuses = {}
+            for payment_id, _ in batch:
+                record = storage.get(payment_id)
+                if record is not None and record['Статус'] == PAYMENT_STATUS_PENDING:
+                    statuses[payment_id] = PAYMENT_STATUS_CANCELED
+                else:
+                    # Заказ уже оплачен или отменен другим путем
+                    self.inventory.release(payment_id)
+            # Статус "Отменено" освобождает бронь через слушателя хранилища
+            await storage.set_statuses(statuses)
+            canceled.extend(statuses)
+        return canceled
+
+    async def _cancel_payment(self, payment_id, yookassa_payment_id):
+        if not yookassa_payment_id:
+            return
+        try:
+            await self.matrix_bot.yookassa.cancel_payment(yookassa_payment_id, idempotence_key(payment_id, 'cancel'))
+        except YooKassaError as e:
+            # Обычно платеж еще pending и не отменяется через API - ЮKassa отменит его сама
+            logger.info(f"ЮKassa не отменила платеж {yookassa_payment_id} (Payment ID {payment_id}): {e}")
@@ -0,0 +1,417 @@
+"""
+Нагрузочный тест воронки регистрации без сети.
+
+Прогоняет N одновременных пользователей через /start -> register ->
+количество билетов -> имя -> телефон -> pay_ -> check_payment_ с
+настоящими обработчиками MatrixBot, Application и PerUserUpdateProcessor.
+Telegram Bot API, Google Sheets и ЮKassa заменены локальными заглушками
+с настраиваемой задержкой и долей ошибок.
+
+Пример:
+    python loadtest.py --users 500 --sheets-latency 0.3 --yookassa-latency 0.2 --yookassa-error-rate 0.02
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from gspread.utils import a1_to_rowcol
+from telegram import Update
+from telegram.request import BaseRequest
+
+# Процессы отрисовки билетов (spawn) импортируют этот модуль повторно как
+# __mp_main__: рабочий каталог и бот нужны только самому нагрузочному тесту
+if __name__ != '__mp_main__':
+    # Конфигурация читается при импорте bot.py, поэтому окружение готовим заранее
+    _workdir = tempfile.mkdtemp(prefix='matrixbot-loadtest-')
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:LOADTEST')
+    os.environ.setdefault('TELEGRAM_MODE', 'polling')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['GOOGLE_SERVICE_ACCOUNT'] = ''
+    os.environ['LOG_FILE'] = os.path.join(_workdir, 'bot.log')
+    os.environ['SHEETS_JOURNAL_PATH'] = os.path.join(_workdir, 'sheets_journal.db')
+    os.environ['PERSISTENCE_PATH'] = os.path.join(_workdir, 'bot_state.db')
+    os.environ['STORAGE_PATH'] = os.path.join(_workdir, 'registrations.db')
+    os.environ['CHECKIN_PATH'] = os.path.join(_workdir, 'checkins.db')
+
+    import bot
+    from config import GS_HEADERS
+    from sheets_exporter import SheetsExporter
+    from sheets_gateway import SheetsGateway
+    from storage import SheetsStorage
+    from yookassa_client import YooKassaError
+
+FUNNEL_STEPS = ('start', 'register', 'ticket_count', 'name', 'phone', 'pay', 'check_payment')
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'MatrixBot', 'username': 'matrix_loadtest_bot'}
+
+
+class FakeSheetsError(Exception):
+    """Сбой, имитирующий ошибку API Google Sheets"""
+
+
+class Fault:
+    """Задержка и доля ошибок для заглушки внешнего сервиса"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class FakeCell:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet:
+    """
+    Заглушка gspread.Worksheet в памяти. Методы синхронные и "спят", как
+    настоящие HTTP-вызовы gspread, поэтому нагрузка на пул потоков
+    SheetsGateway такая же, как в продакшене.
+    """
+
+    def __init__(self, fault):
+        self.fault = fault
+        self.rows = [list(GS_HEADERS)]
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _io(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.fault.delay())
+        if self.fault.should_fail():
+            raise FakeSheetsError("Injected Google Sheets failure")
+
+    def get_all_values(self, **kwargs):
+        self._io()
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def row_values(self, row, **kwargs):
+        self._io()
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col, **kwargs):
+        self._io()
+        with self._lock:
+            return [row[col - 1] if col <= len(row) else '' for row in self.rows]
+
+    def cell(self, row, col, **kwargs):
+        values = self.row_values(row)
+        return FakeCell(values[col - 1] if col <= len(values) else None)
+
+    def append_row(self, values, **kwargs):
+        return self.append_rows([values], **kwargs)
+
+    def append_rows(self, values, **kwargs):
+        self._io()
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.extend([str(value) for value in row] for row in values)
+            last = len(self.rows)
+        return {'updates': {'updatedRange': f"Sheet1!A{first}:I{last}", 'updatedRows': len(values)}}
+
+    def update_cell(self, row, col, value, **kwargs):
+        self._io()
+        with self._lock:
+            self._set(row, col, value)
+
+    def batch_update(self, data, **kwargs):
+        self._io()
+        with self._lock:
+            for item in data:
+                row, col = a1_to_rowcol(item['range'].split(':')[0])
+                self._set(row, col, item['values'][0][0])
+
+    def _set(self, row, col, value):
+        while len(self.rows) < row:
+            self.rows.append([])
+        target = self.rows[row - 1]
+        while len(target) < col:
+            target.append('')
+        target[col - 1] = str(value)
+
+
+class FakeYooKassaClient:
+    """Заглушка YooKassaClient: платеж считается оплаченным сразу после создания"""
+
+    def __init__(self, fault):
+        self.fault = fault
+        self.payments = {}
+        self.by_idempotence_key = {}
+        self.calls = 0
+
+    async def _io(self):
+        self.calls += 1
+        await asyncio.sleep(self.fault.delay())
+        if self.fault.should_fail():
+            raise YooKassaError(500, 'internal_server_error', 'Injected YooKassa failure')
+
+    async def create_payment(self, payload, idempotence_key):
+        await self._io()
+        if idempotence_key in self.by_idempotence_key:
+            return self.by_idempotence_key[idempotence_key]
+        payment_id = f"yk-{uuid.uuid4()}"
+        payment = {
+            'id': payment_id,
+            'status': 'pending',
+            'amount': payload['amount'],
+            'metadata': payload.get('metadata', {}),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()),
+            'confirmation': {'type': 'redirect', 'confirmation_url': f"https://yoomoney.example/checkout/{payment_id}"},
+        }
+        self.payments[payment_id] = payment
+        self.by_idempotence_key[idempotence_key] = payment
+        return payment
+
+    async def get_payment(self, yookassa_payment_id):
+        await self._io()
+        payment = self.payments[yookassa_payment_id]
+        payment['status'] = 'succeeded'
+        return payment
+
+    async def list_payments(self, params):
+        await self._io()
+        return {'items': list(self.payments.values()), 'next_cursor': None}
+
+    async def close(self):
+        pass
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API, отвечающий локально на все методы, которые использует бот"""
+
+    def __init__(self, fault):
+        self.fault = fault
+        self.calls = 0
+        self._message_ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        await asyncio.sleep(self.fault.delay())
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint in ('sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument'):
+            chat_id = params.get('chat_id') or 0
+            result = {
+                'message_id': params.get('message_id') or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class SyntheticUser:
+    """Генерирует апдейты Telegram от имени одного пользователя"""
+
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+        self.chat = {'id': user_id, 'type': 'private'}
+        self._message_ids = itertools.count(1)
+
+    def _message(self, text):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self.chat,
+            'from': self.user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def text(self, text):
+        return {'update_id': next(self._update_ids), 'message': self._message(text)}
+
+    def callback(self, data):
+        bot_message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': self.chat,
+            'from': BOT_USER,
+            'text': '...',
+        }
+        return {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(uuid.uuid4()),
+                'from': self.user,
+                'chat_instance': str(self.user_id),
+                'message': bot_message,
+                'data': data,
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.latencies = {step: [] for step in FUNNEL_STEPS}
+        self.completed_users = 0
+        self.updates = 0
+        self.telegram = FakeTelegramRequest(Fault(args.telegram_latency, args.telegram_latency / 2))
+        self.worksheet = FakeWorksheet(Fault(args.sheets_latency, args.sheets_latency / 2, args.sheets_error_rate))
+        self.yookassa = FakeYooKassaClient(Fault(args.yookassa_latency, args.yookassa_latency / 2, args.yookassa_error_rate))
+        self.application = None
+
+    async def setup(self):
+        matrix_bot = bot.matrix_bot
+        self.application = bot.build_application(request=self.telegram)
+        await self.application.initialize()
+        await self.application.start()
+        # То же, что MatrixBot.on_startup, но без HTTP-сервера и с заглушками
+        matrix_bot.application = self.application
+        matrix_bot.yookassa = self.yookassa
+        matrix_bot.sheet = self.worksheet
+        matrix_bot.sheets = SheetsGateway(self.worksheet)
+        matrix_bot.ticket_renderer.start()
+        if bot.STORAGE_BACKEND == 'sheets':
+            storage = SheetsStorage(matrix_bot.sheets)
+            await storage.start()
+            await matrix_bot.attach_storage(storage)
+        else:
+            await matrix_bot.open_storage()
+            matrix_bot.exporter = SheetsExporter(matrix_bot.storage, matrix_bot.sheets)
+            await matrix_bot.exporter.start()
+        matrix_bot.readiness = bot.READINESS_READY
+
+    async def flush(self):
+        """Дописывает в таблицу все, что еще не выгружено"""
+        matrix_bot = bot.matrix_bot
+        if matrix_bot.exporter:
+            await matrix_bot.exporter.flush()
+        else:
+            await matrix_bot.storage.writer.flush()
+
+    async def teardown(self):
+        matrix_bot = bot.matrix_bot
+        if matrix_bot.exporter:
+            await matrix_bot.exporter.stop()
+        await matrix_bot.storage.stop()
+        matrix_bot.tickets.close()
+        matrix_bot.sheets.shutdown()
+        await self.application.stop()
+        await self.application.shutdown()
+
+    async def send(self, step, payload):
+        update = Update.de_json(payload, self.application.bot)
+        started = time.perf_counter()
+        # Тот же путь, что у апдейтов из polling/webhook: через update processor
+        await self.application.update_processor.process_update(update, self.application.process_update(update))
+        self.latencies[step].append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def run_user(self, user_id):
+        user = SyntheticUser(user_id)
+        think = self.args.think_time
+        await self.send('start', user.text('/start'))
+        await asyncio.sleep(random.uniform(0, think))
+        await self.send('register', user.callback('register'))
+        await self.send('ticket_count', user.text(str(random.randint(1, 3))))
+        await self.send('name', user.text(f"Участник {user_id}"))
+        await self.send('phone', user.text(f"+7900{user_id % 10_000_000:07d}"))
+        payment_id = self.application.user_data.get(user_id, {}).get('payment_id')
+        if not payment_id:
+            return
+        await asyncio.sleep(random.uniform(0, think))
+        await self.send('pay', user.callback(f"pay_{payment_id}"))
+        await asyncio.sleep(random.uniform(0, think))
+        await self.send('check_payment', user.callback(f"check_payment_{payment_id}"))
+        self.completed_users += 1
+
+    async def run(self):
+        await self.setup()
+        first_user_id = 10_000_000
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(self.run_user(first_user_id + i) for i in range(self.args.users)))
+            elapsed = time.perf_counter() - started
+            flush_started = time.perf_counter()
+            await self.flush()
+            flush_elapsed = time.perf_counter() - flush_started
+        finally:
+            await self.teardown()
+        self.report(elapsed, flush_elapsed)
+
+    def report(self, elapsed, flush_elapsed):
+        def percentile(values, q):
+            if not values:
+                return 0.0
+            if len(values) == 1:
+                return values[0]
+            return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+        print(f"\nПользователей: {self.args.users}, дошли до оплаты: {self.completed_users}")
+        print(f"Апдейтов: {self.updates} за {elapsed:.2f} сек. -> {self.updates / elapsed:.1f} апдейтов/сек.")
+        print(f"\n{'шаг':<15}{'n':>7}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}{'max, мс':>11}")
+        for step in FUNNEL_STEPS:
+            values = self.latencies[step]
+            if not values:
+                continue
+            print(f"{step:<15}{len(values):>7}"
+                  f"{percentile(values, 50) * 1000:>11.1f}{percentile(values, 95) * 1000:>11.1f}"
+                  f"{percentile(values, 99) * 1000:>11.1f}{max(values) * 1000:>11.1f}")
+        print(f"\nВызовов: Bot API {self.telegram.calls}, Google Sheets {self.worksheet.calls}, ЮKassa {self.yookassa.calls}")
+        print(f"Строк в таблице: {len(self.worksheet.rows) - 1}, финальная запись очереди: {flush_elapsed * 1000:.1f} мс")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест воронки регистрации MatrixBot без сети")
+    parser.add_argument('--users', type=int, default=200, help="число одновременных пользователей")
+    parser.add_argument('--think-time', type=float, default=0.0, help="максимальная пауза пользователя между шагами, сек.")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="задержка Bot API, сек.")
+    parser.add_argument('--sheets-latency', type=float, default=0.2, help="задержка Google Sheets, сек.")
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0, help="доля ошибок Google Sheets")
+    parser.add_argument('--yookassa-latency', type=float, default=0.15, help="задержка ЮKassa, сек.")
+    parser.add_argument('--yookassa-error-rate', type=float, default=0.0, help="доля ошибок ЮKassa")
+    parser.add_argument('--seed', type=int, default=None, help="seed генератора случайных чисел")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(LoadTest(args).run())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+from datetime import datetime, timezone
+from config import (
+    LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES,
+)
+
+# Передается в extra= для записей, которые пишутся на каждое сообщение
+# пользователя и подлежат семплированию
+SAMPLED = {'sampled': True}
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Стандартные атрибуты LogRecord - все остальное пришло через extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def mask_phone(phone):
+    """+79001234567 -> +7900*****67: в логах не должно быть полных номеров"""
+    digits = re.sub(r'\D', '', phone or '')
+    if len(digits) < 6:
+        return '***'
+    return f"+{digits[:4]}{'*' * (len(digits) - 6)}{digits[-2:]}"
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != 'sampled':
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей, помеченных SAMPLED, в зависимости от уровня"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if not getattr(record, 'sampled', False):
+            return True
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler с ограниченной очередью: если поток записи не успевает,
+    записи отбрасываются, а не блокируют обработчики бота.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # В отличие от базовой реализации не склеиваем traceback с текстом:
+        # JSON-формат хранит его отдельным полем
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(value):
+    """'DEBUG=0.01,INFO=0.1' -> {logging.DEBUG: 0.01, logging.INFO: 0.1}"""
+    rates = {}
+    for part in (value or '').split(','):
+        if '=' not in part:
+            continue
+        level, rate = part.split('=', 1)
+        level_number = logging.getLevelName(level.strip().upper())
+        if isinstance(level_number, int):
+            rates[level_number] = float(rate)
+    return rates
+
+
+def setup_logging():
+    """
+    Логи пишутся в ограниченную очередь, а консоль и файл обслуживает
+    отдельный поток QueueListener, так что дисковый I/O не задерживает
+    обработчики. Файл ротируется по размеру и пишется в формате JSON.
+    """
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(TEXT_FORMAT))
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    listener = logging.handlers.QueueListener(queue_handler.queue, console, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx (HTTP-клиент python-telegram-bot) пишет INFO на каждый запрос к Bot API
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return listener
@@ -1,46 +1,19 @@
-import asyncio
-import os
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from bot import start_handler, button_handler, message_handler, cancel_handler
-from config import TELEGRAM_TOKEN
-
-# Для Render
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is running")
-
-def start_health_server():
-    """Запуск легкого HTTP-сервера для Render"""
-    port = int(os.environ.get('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
-    thread = threading.Thread(target=server.serve_forever)
-    thread.daemon = True
-    thread.start()
-    print(f"Health server running on port {port}")
-
 def main():
     """Основная функция запуска"""
-    # Запускаем "здоровый" сервер для Render
-    start_health_server()
-    
-    # Создаем приложение бота
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    
-    # Добавляем обработчики
-    application.add_handler(CommandHandler("start", start_handler))
-    application.add_handler(CommandHandler("cancel", cancel_handler))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    # Импорт здесь, а не в начале модуля: процессы отрисовки билетов (spawn)
+    # импортируют main.py повторно, и бот с логированием им не нужен
+    from bot import build_application, run_application
+
+    # Создаем приложение бота с обработчиками и фоновыми задачами.
+    # HTTP-сервер для Render (health check, уведомления ЮKassa и, в режиме
+    # webhook, апдейты Telegram) поднимается в post_init и работает в том же
+    # event loop, что и бот.
+    application = build_application()
     
     print("Бот запущен...")
     
-    # Запускаем polling
-    application.run_polling()
+    # Запускаем polling или webhook (TELEGRAM_MODE)
+    run_application(application)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
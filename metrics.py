@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек, в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        # Метрики обновляются и из потоков пула Google Sheets
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_sample(self, key, state):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, state['counts']):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Апдейты и обработчики
+UPDATES_TOTAL = Counter('bot_updates_total', 'Обработанные апдейты по обработчикам', ['handler'])
+UPDATES_IN_FLIGHT = Gauge('bot_updates_in_flight', 'Апдейты, обрабатываемые в данный момент')
+HANDLER_LATENCY = Histogram('bot_handler_latency_seconds', 'Время обработки апдейта', ['handler', 'callback'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Необработанные исключения в обработчиках', ['handler'])
+
+# Внешние зависимости (Google Sheets, ЮKassa)
+DEPENDENCY_LATENCY = Histogram('bot_dependency_latency_seconds', 'Длительность вызовов внешних API', ['dependency', 'operation'])
+DEPENDENCY_ERRORS = Counter('bot_dependency_errors_total', 'Ошибки вызовов внешних API', ['dependency', 'operation'])
+
+# Ограничение запросов к Google Sheets (sheets_gateway.py)
+SHEETS_QUEUE_DEPTH = Gauge('bot_sheets_queue_depth', 'Вызовы Google Sheets, ожидающие квоты', ['priority'])
+SHEETS_THROTTLED = Counter('bot_sheets_throttled_total', 'Задержки вызовов Google Sheets: ожидание квоты, 429, 5xx', ['reason'])
+
+# Предохранители внешних сервисов (circuit_breaker.py)
+CIRCUIT_STATE = Gauge('bot_circuit_state', 'Состояние предохранителя: 0 - замкнут, 1 - пробный вызов, 2 - разомкнут', ['dependency'])
+CIRCUIT_REJECTED = Counter('bot_circuit_rejected_total', 'Вызовы, отклоненные разомкнутым предохранителем', ['dependency'])
+
+# Воронка регистрации: start -> register -> phone -> pay -> paid
+FUNNEL = Counter('bot_funnel_total', 'Переходы по шагам воронки регистрации', ['step'])
+
+
+CALLBACK_TYPES = ('register', 'confirm_payment', 'cancel_payment')
+CALLBACK_PREFIXES = ('check_payment_', 'pay_', 'register_')
+
+
+def callback_type(data):
+    """Тип callback-кнопки для меток метрик (без id платежа)"""
+    if not data:
+        return ''
+    if data in CALLBACK_TYPES:
+        return data
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip('_')
+    return 'other'
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from config import RECONCILE_INTERVAL, RECONCILE_MAX_AGE_HOURS, RECONCILE_MAX_BACKOFF, HOLD_TTL_MINUTES
+
+logger = logging.getLogger(__name__)
+
+# Запас окна выборки: время в таблице записано с точностью до минуты
+WINDOW_SLACK = timedelta(minutes=5)
+FINAL_STATUSES = ('succeeded', 'canceled')
+# Сколько после отмены заказа ждать поздней оплаты. Бронь отменяется вместе с
+# платежом в ЮKassa, поэтому оплата может успеть пройти только около момента
+# отмены; для таблицы время отмены неизвестно, берется время заказа, а бронь
+# живет HOLD_TTL_MINUTES
+CANCELED_LOOKBACK = timedelta(minutes=HOLD_TTL_MINUTES) + 2 * WINDOW_SLACK
+
+
+def parse_order_time(value):
+    """Время из столбца 'Когда куплено' (локальное время сервера) в UTC"""
+    try:
+        return datetime.strptime(value, "%d.%m.%Y %H:%M").astimezone(timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+class PaymentReconciler:
+    """
+    Периодическая сверка неоплаченных заказов с ЮKassa.
+    Вместо запроса на каждый платеж забирает список платежей за окно
+    created_at, покрывающее все ожидающие заказы, и подтверждает или
+    отменяет те, что уже завершились. Нужна для пользователей, которые
+    оплатили и закрыли Telegram, и для потерянных уведомлений.
+    Недавно (CANCELED_LOOKBACK) отмененные заказы тоже сверяются: оплата,
+    прошедшая одновременно с отменой брони, должна подтвердить заказ, даже
+    если уведомление потеряно. Такой заказ проверяется отдельным запросом
+    платежа и только до тех пор, пока платеж не завершится, поэтому
+    отмены не расширяют окно выборки списка платежей.
+    """
+
+    def __init__(self, matrix_bot, interval=RECONCILE_INTERVAL, max_age_hours=RECONCILE_MAX_AGE_HOURS):
+        self.matrix_bot = matrix_bot
+        self.interval = interval
+        self.max_age = timedelta(hours=max_age_hours)
+        self.last_run = {}
+        self.total_reconciled = 0
+        self._canceled_checked = set()  # отмененные заказы с уже завершенным платежом
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.run_once()
+                delay = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(delay * 2, RECONCILE_MAX_BACKOFF)
+                logger.error(f"Ошибка сверки платежей, следующая попытка через {delay} сек.: {e}", exc_info=True)
+
+    def _window_start(self, pending):
+        now = datetime.now(timezone.utc)
+        times = [parse_order_time(record['Когда куплено']) for record in pending.values()]
+        times = [value for value in times if value is not None]
+        oldest = min(times) if times else now - self.max_age
+        return max(oldest - WINDOW_SLACK, now - self.max_age)
+
+    async def _fetch_payments(self, created_from):
+        """Все платежи ЮKassa, созданные начиная с created_from (постранично)"""
+        params = {'created_at.gte': created_from.strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'limit': 100}
+        while True:
+            response = await self.matrix_bot.yookassa.list_payments(params)
+            for payment in response.get('items', []):
+                yield payment
+            if not response.get('next_cursor'):
+                break
+            params = {'cursor': response['next_cursor']}
+
+    async def _apply(self, event, payment):
+        """
+        Применяет завершенный платеж к заказу. Ошибка одного платежа (например,
+        пользователь заблокировал бота) не прерывает сверку остальных.
+        """
+        try:
+            await self.matrix_bot.handle_payment_notification(event, payment, verified=True)
+            return True
+        except Exception as e:
+            payment_id = (payment.get('metadata') or {}).get('payment_id')
+            logger.error(f"Ошибка сверки платежа для Payment ID {payment_id}: {e}", exc_info=True)
+            return False
+
+    async def run_once(self):
+        """Один проход сверки. Возвращает число подтвержденных/отмененных заказов."""
+        started = time.monotonic()
+        storage = self.matrix_bot.storage
+        pending = storage.pending_payments() if storage else {}
+        recent = storage.canceled_since(datetime.now(timezone.utc) - CANCELED_LOOKBACK) if storage else {}
+        self._canceled_checked &= recent.keys()
+        canceled = {payment_id: record for payment_id, record in recent.items() if payment_id not in self._canceled_checked}
+        reconciled = 0
+        failed = 0
+        fetched = 0
+
+        # Отмененные заказы с известным платежом ЮKassa - по одному запросу на заказ
+        listed = {}
+        for payment_id in canceled:
+            yookassa_payment_id = storage.yookassa_payment_id(payment_id)
+            if yookassa_payment_id is None:
+                listed[payment_id] = canceled[payment_id]
+                continue
+            try:
+                payment = await self.matrix_bot.yookassa.get_payment(yookassa_payment_id)
+            except Exception as e:
+                failed += 1
+                logger.error(f"Ошибка запроса платежа ЮKassa {yookassa_payment_id} отмененного заказа: {e}")
+                continue
+            fetched += 1
+            if payment.get('status') == 'succeeded':
+                if not await self._apply('payment.succeeded', payment):
+                    failed += 1
+                    continue
+                reconciled += 1
+            if payment.get('status') in FINAL_STATUSES:
+                self._canceled_checked.add(payment_id)
+
+        if pending or listed:
+            still_open = set()
+            async for payment in self._fetch_payments(self._window_start({**listed, **pending})):
+                fetched += 1
+                payment_id = (payment.get('metadata') or {}).get('payment_id')
+                if payment_id in listed and payment.get('status') not in FINAL_STATUSES:
+                    still_open.add(payment_id)
+                if payment_id in pending:
+                    if payment.get('status') not in FINAL_STATUSES:
+                        continue
+                elif payment_id not in listed or payment.get('status') != 'succeeded':
+                    # Из отмененных интересует только оплата, пришедшая после отмены
+                    continue
+                if not await self._apply(f"payment.{payment['status']}", payment):
+                    failed += 1
+                    # Неприменившийся отмененный заказ проверим в следующий раз
+                    still_open.add(payment_id)
+                    continue
+                reconciled += 1
+            # Отмененный заказ без незавершенного платежа в выборке больше не проверяем
+            self._canceled_checked |= listed.keys() - still_open
+
+        self.total_reconciled += reconciled
+        self.last_run = {
+            'pending': len(pending),
+            'canceled': len(canceled),
+            'fetched': fetched,
+            'reconciled': reconciled,
+            'failed': failed,
+            'duration': round(time.monotonic() - started, 3),
+            'finished_at': datetime.now(timezone.utc).isoformat(),
+        }
+        if reconciled or failed:
+            logger.info(f"Сверка платежей: ожидало {len(pending)}, получено из ЮKassa {fetched}, "
+                        f"обработано {reconciled}, с ошибкой {failed}.")
+        else:
+            logger.debug(f"Сверка платежей: ожидало {len(pending)}, изменений нет.")
+        return reconciled
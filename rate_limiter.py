@@ -0,0 +1,129 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket: не больше rate операций в секунду в среднем,
+    с разовым всплеском до capacity.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """Забирает tokens токенов, если они есть, не дожидаясь"""
+        if self._lock.locked():
+            return False
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """Ждет, пока в корзине наберется tokens токенов, и забирает их"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Опустошает корзину на seconds секунд (ответ сервера "слишком часто")"""
+        self._refill()
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class TelegramRateLimiter:
+    """
+    Ограничение отправки сообщений по лимитам Telegram: общий темп бота
+    (global_rate сообщений в секунду) и не чаще раза в per_chat_interval
+    секунд в один чат.
+    """
+
+    def __init__(self, global_rate, per_chat_interval):
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._last_sent = {}  # chat_id -> время последней отправки
+
+    async def acquire(self, chat_id):
+        while True:
+            now = time.monotonic()
+            wait = self._last_sent.get(chat_id, 0) + self.per_chat_interval - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._last_sent[chat_id] = time.monotonic()
+        await self.bucket.acquire()
+        if len(self._last_sent) > 10000:
+            self._prune()
+
+    def retry_after(self, seconds):
+        """Telegram ответил RetryAfter: останавливаем все отправки на seconds секунд"""
+        self.bucket.pause(seconds)
+
+    def _prune(self):
+        threshold = time.monotonic() - self.per_chat_interval
+        self._last_sent = {chat_id: sent for chat_id, sent in self._last_sent.items() if sent > threshold}
+
+
+class PriorityGovernor:
+    """
+    Token bucket с очередью по приоритетам: когда токенов не хватает,
+    следующим токен получает ожидающий с наименьшим значением priority,
+    а при равных - пришедший раньше.
+    """
+
+    def __init__(self, rate, capacity=None, on_queue_change=None):
+        self.bucket = TokenBucket(rate, capacity)
+        self.on_queue_change = on_queue_change
+        self._waiters = []   # heap [(priority, порядковый номер, future)]
+        self._sequence = itertools.count()
+        self._dispatcher = None
+
+    def __len__(self):
+        return len(self._waiters)
+
+    async def acquire(self, priority):
+        """Ждет токен в порядке приоритета. Возвращает True, если пришлось ждать."""
+        if not self._waiters and self.bucket.try_acquire():
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._queue_changed(priority, 1)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+        return True
+
+    async def _dispatch(self):
+        while self._waiters:
+            await self.bucket.acquire()
+            while self._waiters:
+                priority, _, future = heapq.heappop(self._waiters)
+                self._queue_changed(priority, -1)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    def pause(self, seconds):
+        """Сервер ответил "слишком часто": никто не получит токен seconds секунд"""
+        self.bucket.pause(seconds)
+
+    def _queue_changed(self, priority, delta):
+        if self.on_queue_change:
+            self.on_queue_change(priority, delta)
@@ -0,0 +1,168 @@
+import logging
+from collections import Counter
+from config import GS_HEADERS, GS_COL_PAYMENT_ID, PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, DEFAULT_EVENT_ID
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationIndex:
+    """
+    Локальный индекс регистраций из Google Sheets.
+    Строится один раз из таблицы и дальше обновляется на месте при каждой
+    записи бота, поэтому проверки регистрации не ходят в сеть.
+    """
+
+    def __init__(self):
+        self._records = {}       # payment_id -> запись {заголовок: значение}
+        self._rows = {}          # payment_id -> номер строки в таблице (1-based)
+        self._paid = Counter()   # user_id -> количество оплаченных заказов
+        self._paid_events = Counter()  # (user_id, мероприятие) -> количество оплаченных заказов
+        self._pending = set()    # payment_id заказов в статусе "Ожидание оплаты"
+        self.next_row = 2        # Первая свободная строка (первая - заголовки)
+
+    def __len__(self):
+        return len(self._records)
+
+    def load(self, all_values):
+        """Строит индекс по результату worksheet.get_all_values()"""
+        self._records.clear()
+        self._rows.clear()
+        self._paid.clear()
+        self._paid_events.clear()
+        self._pending.clear()
+        self.next_row = 2
+        if not all_values:
+            return
+
+        headers = all_values[0]
+        # Столбцы ищем по реальным заголовкам таблицы, а не по позициям
+        columns = {}
+        for position, name in enumerate(GS_HEADERS):
+            columns[name] = headers.index(name) if name in headers else position
+
+        for row_number, row in enumerate(all_values[1:], start=2):
+            record = {name: row[col] if col < len(row) else '' for name, col in columns.items()}
+            # Заказы, записанные до появления каталога, относятся к мероприятию по умолчанию
+            record['Мероприятие'] = record['Мероприятие'] or DEFAULT_EVENT_ID
+            payment_id = str(record['Payment ID'])
+            if payment_id:
+                self._put(payment_id, record, row_number)
+        self.next_row = len(all_values) + 1
+        logger.info(f"Индекс регистраций построен: {len(self._records)} заказов, {len(self._paid)} оплативших пользователей.")
+
+    def _put(self, payment_id, record, row_number):
+        previous = self._records.get(payment_id)
+        if previous and previous['Статус'] == PAYMENT_STATUS_PAID:
+            self._uncount_paid(previous)
+        self._records[payment_id] = record
+        if row_number is not None:
+            self._rows[payment_id] = row_number
+        if record['Статус'] == PAYMENT_STATUS_PAID:
+            self._count_paid(record)
+        if record['Статус'] == PAYMENT_STATUS_PENDING:
+            self._pending.add(payment_id)
+        else:
+            self._pending.discard(payment_id)
+
+    def _count_paid(self, record):
+        user_id = str(record['User ID'])
+        self._paid[user_id] += 1
+        self._paid_events[(user_id, record['Мероприятие'])] += 1
+
+    def _uncount_paid(self, record):
+        user_id = str(record['User ID'])
+        for counter, key in ((self._paid, user_id), (self._paid_events, (user_id, record['Мероприятие']))):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+    def is_paid(self, user_id, event_id=None):
+        """Есть ли у пользователя оплаченный заказ (на мероприятие event_id или любое)"""
+        if event_id is not None:
+            return self._paid_events.get((str(user_id), event_id), 0) > 0
+        return self._paid.get(str(user_id), 0) > 0
+
+    def paid_user_ids(self):
+        """user_id всех пользователей с оплаченным заказом"""
+        return list(self._paid)
+
+    def row_for(self, payment_id):
+        """Номер строки по Payment ID. Возвращает -1, если не найдено."""
+        return self._rows.get(str(payment_id), -1)
+
+    def get(self, payment_id):
+        """Запись по Payment ID или None"""
+        return self._records.get(str(payment_id))
+
+    def records(self):
+        """Все записи индекса"""
+        return list(self._records.values())
+
+    def pending_payments(self):
+        """Заказы, ожидающие оплаты: {payment_id: запись}"""
+        return {payment_id: self._records[payment_id] for payment_id in self._pending}
+
+    def add_row(self, row_values, row_number=None):
+        """
+        Регистрирует строку, добавленную ботом (значения в порядке GS_HEADERS).
+        row_number=None - строка еще не записана в таблицу, номер будет
+        назначен позже через set_row().
+        """
+        record = dict(zip(GS_HEADERS, (str(value) for value in row_values)))
+        record['Мероприятие'] = record.get('Мероприятие') or DEFAULT_EVENT_ID
+        payment_id = record.get('Payment ID', '')
+        self._put(payment_id, record, None)
+        if row_number is not None:
+            self.set_row(payment_id, row_number)
+
+    def set_row(self, payment_id, row_number):
+        """Запоминает номер строки заказа после записи в таблицу"""
+        self._rows[str(payment_id)] = row_number
+        self.next_row = max(self.next_row, row_number + 1)
+
+    def row_payment_ids(self):
+        """Payment ID заказов, для которых известен номер строки"""
+        return list(self._rows)
+
+    def forget_row(self, payment_id):
+        """Забывает номер строки заказа, удаленной из таблицы"""
+        self._rows.pop(str(payment_id), None)
+
+    def set_status(self, payment_id, status):
+        """Обновляет статус заказа. Возвращает False, если заказ неизвестен."""
+        record = self._records.get(str(payment_id))
+        if record is None:
+            return False
+        was_paid = record['Статус'] == PAYMENT_STATUS_PAID
+        record['Статус'] = status
+        if was_paid and status != PAYMENT_STATUS_PAID:
+            self._uncount_paid(record)
+        elif not was_paid and status == PAYMENT_STATUS_PAID:
+            self._count_paid(record)
+        if status == PAYMENT_STATUS_PENDING:
+            self._pending.add(str(payment_id))
+        else:
+            self._pending.discard(str(payment_id))
+        return True
+
+
+def row_from_append_response(response):
+    """Извлекает номер строки из ответа append_row ('Sheet1!A5:I5' -> 5)"""
+    try:
+        updated_range = response['updates']['updatedRange']
+        first_cell = updated_range.split('!')[-1].split(':')[0]
+        return int(''.join(ch for ch in first_cell if ch.isdigit()))
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+
+async def appended_rows(gateway, payment_ids):
+    """
+    Номера строк заказов payment_ids, которые уже есть в таблице: {payment_id: строка}.
+    Нужна перед повтором неудавшегося append_rows: таймаут или отмена не
+    значат, что Google не добавил строки, а повторное добавление их бы удвоило.
+    Читает один столбец Payment ID.
+    """
+    wanted = set(payment_ids)
+    column = await gateway.col_values(GS_COL_PAYMENT_ID)
+    return {value: number for number, value in enumerate(column, start=1) if value in wanted}
@@ -0,0 +1,178 @@
+import asyncio
+import codecs
+import csv
+import io
+import logging
+import re
+import tempfile
+from collections import Counter
+from config import GS_HEADERS, PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_CANCELED
+from inventory import ticket_count
+from storage import row_from_record
+
+logger = logging.getLogger(__name__)
+
+# Шаги воронки (metrics.FUNNEL) и их подписи в /stats
+FUNNEL_STEPS = (
+    ('start', '/start'),
+    ('register', 'регистрация'),
+    ('phone', 'телефон'),
+    ('pay', 'оплата'),
+    ('paid', 'оплачено'),
+)
+# CSV до этого размера собирается в памяти, больше - во временном файле
+EXPORT_SPOOL_BYTES = 1024 * 1024
+
+
+def amount_value(record):
+    """Сумма заказа в рублях из столбца 'Сумма' ('2222 руб.' -> 2222)"""
+    match = re.match(r'\s*(\d+(?:[.,]\d+)?)', record.get('Сумма', ''))
+    if not match:
+        return 0
+    value = float(match.group(1).replace(',', '.'))
+    return int(value) if value.is_integer() else value
+
+
+class SalesStats:
+    """
+    Сводка продаж для /stats: число заказов, билетов и сумма по
+    (мероприятие, статус). Строится один раз по хранилищу, дальше
+    обновляется слушателем хранилища за O(1) на изменение, поэтому
+    ответ не зависит от числа заказов и не трогает Google Sheets.
+    """
+
+    def __init__(self):
+        self.orders = Counter()    # (мероприятие, статус) -> заказов
+        self.tickets = Counter()   # (мероприятие, статус) -> билетов
+        self.revenue = Counter()   # (мероприятие, статус) -> рублей
+        self._changes = None       # изменения хранилища во время обхода в load()
+
+    @classmethod
+    def from_records(cls, records):
+        stats = cls()
+        for record in records:
+            stats._add(record, 1)
+        return stats
+
+    async def load(self, storage):
+        """
+        Пересчитывает сводку по хранилищу: по готовым итогам SQLite или обходом
+        заказов в фоновом потоке. Обходится снимок, снятый до начала обхода
+        (iter_records таблицы), поэтому изменения за время обхода
+        применяются к новой сводке повторно.
+        """
+        totals = storage.sales_totals()
+        if totals is None:
+            self._changes = []
+            try:
+                fresh = await asyncio.to_thread(self.from_records, storage.iter_records())
+            finally:
+                changes, self._changes = self._changes, None
+            for record, previous_status in changes:
+                fresh.on_storage_change(record, previous_status)
+        else:
+            fresh = type(self)()
+            for event_id, status, orders, tickets, revenue in totals:
+                key = (event_id, status)
+                fresh.orders[key], fresh.tickets[key], fresh.revenue[key] = orders, tickets, revenue
+        self.orders, self.tickets, self.revenue = fresh.orders, fresh.tickets, fresh.revenue
+
+    def _add(self, record, sign):
+        key = (record['Мероприятие'], record['Статус'])
+        self.orders[key] += sign
+        self.tickets[key] += sign * ticket_count(record)
+        self.revenue[key] += sign * amount_value(record)
+
+    def on_storage_change(self, record, previous_status):
+        """Слушатель хранилища: новый заказ добавляется, смена статуса переносит его"""
+        if self._changes is not None:
+            self._changes.append((dict(record), previous_status))
+        if previous_status is not None:
+            self._add(dict(record, **{'Статус': previous_status}), -1)
+        self._add(record, 1)
+
+    def totals(self, event_id=None):
+        """Итоги по статусам (по одному мероприятию или всем): {статус: (заказов, билетов, рублей)}"""
+        totals = {}
+        for key, orders in self.orders.items():
+            event, status = key
+            if event_id is not None and event != event_id:
+                continue
+            count, tickets, revenue = totals.get(status, (0, 0, 0))
+            totals[status] = (count + orders, tickets + self.tickets[key], revenue + self.revenue[key])
+        return totals
+
+    def events(self):
+        return sorted({event for event, _ in self.orders})
+
+
+def format_stats(stats, catalog, funnel):
+    """Текст /stats. funnel - {шаг: число переходов} с запуска бота."""
+    totals = stats.totals()
+    paid = totals.get(PAYMENT_STATUS_PAID, (0, 0, 0))
+    pending = totals.get(PAYMENT_STATUS_PENDING, (0, 0, 0))
+    canceled = totals.get(PAYMENT_STATUS_CANCELED, (0, 0, 0))
+    lines = [
+        "📊 <b>Продажи</b>\n",
+        f"✅ Оплачено заказов: <b>{paid[0]}</b>",
+        f"⏳ Ожидают оплаты: <b>{pending[0]}</b> (билетов: {pending[1]})",
+        f"❌ Отменено: <b>{canceled[0]}</b>",
+        f"🎟️ Продано билетов: <b>{paid[1]}</b>",
+        f"💰 Выручка: <b>{paid[2]} руб.</b>",
+    ]
+
+    events = stats.events()
+    if len(events) > 1:
+        lines.append("\n<b>По мероприятиям:</b>")
+        for event_id in events:
+            event_paid = stats.totals(event_id).get(PAYMENT_STATUS_PAID, (0, 0, 0))
+            event = catalog.get(event_id)
+            title = f"{event.title}, {event.date}" if event else event_id
+            capacity = f" из {event.capacity}" if event and event.capacity else ''
+            lines.append(f"• {title}: {event_paid[1]}{capacity} билетов, {event_paid[2]} руб.")
+
+    lines.append("\n<b>Воронка</b> (с запуска бота):")
+    previous = None
+    for step, label in FUNNEL_STEPS:
+        count = int(funnel.get(step, 0))
+        conversion = f" ({count * 100 // previous}%)" if previous else ''
+        lines.append(f"{label}: {count}{conversion}")
+        previous = count
+    return '\n'.join(lines)
+
+
+def csv_lines(records):
+    """CSV заказов построчно: в памяти одновременно только одна строка"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in _rows_with_headers(records):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _rows_with_headers(records):
+    yield GS_HEADERS
+    for record in records:
+        yield row_from_record(record)
+
+
+def export_csv(records, event_id=None):
+    """
+    Пишет CSV заказов (все или одного мероприятия) во временный файл,
+    который держится в памяти, пока он меньше EXPORT_SPOOL_BYTES.
+    Выполняется в фоновом потоке. Возвращает (файл с позицией в начале, число заказов).
+    """
+    if event_id is not None:
+        records = (record for record in records if record['Мероприятие'] == event_id)
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    # BOM - чтобы Excel открыл кириллицу без выбора кодировки
+    output.write(codecs.BOM_UTF8)
+    lines = 0
+    for line in csv_lines(records):
+        output.write(line.encode('utf-8'))
+        lines += 1
+    output.seek(0)
+    # Первая строка - заголовки
+    return output, lines - 1
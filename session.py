@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from broadcast import retry_after_seconds
+from config import (
+    SESSION_TTL_MINUTES, SESSION_SWEEP_INTERVAL, SESSION_EXPIRED_NOTIFY, BROADCAST_RATE, PAYMENT_STATUS_PENDING,
+)
+
+logger = logging.getLogger(__name__)
+
+ORDER_EXPIRED_TEXT = "⌛ Время на оплату заказа истекло, заказ отменен.\n\nВведите /start для новой регистрации"
+# Сколько сессий в общем хранилище ведущий обрабатывает за один обход
+SHARED_EXPIRY_BATCH = 500
+
+
+class RegistrationSession:
+    """
+    context.user_data пользователя: шаг воронки регистрации и данные заказа.
+    Поля фиксированы (__slots__), поэтому сессия занимает в несколько раз
+    меньше памяти, чем словарь. Интерфейс словаря (get, [], clear, ...)
+    сохранен для обработчиков и хранилищ сессий; неизвестный ключ -
+    KeyError, незаполненное поле (None) считается отсутствующим.
+    touched_at - время последнего апдейта, по нему SessionReaper удаляет
+    брошенные сессии.
+    """
+
+    FIELDS = ('state', 'event_id', 'ticket_count', 'name', 'phone', 'payment_id', 'total_amount', 'yookassa_payment_id')
+    __slots__ = FIELDS + ('touched_at', 'loaded')
+
+    state: Optional[str]
+    event_id: Optional[str]
+    ticket_count: Optional[int]
+    name: Optional[str]
+    phone: Optional[str]
+    payment_id: Optional[str]
+    total_amount: Optional[float]
+    yookassa_payment_id: Optional[str]
+    touched_at: float
+    # Сессия уже подгружена из хранилища (SQLitePersistence)
+    loaded: bool
+
+    def __init__(self):
+        self.touched_at = time.time()
+        self.loaded = False
+        self.clear()
+
+    def touch(self):
+        self.touched_at = time.time()
+
+    # --- Интерфейс словаря ---
+
+    def _check(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+
+    def __getitem__(self, key):
+        self._check(key)
+        value = getattr(self, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._check(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        setattr(self, key, None)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and getattr(self, key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return any(getattr(self, field) is not None for field in self.FIELDS)
+
+    def __repr__(self):
+        return f"RegistrationSession({dict(self.items())})"
+
+    def keys(self):
+        return [field for field in self.FIELDS if getattr(self, field) is not None]
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.keys()]
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.FIELDS else None
+        return default if value is None else value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self.get(key)
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        if key in self:
+            del self[key]
+        return value
+
+    def update(self, data):
+        for key, value in data.items():
+            self[key] = value
+
+    def clear(self):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    # --- Сохранение ---
+
+    def to_dict(self):
+        """Данные для хранилища сессий (JSON)"""
+        data = dict(self.items())
+        data['touched_at'] = self.touched_at
+        return data
+
+    def restore(self, data):
+        """Заполняет сессию из хранилища; ключи, которых больше нет в FIELDS, пропускаются"""
+        self.clear()
+        for key, value in (data or {}).items():
+            if key in self.FIELDS:
+                setattr(self, key, value)
+        self.touched_at = (data or {}).get('touched_at', self.touched_at)
+
+
+class SessionReaper:
+    """
+    Удаляет сессии пользователей, бросивших регистрацию: без апдейтов
+    дольше SESSION_TTL_MINUTES. Иначе каждый, кто нажал /start и ушел,
+    навсегда остается в памяти Application. Неоплаченный заказ такой
+    сессии отменяется (платеж ЮKassa, статус, бронь - как у HoldReaper),
+    при SESSION_EXPIRED_NOTIFY пользователь получает сообщение.
+    В режиме реплик каждый экземпляр удаляет только свои копии сессий
+    (они все равно перечитываются перед каждым апдейтом), а брошенные
+    сессии в общем хранилище под блокировкой пользователя удаляет ведущий.
+    """
+
+    def __init__(self, matrix_bot, ttl_minutes=SESSION_TTL_MINUTES, interval=SESSION_SWEEP_INTERVAL,
+                 notify=SESSION_EXPIRED_NOTIFY):
+        self.matrix_bot = matrix_bot
+        self.ttl = ttl_minutes * 60
+        self.interval = interval
+        self.notify = notify
+        self.total_evicted = 0
+        self.total_abandoned = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка очистки брошенных сессий: {e}", exc_info=True)
+
+    async def run_once(self):
+        """Один обход: удаляет просроченные сессии. Возвращает их число."""
+        application = self.matrix_bot.application
+        cutoff = time.time() - self.ttl
+        processor = application.update_processor
+        expired = [
+            (user_id, session) for user_id, session in list(application.user_data.items())
+            if session.touched_at < cutoff and not processor.busy(user_id)
+        ]
+        for user_id, _ in expired:
+            application.drop_user_data(user_id)
+            if application.persistence:
+                await application.persistence.drop_user_data(user_id)
+        self.total_evicted += len(expired)
+
+        shared_store = self.matrix_bot.shared_store
+        if shared_store is None:
+            await self._abandon([(user_id, session.to_dict()) for user_id, session in expired if session])
+        elif self.matrix_bot.leader and self.matrix_bot.leader.is_leader:
+            await self._expire_shared(shared_store, cutoff)
+        if expired:
+            logger.info(f"Удалено брошенных сессий: {len(expired)}, в памяти осталось: {len(application.user_data)}.")
+        return len(expired)
+
+    async def _expire_shared(self, store, cutoff):
+        abandoned = []
+        for user_id in await store.idle_sessions(cutoff, SHARED_EXPIRY_BATCH):
+            # Под блокировкой пользователя: апдейт на другом экземпляре не пересечется с удалением
+            async with store.lock(f'user:{user_id}'):
+                data = await store.delete_idle_session(user_id, cutoff)
+            if data:
+                abandoned.append((user_id, data))
+        await self._abandon(abandoned)
+
+    async def _abandon(self, sessions):
+        """Отменяет неоплаченные заказы брошенных сессий и (notify) сообщает об этом пользователям"""
+        storage = self.matrix_bot.storage
+        if not sessions or storage is None:
+            return
+        orders = {}
+        owners = {}
+        for user_id, data in sessions:
+            payment_id = data.get('payment_id')
+            record = storage.get(payment_id) if payment_id else None
+            if record is not None and record['Статус'] == PAYMENT_STATUS_PENDING:
+                orders[payment_id] = data.get('yookassa_payment_id')
+                owners[payment_id] = user_id
+        if not orders:
+            return
+        canceled = await self.matrix_bot.hold_reaper.cancel_orders(orders)
+        self.total_abandoned += len(canceled)
+        logger.info(f"Отменено заказов брошенных сессий: {len(canceled)}.")
+        if self.notify:
+            await self._send_expired([owners[payment_id] for payment_id in canceled])
+
+    async def _send_expired(self, user_ids):
+        bot = self.matrix_bot.application.bot
+        for user_id in user_ids:
+            for attempt in range(2):
+                try:
+                    await bot.send_message(chat_id=int(user_id), text=ORDER_EXPIRED_TEXT)
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(retry_after_seconds(e))
+                except (Forbidden, BadRequest):
+                    # Пользователь заблокировал бота
+                    break
+                except Exception as e:
+                    logger.warning(f"Не удалось сообщить пользователю {user_id} об отмене заказа: {e}")
+                    break
+            # Тот же темп, что у рассылок: не мешаем ответам остальным пользователям
+            await asyncio.sleep(1 / BROADCAST_RATE)
+
+    def stats(self):
+        application = self.matrix_bot.application
+        return {
+            'in_memory': len(application.user_data) if application else 0,
+            'evicted': self.total_evicted,
+            'abandoned_orders': self.total_abandoned,
+        }
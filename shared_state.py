@@ -0,0 +1,367 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+from config import (
+    SHARED_STORE_BACKEND, SHARED_STORE_PATH, REPLICA_ID, USER_LOCK_TTL, LEADER_LEASE_TTL,
+    PERSISTENCE_UPDATE_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор экземпляра бота в общих блокировках
+REPLICA = REPLICA_ID or f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedStore(ABC):
+    """
+    Общее состояние нескольких экземпляров бота: сессии пользователей
+    (context.user_data) и аренды (lease) с ограниченным сроком - на них
+    построены блокировки пользователей и выбор ведущего экземпляра.
+    Аренда, которую владелец перестал продлевать (процесс упал),
+    освобождается сама по истечении срока.
+    """
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def load_session(self, user_id):
+        """Сессия пользователя или None"""
+
+    @abstractmethod
+    async def save_session(self, user_id, data):
+        """Сохраняет сессию пользователя; пустая data удаляет ее"""
+
+    @abstractmethod
+    async def idle_sessions(self, cutoff, limit):
+        """user_id сессий, не сохранявшихся с момента cutoff (time.time())"""
+
+    @abstractmethod
+    async def delete_idle_session(self, user_id, cutoff):
+        """Удаляет сессию, если она не сохранялась с момента cutoff. Возвращает ее данные или None."""
+
+    @abstractmethod
+    async def try_acquire(self, name, owner, ttl):
+        """Берет или продлевает аренду name на ttl секунд. Возвращает True, если она у owner."""
+
+    @abstractmethod
+    async def release(self, name, owner):
+        """Освобождает аренду, если она у owner"""
+
+    def lock(self, name, ttl=USER_LOCK_TTL):
+        """Блокировка между экземплярами: async with store.lock('user:42')"""
+        return SharedLock(self, name, ttl)
+
+
+class SharedLock:
+    """
+    Эксклюзивная блокировка на аренде общего хранилища.
+    Пока блокировка удерживается, аренда продлевается в фоне, поэтому
+    долгий обработчик (запрос к ЮKassa с повторами) ее не потеряет.
+    """
+
+    def __init__(self, store, name, ttl):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        # Уникален для каждой блокировки: два обработчика одного процесса тоже исключают друг друга
+        self.owner = f"{REPLICA}:{uuid.uuid4().hex}"
+        self._renew_task = None
+
+    async def acquire(self):
+        delay = 0.01
+        while not await self.store.try_acquire(self.name, self.owner, self.ttl):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        self._renew_task = asyncio.create_task(self._renew())
+
+    async def release(self):
+        if self._renew_task is None:
+            return
+        self._renew_task.cancel()
+        self._renew_task = None
+        await self.store.release(self.name, self.owner)
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self.store.try_acquire(self.name, self.owner, self.ttl):
+                    logger.error(f"Блокировка {self.name} потеряна: аренда истекла и занята другим владельцем.")
+                    return
+            except Exception as e:
+                logger.warning(f"Не удалось продлить блокировку {self.name}: {e}")
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
+
+
+class SQLiteSharedStore(SharedStore):
+    """
+    Общее хранилище в файле SQLite: подходит для нескольких процессов на
+    одной машине (или общем томе) и для проверки режима реплик локально.
+    Атомарность аренды обеспечивает сама SQLite: захват - один UPSERT
+    с условием "свободна, истекла или уже наша".
+    """
+
+    def __init__(self, path=SHARED_STORE_PATH):
+        self.path = path
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-store')
+
+    async def start(self):
+        await self._run(self._open)
+        logger.info(f"Общее хранилище SQLite открыто: {self.path}, экземпляр {REPLICA}")
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._db.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+
+    async def stop(self):
+        if self._db:
+            await self._run(self._db.close)
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def load_session(self, user_id):
+        return await self._run(self._load_session, user_id)
+
+    def _load_session(self, user_id):
+        row = self._db.execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def save_session(self, user_id, data):
+        await self._run(self._save_session, user_id, json.dumps(data, ensure_ascii=False) if data else None)
+
+    def _save_session(self, user_id, data):
+        with self._db:
+            if data is None:
+                self._db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+            else:
+                self._db.execute(
+                    'INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+                    (user_id, data, time.time())
+                )
+
+    async def idle_sessions(self, cutoff, limit):
+        return await self._run(self._idle_sessions, cutoff, limit)
+
+    def _idle_sessions(self, cutoff, limit):
+        rows = self._db.execute(
+            'SELECT user_id FROM sessions WHERE updated_at < ? ORDER BY updated_at LIMIT ?', (cutoff, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    async def delete_idle_session(self, user_id, cutoff):
+        return await self._run(self._delete_idle_session, user_id, cutoff)
+
+    def _delete_idle_session(self, user_id, cutoff):
+        with self._db:
+            row = self._db.execute(
+                'SELECT data FROM sessions WHERE user_id = ? AND updated_at < ?', (user_id, cutoff)
+            ).fetchone()
+            if row is None:
+                # Сессию успели сохранить заново
+                return None
+            self._db.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+        return json.loads(row[0])
+
+    async def try_acquire(self, name, owner, ttl):
+        return await self._run(self._try_acquire, name, owner, ttl)
+
+    def _try_acquire(self, name, owner, ttl):
+        now = time.time()
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+                (name, owner, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+
+    async def release(self, name, owner):
+        await self._run(self._release, name, owner)
+
+    def _release(self, name, owner):
+        with self._db:
+            self._db.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+
+def open_shared_store(backend=SHARED_STORE_BACKEND):
+    """Общее хранилище по SHARED_STORE_BACKEND"""
+    if backend == 'sqlite':
+        return SQLiteSharedStore()
+    raise ValueError(f"Неизвестный SHARED_STORE_BACKEND: {backend}")
+
+
+class LeaderElection:
+    """
+    Выбор ведущего экземпляра: ведущий тот, у кого аренда name.
+    Аренда продлевается каждые ttl/3 секунд; при получении вызывается
+    on_elected(), при потере - on_demoted(resigned=False), при остановке
+    экземпляра - on_demoted(resigned=True), пока аренда еще у него.
+    Фоновые задачи, которые должны выполняться ровно в одном экземпляре
+    (сверка платежей, выгрузка в Google Sheets), запускаются и
+    останавливаются в них.
+    """
+
+    def __init__(self, store, on_elected, on_demoted, name='leader', ttl=LEADER_LEASE_TTL, owner=REPLICA):
+        self.store = store
+        self.owner = owner
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Снимает полномочия и отдает аренду, чтобы другой экземпляр не ждал ее истечения"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._set_leader(False, resigned=True)
+            try:
+                await self.store.release(self.name, self.owner)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить аренду ведущего: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await self.store.try_acquire(self.name, self.owner, self.ttl)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Без продления аренда истечет, и ведущим станет другой экземпляр
+                logger.error(f"Ошибка продления аренды ведущего: {e}")
+                acquired = False
+            if acquired != self.is_leader:
+                await self._set_leader(acquired)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def _set_leader(self, is_leader, resigned=False):
+        self.is_leader = is_leader
+        logger.info(f"Экземпляр {self.owner} {'стал ведущим' if is_leader else 'больше не ведущий'}.")
+        try:
+            await (self.on_elected() if is_leader else self.on_demoted(resigned=resigned))
+        except Exception as e:
+            logger.error(f"Ошибка смены роли ведущего: {e}", exc_info=True)
+
+
+class SharedPersistence(BasePersistence):
+    """
+    context.user_data в общем хранилище для режима нескольких реплик.
+    Сессия читается заново перед каждым апдейтом и записывается сразу
+    после него (save_session), пока PerUserUpdateProcessor держит
+    блокировку пользователя, поэтому следующий апдейт того же
+    пользователя на любом экземпляре видит актуальные данные.
+    Периодическая запись Application отключена: она могла бы затереть
+    более свежую сессию, записанную другим экземпляром.
+    """
+
+    def __init__(self, store, update_interval=PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        self._sessions = {}  # user_id -> user_data в обработке
+
+    async def refresh_user_data(self, user_id, user_data):
+        stored = await self.store.load_session(user_id)
+        user_data.restore(stored)
+        self._sessions[user_id] = user_data
+
+    async def save_session(self, user_id):
+        """Записывает сессию пользователя после обработки апдейта"""
+        user_data = self._sessions.pop(user_id, None)
+        if user_data is not None:
+            await self.store.save_session(user_id, user_data.to_dict() if user_data else None)
+
+    async def peek_user_data(self, user_id):
+        return await self.store.load_session(user_id)
+
+    async def drop_user_data(self, user_id):
+        # Application удаляет данные с задержкой, когда у пользователя уже может
+        # быть новая сессия; сессии удаляются сразу через store.save_session
+        pass
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def flush(self):
+        # Сессии уже записаны после апдейтов; хранилище закрывает бот
+        pass
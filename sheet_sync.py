@@ -0,0 +1,219 @@
+import asyncio
+import hashlib
+import logging
+import time
+from gspread.utils import rowcol_to_a1
+from config import (
+    GS_HEADERS, GS_COL_PAYMENT_ID, PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_CANCELED,
+    SHEETS_SYNC_INTERVAL, SHEETS_SYNC_WINDOW, SHEETS_SYNC_MAX_DELETES,
+)
+from storage import record_from_row
+
+logger = logging.getLogger(__name__)
+
+# Столбцы, правки которых в таблице переносятся в хранилище
+SYNC_FIELDS = ('Статус', 'Имя', 'Номер телефона')
+KNOWN_STATUSES = {PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_CANCELED}
+
+
+def _column_letter(col):
+    return rowcol_to_a1(1, col)[:-1]
+
+
+def _runs(numbers):
+    """Отсортированные номера строк -> отрезки подряд идущих [(первая, последняя)]"""
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][1] == number - 1:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return [tuple(run) for run in runs]
+
+
+def row_hash(row):
+    return hashlib.blake2b('\x1f'.join(row).encode('utf-8'), digest_size=8).digest()
+
+
+class SheetSync:
+    """
+    Переносит в SQLite ручные правки организаторов в Google Sheets: статус
+    (оплата наличными, отмена), имя и телефон, удаленные строки и строки,
+    добавленные вручную.
+    Таблица целиком не перечитывается. За один цикл - один batch_get:
+    столбец Payment ID (порядок строк, новые и удаленные заказы) и окно
+    из SHEETS_SYNC_WINDOW строк, которое сдвигается по таблице от цикла к
+    циклу. Для каждой прочитанной строки хранится хеш содержимого, и с
+    хранилищем сравниваются только изменившиеся строки. Строки незнакомых
+    заказов (добавленные вручную) дочитываются вторым вызовом, только
+    если они появились.
+    Правка применяется, только если у заказа нет невыгруженных изменений
+    бота: иначе таблицу вскоре перезапишет экспортер. Цикл выполняется под
+    блокировкой экспортера, чтобы номера строк не сдвигались во время чтения.
+    """
+
+    def __init__(self, storage, exporter, on_bulk_change=None, interval=SHEETS_SYNC_INTERVAL,
+                 window=SHEETS_SYNC_WINDOW, max_deletes=SHEETS_SYNC_MAX_DELETES):
+        self.storage = storage
+        self.gateway = exporter.gateway
+        self.index = exporter.index
+        self.lock = exporter.lock
+        # Корутина, вызывается после импорта и удаления заказов: слушатели хранилища их не видят
+        self.on_bulk_change = on_bulk_change
+        self.interval = interval
+        self.window = window
+        self.max_deletes = max_deletes
+        self._hashes = {}      # payment_id -> хеш строки при последнем чтении
+        self._cursor = 2       # Первая строка следующего окна
+        # Последняя строка таблицы при прошлом цикле
+        self._known_rows = self.index.next_row - 1
+        # Заказы, которых не было в таблице на прошлом цикле
+        self._missing = set()
+        self._task = None
+        self.last_run = None
+        self.applied = {'edited': 0, 'imported': 0, 'deleted': 0}
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.sync()
+                delay = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(delay * 2, 300)
+                logger.error(f"Ошибка синхронизации с Google Sheets, повтор через {delay:.0f} сек.: {e}", exc_info=True)
+
+    def _rows_range(self, first, last):
+        return f"{rowcol_to_a1(first, 1)}:{rowcol_to_a1(last, len(GS_HEADERS))}"
+
+    async def sync(self, full=False):
+        """
+        Один цикл синхронизации. full=True - сравнить с хранилищем все
+        строки (команда /resync), тоже одним batch_get.
+        Возвращает число примененных правок, импортов и удалений.
+        """
+        async with self.lock:
+            letter = _column_letter(GS_COL_PAYMENT_ID)
+            ranges = [f"{letter}2:{letter}"]
+            window_first = self._cursor if self._cursor <= self._known_rows else 2
+            if full:
+                self._hashes.clear()
+                ranges.append(f"A2:{_column_letter(len(GS_HEADERS))}")
+            elif self._known_rows >= 2:
+                ranges.append(self._rows_range(window_first, min(window_first + self.window - 1, self._known_rows)))
+            result = await self.gateway.batch_get(ranges)
+            column, rows_read = result[0], [row for value_range in result[1:] for row in value_range]
+
+            payment_ids = [str(cell[0]).strip() if cell else '' for cell in column]
+            last_row = len(payment_ids) + 1
+            unknown = [row_number for row_number, payment_id in enumerate(payment_ids, start=2)
+                       if payment_id and self.index.row_for(payment_id) == -1 and self.storage.get(payment_id) is None]
+            if unknown and not full:
+                # Строки, добавленные в таблицу вручную: дочитываем только их
+                extra = await self.gateway.batch_get([self._rows_range(first, last) for first, last in _runs(unknown)])
+                rows_read += [row for value_range in extra for row in value_range]
+
+            edits, new_records = self._compare(rows_read)
+            deleted = self._deleted(payment_ids)
+            self._remap_rows(payment_ids)
+            if not full:
+                self._cursor = window_first + self.window
+            self._known_rows = last_row
+
+            changes = await self._apply(edits, new_records, deleted)
+        self.last_run = time.time()
+        return changes
+
+    def _compare(self, rows):
+        """Правки известных заказов {payment_id: {столбец: значение}} и новые заказы"""
+        edits = {}
+        new_records = {}
+        for row in rows:
+            row = [str(value) for value in row] + [''] * (len(GS_HEADERS) - len(row))
+            record = record_from_row(row[:len(GS_HEADERS)])
+            payment_id = record['Payment ID'] = record['Payment ID'].strip()
+            if not payment_id:
+                continue
+            digest = row_hash(row)
+            if self._hashes.get(payment_id) == digest:
+                continue
+            self._hashes[payment_id] = digest
+            local = self.storage.get(payment_id)
+            if local is None:
+                new_records[payment_id] = record
+                continue
+            fields = {field: record[field] for field in SYNC_FIELDS if record[field] != local[field]}
+            if 'Статус' in fields and fields['Статус'] not in KNOWN_STATUSES:
+                logger.warning(f"Неизвестный статус '{fields.pop('Статус')}' в Google Sheets для Payment ID {payment_id}, пропускаем.")
+            if fields:
+                edits[payment_id] = fields
+        return edits, list(new_records.values())
+
+    def _deleted(self, payment_ids):
+        """
+        Выгруженные ранее заказы, строк которых больше нет в таблице.
+        Удаление применяется, только если строки нет два цикла подряд:
+        случайный пустой ответ API не сотрет заказы.
+        """
+        present = set(payment_ids)
+        missing = {payment_id for payment_id in self.storage.exported_payment_ids() if payment_id not in present}
+        deleted, self._missing = sorted(missing & self._missing), missing
+        if len(deleted) > self.max_deletes:
+            # Скорее сортировка с потерей столбца или очистка листа, чем ручное удаление
+            logger.error(f"Из Google Sheets пропало {len(deleted)} заказов (лимит {self.max_deletes}), удаление не применено.")
+            return []
+        return deleted
+
+    def _remap_rows(self, payment_ids):
+        """Номера строк для экспортера: после удаления строк они сдвигаются"""
+        for row_number, payment_id in enumerate(payment_ids, start=2):
+            if payment_id:
+                self.index.set_row(payment_id, row_number)
+        present = set(payment_ids)
+        for payment_id in self.index.row_payment_ids():
+            if payment_id not in present:
+                self.index.forget_row(payment_id)
+                self._hashes.pop(payment_id, None)
+        self.index.next_row = len(payment_ids) + 2
+
+    async def _apply(self, edits, new_records, deleted):
+        changes = {'edited': 0, 'imported': 0, 'deleted': 0}
+        if edits:
+            applied = await self.storage.apply_edits(edits)
+            changes['edited'] = len(applied)
+            for payment_id in set(edits) - set(applied):
+                # Заказ изменен ботом: строку перечитаем после его выгрузки
+                self._hashes.pop(payment_id, None)
+            for payment_id in applied:
+                logger.info(f"Правка из Google Sheets применена, Payment ID {payment_id}: {edits[payment_id]}")
+        if new_records:
+            await self.storage.import_records(new_records)
+            changes['imported'] = len(new_records)
+        if deleted:
+            removed = await self.storage.delete_records(deleted)
+            changes['deleted'] = len(removed)
+            if removed:
+                logger.info(f"Заказы, удаленные из Google Sheets, удалены из хранилища: {removed}")
+        for key, count in changes.items():
+            self.applied[key] += count
+        if (changes['imported'] or changes['deleted']) and self.on_bulk_change:
+            await self.on_bulk_change()
+        return changes
+
+    def stats(self):
+        return {'last_run': self.last_run, 'rows': max(self._known_rows - 1, 0), 'applied': dict(self.applied)}
@@ -0,0 +1,206 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gspread.utils import rowcol_to_a1
+from config import (
+    GS_COL_STATUS, GS_COL_PAYMENT_ID, SHEETS_JOURNAL_PATH, SHEETS_FLUSH_INTERVAL_MS, SHEETS_FLUSH_BATCH,
+)
+from registration_index import row_from_append_response, appended_rows
+
+logger = logging.getLogger(__name__)
+
+OP_APPEND = 'append'
+OP_STATUS = 'status'
+
+
+class SheetWriteBehind:
+    """
+    Отложенная пакетная запись в Google Sheets.
+    Каждая операция сначала попадает в локальный журнал SQLite (WAL) и только
+    потом подтверждается пользователю. Фоновая задача раз в
+    SHEETS_FLUSH_INTERVAL_MS или при накоплении SHEETS_FLUSH_BATCH операций
+    отправляет их одним append_rows и одним batch_update.
+    Если append_rows завершился ошибкой, перед повтором по столбцу Payment ID
+    проверяется, не добавил ли Google строки все-таки: такие строки не
+    добавляются второй раз, их статус дописывается обновлением.
+    """
+
+    def __init__(self, gateway, index, journal_path=SHEETS_JOURNAL_PATH,
+                 flush_interval_ms=SHEETS_FLUSH_INTERVAL_MS, batch_size=SHEETS_FLUSH_BATCH):
+        self.gateway = gateway
+        self.index = index
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self._pending = []  # [(journal_id, op, payment_id, payload)]
+        self._wakeup = None
+        self._task = None
+        self._flush_lock = None
+        self._append_uncertain = False  # последний append_rows завершился ошибкой
+        # Все обращения к журналу идут через один поток, чтобы не блокировать loop
+        self._journal_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets-journal')
+        self._db = sqlite3.connect(journal_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=FULL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS sheet_journal ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, payment_id TEXT NOT NULL, '
+            'payload TEXT NOT NULL, created_at REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        """Загружает незавершенные операции из журнала и запускает фоновую запись"""
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        rows = self._db.execute('SELECT id, op, payment_id, payload FROM sheet_journal ORDER BY id').fetchall()
+        for journal_id, op, payment_id, payload in rows:
+            payload = json.loads(payload)
+            if op == OP_APPEND:
+                if self.index.row_for(payment_id) != -1:
+                    # Строка уже попала в таблицу до перезапуска
+                    self._db.execute('DELETE FROM sheet_journal WHERE id = ?', (journal_id,))
+                    continue
+                self.index.add_row(payload)
+            elif op == OP_STATUS:
+                self.index.set_status(payment_id, payload)
+            self._pending.append((journal_id, op, payment_id, payload))
+        self._db.commit()
+        if self._pending:
+            logger.info(f"Из журнала восстановлено {len(self._pending)} незаписанных операций Google Sheets.")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую задачу и пытается записать остаток очереди"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Не удалось записать очередь Google Sheets при остановке, операции остаются в журнале: {e}")
+        self._journal_executor.shutdown(wait=True)
+        self._db.close()
+
+    async def enqueue_append(self, row_values):
+        """Ставит в очередь добавление строки заказа (значения в порядке GS_HEADERS)"""
+        payment_id = str(row_values[GS_COL_PAYMENT_ID - 1])
+        await self._enqueue(OP_APPEND, payment_id, list(row_values))
+        self.index.add_row(row_values)
+
+    async def enqueue_status(self, payment_id, status):
+        """Ставит в очередь обновление статуса заказа"""
+        await self._enqueue(OP_STATUS, str(payment_id), status)
+        self.index.set_status(payment_id, status)
+
+    async def _enqueue(self, op, payment_id, payload):
+        loop = asyncio.get_running_loop()
+        journal_id = await loop.run_in_executor(
+            self._journal_executor, self._journal_insert, op, payment_id, json.dumps(payload, ensure_ascii=False)
+        )
+        self._pending.append((journal_id, op, payment_id, payload))
+        if self._wakeup and len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def _journal_insert(self, op, payment_id, payload):
+        cursor = self._db.execute(
+            'INSERT INTO sheet_journal (op, payment_id, payload, created_at) VALUES (?, ?, ?, ?)',
+            (op, payment_id, payload, time.time())
+        )
+        self._db.commit()
+        return cursor.lastrowid
+
+    def _journal_delete(self, journal_ids):
+        self._db.executemany('DELETE FROM sheet_journal WHERE id = ?', [(i,) for i in journal_ids])
+        self._db.commit()
+
+    async def _run(self):
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Операции остаются в очереди и журнале, повторяем с нарастающей паузой
+                delay = min(delay * 2, 60)
+                logger.error(f"Ошибка пакетной записи в Google Sheets, повтор через {delay:.1f} сек.: {e}", exc_info=True)
+
+    async def flush(self):
+        """Записывает накопленные операции в таблицу минимальным числом вызовов API"""
+        if not self._pending:
+            return
+        async with self._flush_lock:
+            appends = {}        # payment_id -> строка
+            append_ids = {}     # payment_id -> [journal_id]
+            statuses = {}       # payment_id -> статус (побеждает последний)
+            status_ids = []
+            for journal_id, op, payment_id, payload in self._pending:
+                if op == OP_APPEND:
+                    appends[payment_id] = list(payload)
+                    append_ids.setdefault(payment_id, []).append(journal_id)
+                elif payment_id in appends:
+                    # Статус еще не записанной строки пишем прямо в добавляемую строку
+                    appends[payment_id][GS_COL_STATUS - 1] = payload
+                    append_ids[payment_id].append(journal_id)
+                else:
+                    statuses[payment_id] = payload
+                    status_ids.append(journal_id)
+
+            if appends and self._append_uncertain:
+                for payment_id, row_number in (await appended_rows(self.gateway, appends)).items():
+                    # Строка добавлена прошлой попыткой, но со статусом на тот момент
+                    logger.info(f"Строка с Payment ID {payment_id} уже добавлена в Google Sheets (строка {row_number}).")
+                    self.index.set_row(payment_id, row_number)
+                    statuses[payment_id] = appends.pop(payment_id)[GS_COL_STATUS - 1]
+                    status_ids.extend(append_ids.pop(payment_id))
+                self._append_uncertain = False
+
+            if appends:
+                rows = list(appends.values())
+                try:
+                    response = await self.gateway.append_rows(rows)
+                except BaseException:
+                    self._append_uncertain = True
+                    raise
+                first_row = row_from_append_response(response) or self.index.next_row
+                for offset, payment_id in enumerate(appends):
+                    self.index.set_row(payment_id, first_row + offset)
+                # Строки уже в таблице: убираем их из очереди сразу, чтобы
+                # ошибка batch_update ниже не привела к повторному добавлению
+                await self._complete([journal_id for ids in append_ids.values() for journal_id in ids])
+                logger.info(f"В Google Sheets добавлено строк: {len(rows)} (с {first_row}).")
+
+            if statuses:
+                updates = []
+                for payment_id, status in statuses.items():
+                    row_index = self.index.row_for(payment_id)
+                    if row_index == -1:
+                        logger.error(f"Строка с Payment ID {payment_id} не найдена в Google Sheets, статус '{status}' не записан.")
+                        continue
+                    updates.append({'range': rowcol_to_a1(row_index, GS_COL_STATUS), 'values': [[status]]})
+                if updates:
+                    await self.gateway.batch_update(updates)
+                    logger.info(f"В Google Sheets обновлено статусов: {len(updates)}.")
+                await self._complete(status_ids)
+
+    async def _complete(self, journal_ids):
+        completed = set(journal_ids)
+        self._pending = [item for item in self._pending if item[0] not in completed]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._journal_executor, self._journal_delete, journal_ids)
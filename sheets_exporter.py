@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from gspread.utils import rowcol_to_a1
+from config import GS_COL_STATUS, SHEETS_FLUSH_INTERVAL_MS, SHEETS_FLUSH_BATCH
+from registration_index import RegistrationIndex, row_from_append_response, appended_rows
+from storage import ensure_headers, row_from_record
+
+logger = logging.getLogger(__name__)
+
+
+class SheetsExporter:
+    """
+    Зеркалирует регистрации из SQLiteStorage в Google Sheets.
+    Таблица - только отображение для организаторов: бот из нее не читает,
+    поэтому медленный или недоступный Google не задерживает пользователей.
+    Новые заказы уходят одним append_rows, смена статусов - одним
+    batch_update; выгруженная версия записи отмечается в SQLite, так что
+    после перезапуска экспорт продолжается с того же места.
+    Если append_rows завершился ошибкой, перед повтором по столбцу Payment ID
+    проверяется, не добавил ли Google строки все-таки, чтобы не удвоить их.
+    """
+
+    def __init__(self, storage, gateway, flush_interval_ms=SHEETS_FLUSH_INTERVAL_MS, batch_size=SHEETS_FLUSH_BATCH):
+        self.storage = storage
+        self.gateway = gateway
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        # Номера строк заказов в таблице
+        self.index = RegistrationIndex()
+        self._append_uncertain = False  # последний append_rows завершился ошибкой
+        self._wakeup = None
+        self._task = None
+        # Общая с SheetSync: чтение и запись таблицы не пересекаются
+        self.lock = None
+
+    async def start(self):
+        """Читает таблицу один раз, подтягивает в SQLite недостающие заказы и запускает экспорт"""
+        all_values = await self.gateway.get_all_values()
+        all_values = await ensure_headers(self.gateway, all_values)
+        self.index.load(all_values)
+        missing = [record for record in self.index.records() if self.storage.get(record['Payment ID']) is None]
+        if missing:
+            # Заказы, записанные в таблицу до перехода на SQLite
+            await self.storage.import_records(missing)
+        self._wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.storage.add_listener(self._on_change)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, flush=True):
+        """Останавливает экспорт и (flush=True) пытается выгрузить остаток"""
+        self.storage.remove_listener(self._on_change)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if not flush:
+                return
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось выгрузить изменения в Google Sheets при остановке, выгрузка продолжится после запуска: {e}")
+
+    def _on_change(self, record, previous_status):
+        if self._wakeup and self.storage.pending_sync() >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                delay = self.flush_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Изменения остаются невыгруженными в SQLite, повторяем с нарастающей паузой
+                delay = min(delay * 2, 60)
+                logger.error(f"Ошибка выгрузки в Google Sheets, повтор через {delay:.1f} сек.: {e}", exc_info=True)
+
+    async def flush(self):
+        """Выгружает все невыгруженные изменения пачками по batch_size"""
+        async with self.lock:
+            while True:
+                batch = self.storage.unexported(self.batch_size)
+                if not batch:
+                    return
+                await self._export(batch)
+                if len(batch) < self.batch_size:
+                    return
+
+    async def _export(self, batch):
+        appends = []    # [(запись, version)]
+        updates = []
+        exported = []   # [(payment_id, version)]
+        for record, version in batch:
+            row_index = self.index.row_for(record['Payment ID'])
+            if row_index == -1:
+                appends.append((record, version))
+            else:
+                updates.append({'range': rowcol_to_a1(row_index, GS_COL_STATUS), 'values': [[record['Статус']]]})
+                exported.append((record['Payment ID'], version))
+
+        if appends and self._append_uncertain:
+            found = await appended_rows(self.gateway, [record['Payment ID'] for record, _ in appends])
+            remaining = []
+            for record, version in appends:
+                row_number = found.get(record['Payment ID'])
+                if row_number is None:
+                    remaining.append((record, version))
+                    continue
+                # Строка добавлена прошлой попыткой, но со статусом на тот момент
+                logger.info(f"Строка с Payment ID {record['Payment ID']} уже добавлена в Google Sheets (строка {row_number}).")
+                self.index.add_row(row_from_record(record), row_number)
+                updates.append({'range': rowcol_to_a1(row_number, GS_COL_STATUS), 'values': [[record['Статус']]]})
+                exported.append((record['Payment ID'], version))
+            appends = remaining
+            self._append_uncertain = False
+
+        if appends:
+            rows = [row_from_record(record) for record, _ in appends]
+            try:
+                response = await self.gateway.append_rows(rows)
+            except BaseException:
+                self._append_uncertain = True
+                raise
+            first_row = row_from_append_response(response) or self.index.next_row
+            for offset, (record, version) in enumerate(appends):
+                self.index.add_row(rows[offset], first_row + offset)
+            # Отмечаем сразу: ошибка batch_update ниже не должна привести к повторному добавлению
+            await self.storage.mark_exported([(record['Payment ID'], version) for record, version in appends])
+            logger.info(f"В Google Sheets добавлено строк: {len(rows)} (с {first_row}).")
+
+        if updates:
+            await self.gateway.batch_update(updates)
+            await self.storage.mark_exported(exported)
+            logger.info(f"В Google Sheets обновлено статусов: {len(updates)}.")
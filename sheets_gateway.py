@@ -0,0 +1,183 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from gspread.exceptions import APIError
+from config import (
+    SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT, SHEETS_QUOTA_PER_MINUTE, SHEETS_QUOTA_BURST,
+    SHEETS_MAX_RETRIES, SHEETS_BACKOFF_BASE, SHEETS_MAX_BACKOFF,
+)
+from metrics import DEPENDENCY_LATENCY, DEPENDENCY_ERRORS, SHEETS_QUEUE_DEPTH, SHEETS_THROTTLED
+from rate_limiter import PriorityGovernor
+from circuit_breaker import CircuitBreaker
+from update_timing import stage
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты вызовов: меньше - раньше
+PRIORITY_PAYMENT = 0   # Запись статусов оплаты
+PRIORITY_WRITE = 1     # Добавление строк
+PRIORITY_READ = 2      # Чтения
+PRIORITY_NAMES = {PRIORITY_PAYMENT: 'payment', PRIORITY_WRITE: 'write', PRIORITY_READ: 'read'}
+
+# Приоритет по умолчанию для методов worksheet
+METHOD_PRIORITIES = {
+    'batch_update': PRIORITY_PAYMENT,
+    'update_cell': PRIORITY_PAYMENT,
+    'append_row': PRIORITY_WRITE,
+    'append_rows': PRIORITY_WRITE,
+}
+
+# Вызовы, которые безопасно повторять после 5xx: запрос мог выполниться,
+# и повторное добавление строки создало бы дубликат
+IDEMPOTENT_METHODS = {'get_all_values', 'row_values', 'col_values', 'cell', 'batch_get', 'update_cell', 'batch_update'}
+
+
+def api_error_status(error):
+    """HTTP-статус ответа из gspread.exceptions.APIError"""
+    try:
+        return error.response.status_code
+    except AttributeError:
+        return None
+
+
+class SheetsTimeoutError(Exception):
+    """Вызов Google Sheets не уложился в отведенное время"""
+
+
+def is_outage(error):
+    """Недоступность Google Sheets (таймаут, сеть, 5xx, 429), а не ошибка в запросе"""
+    if isinstance(error, APIError):
+        status = api_error_status(error)
+        return status is None or status == 429 or status >= 500
+    return True
+
+
+class SheetsGateway:
+    """
+    Асинхронная обертка над gspread.Worksheet.
+    Синхронные HTTP-вызовы gspread выполняются в ограниченном пуле потоков,
+    поэтому медленный ответ Google задерживает только тот запрос, которому
+    он нужен, а не весь event loop.
+    Каждый вызов сначала получает токен квоты (SHEETS_QUOTA_PER_MINUTE):
+    при нехватке токенов первыми проходят записи статусов оплаты, затем
+    добавление строк, затем чтения. На 429 и 5xx вызов повторяется с
+    экспоненциальной паузой, а 429 дополнительно приостанавливает выдачу
+    квоты всем вызовам.
+    Вызовы с повторами идут через предохранитель: когда Google недоступен,
+    они сразу завершаются CircuitOpenError, не занимая квоту и потоки.
+    """
+
+    def __init__(self, worksheet, max_workers=SHEETS_MAX_WORKERS, timeout=SHEETS_CALL_TIMEOUT,
+                 quota_per_minute=SHEETS_QUOTA_PER_MINUTE, quota_burst=SHEETS_QUOTA_BURST, breaker=None):
+        self.worksheet = worksheet
+        self.breaker = breaker or CircuitBreaker('sheets')
+        self.timeout = timeout
+        self.governor = PriorityGovernor(quota_per_minute / 60, quota_burst, on_queue_change=self._queue_changed)
+        self.throttled = {'quota': 0, '429': 0, '5xx': 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sheets')
+        self._slots = asyncio.Semaphore(max_workers)
+
+    @staticmethod
+    def _queue_changed(priority, delta):
+        SHEETS_QUEUE_DEPTH.inc(delta, priority=PRIORITY_NAMES.get(priority, str(priority)))
+
+    def _throttle(self, reason):
+        self.throttled[reason] += 1
+        SHEETS_THROTTLED.inc(reason=reason)
+
+    def stats(self):
+        """Очередь ожидающих квоты вызовов и счетчики задержек (для /status)"""
+        return {'queue_depth': len(self.governor), 'throttled': dict(self.throttled)}
+
+    async def _call(self, method_name, *args, **kwargs):
+        """Выполняет метод worksheet через предохранитель"""
+        with stage('sheets'):
+            return await self.breaker.call(self._call_with_retries, method_name, *args, is_failure=is_outage, **kwargs)
+
+    async def _call_with_retries(self, method_name, *args, timeout=None, priority=None, **kwargs):
+        """Выполняет метод worksheet в пуле потоков с квотой, таймаутом и повторами"""
+        timeout = self.timeout if timeout is None else timeout
+        if priority is None:
+            priority = METHOD_PRIORITIES.get(method_name, PRIORITY_READ)
+        func = functools.partial(getattr(self.worksheet, method_name), *args, **kwargs)
+        delay = SHEETS_BACKOFF_BASE
+        attempt = 0
+        while True:
+            attempt += 1
+            if await self.governor.acquire(priority):
+                self._throttle('quota')
+            try:
+                return await self._attempt(method_name, func, timeout)
+            except APIError as e:
+                status = api_error_status(e)
+                if status == 429:
+                    reason = '429'
+                elif status is not None and status >= 500 and method_name in IDEMPOTENT_METHODS:
+                    reason = '5xx'
+                else:
+                    raise
+                if attempt > SHEETS_MAX_RETRIES:
+                    raise
+                self._throttle(reason)
+                if reason == '429':
+                    # Квота исчерпана для всех: пауза для всей очереди, а не только для этого вызова
+                    self.governor.pause(delay)
+                pause = delay * random.uniform(0.5, 1.0)
+                logger.warning(f"Google Sheets: {method_name} вернул {status}, повтор {attempt} через {pause:.1f} сек.")
+                await asyncio.sleep(pause)
+                delay = min(delay * 2, SHEETS_MAX_BACKOFF)
+
+    async def _attempt(self, method_name, func, timeout):
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._run(func), timeout)
+        except asyncio.TimeoutError:
+            DEPENDENCY_ERRORS.inc(dependency='sheets', operation=method_name)
+            logger.error(f"Google Sheets: {method_name} не ответил за {timeout} сек.")
+            raise SheetsTimeoutError(f"{method_name} timed out after {timeout}s")
+        except Exception:
+            DEPENDENCY_ERRORS.inc(dependency='sheets', operation=method_name)
+            raise
+        finally:
+            DEPENDENCY_LATENCY.observe(time.perf_counter() - started, dependency='sheets', operation=method_name)
+
+    async def _run(self, func):
+        # Семафор ограничивает число вызовов в полете, чтобы при зависшем API
+        # очередь пула не росла бесконечно
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func)
+
+    async def get_all_values(self, **kwargs):
+        return await self._call('get_all_values', **kwargs)
+
+    async def row_values(self, row, **kwargs):
+        return await self._call('row_values', row, **kwargs)
+
+    async def col_values(self, col, **kwargs):
+        return await self._call('col_values', col, **kwargs)
+
+    async def cell(self, row, col, **kwargs):
+        return await self._call('cell', row, col, **kwargs)
+
+    async def batch_get(self, ranges, **kwargs):
+        return await self._call('batch_get', ranges, **kwargs)
+
+    async def append_row(self, values, **kwargs):
+        return await self._call('append_row', values, **kwargs)
+
+    async def append_rows(self, values, **kwargs):
+        return await self._call('append_rows', values, **kwargs)
+
+    async def update_cell(self, row, col, value, **kwargs):
+        return await self._call('update_cell', row, col, value, **kwargs)
+
+    async def batch_update(self, data, **kwargs):
+        return await self._call('batch_update', data, **kwargs)
+
+    def shutdown(self):
+        """Останавливает пул потоков, не дожидаясь зависших вызовов"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import BasePersistence, PersistenceInput
+from config import PERSISTENCE_PATH, PERSISTENCE_DEBOUNCE_MS, PERSISTENCE_UPDATE_INTERVAL, SESSION_TTL_MINUTES
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранение context.user_data в локальной SQLite.
+    Данные пользователя загружаются лениво, при первом его апдейте после
+    запуска, а не все разом. Изменения копятся в памяти и пишутся одной
+    транзакцией не чаще раза в PERSISTENCE_DEBOUNCE_MS, поэтому серия
+    переходов состояний стоит одного fsync.
+    Сессия, брошенная дольше SESSION_TTL_MINUTES назад, при загрузке
+    отбрасывается: пользователь начинает регистрацию заново.
+    chat_data, bot_data и callback_data бот не использует и не хранит.
+    """
+
+    def __init__(self, path=PERSISTENCE_PATH, debounce_ms=PERSISTENCE_DEBOUNCE_MS,
+                 update_interval=PERSISTENCE_UPDATE_INTERVAL, session_ttl_minutes=SESSION_TTL_MINUTES):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.debounce = debounce_ms / 1000
+        self.session_ttl = session_ttl_minutes * 60
+        self._dirty = {}       # user_id -> JSON или None (удалить)
+        self._flush_task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)'
+        )
+        self._db.commit()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # --- Чтение ---
+
+    async def get_user_data(self):
+        # Ленивая загрузка: данные подтягиваются в refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Флаг живет в самой сессии: когда SessionReaper удаляет ее из памяти,
+        # вместе с ней пропадает и отметка о загрузке
+        if user_data.loaded:
+            return
+        user_data.loaded = True
+        if user_id in self._dirty:
+            return
+        stored = await self._run(self._load, user_id)
+        if stored and stored.get('touched_at', time.time()) >= time.time() - self.session_ttl:
+            user_data.restore(stored)
+
+    async def peek_user_data(self, user_id):
+        """Данные пользователя из хранилища без загрузки в Application"""
+        if user_id in self._dirty:
+            data = self._dirty[user_id]
+            return json.loads(data) if data else None
+        return await self._run(self._load, user_id)
+
+    def _load(self, user_id):
+        row = self._db.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- Запись ---
+
+    async def update_user_data(self, user_id, data):
+        self._dirty[user_id] = json.dumps(data.to_dict(), ensure_ascii=False) if data else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        # bot.py вызывает его сразу после Application.drop_user_data: удаление
+        # попадает в очередь до того, как новая сессия пользователя загрузится
+        self._dirty[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._debounced_flush())
+
+    async def _debounced_flush(self):
+        await asyncio.sleep(self.debounce)
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await self._run(self._write, batch)
+        except Exception as e:
+            # Возвращаем несохраненное в очередь, не затирая более свежие изменения
+            for user_id, data in batch.items():
+                self._dirty.setdefault(user_id, data)
+            logger.error(f"Ошибка записи сессий в SQLite ({len(batch)} польз.): {e}", exc_info=True)
+
+    def _write(self, batch):
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO user_data (user_id, data) VALUES (?, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data',
+                [(user_id, data) for user_id, data in batch.items() if data is not None]
+            )
+            self._db.executemany(
+                'DELETE FROM user_data WHERE user_id = ?',
+                [(user_id,) for user_id, data in batch.items() if data is None]
+            )
+
+    async def flush(self):
+        """Вызывается при остановке Application: пишем все, что накопилось"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_dirty()
+        self._executor.shutdown(wait=True)
+        self._db.close()
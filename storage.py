@@ -0,0 +1,631 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from config import (
+    GS_HEADERS, PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING, PAYMENT_STATUS_CANCELED, STORAGE_PATH, DEFAULT_EVENT_ID,
+)
+from payment_reconciler import parse_order_time
+from registration_index import RegistrationIndex
+from sheet_writer import SheetWriteBehind
+from update_timing import stage
+
+logger = logging.getLogger(__name__)
+
+# Столбцы таблицы registrations в порядке GS_HEADERS
+COLUMNS = ('user_id', 'username', 'name', 'phone', 'ticket_count', 'amount', 'created_at', 'status', 'payment_id', 'event_id')
+PAYMENT_ID_POSITION = COLUMNS.index('payment_id')
+# Заголовок таблицы -> столбец SQLite
+HEADER_COLUMNS = dict(zip(GS_HEADERS, COLUMNS))
+
+# Итоги продаж по (мероприятие, статус) для /stats. Триггеры обновляют их
+# в той же транзакции, что и заказ, на каком бы экземпляре он ни изменился.
+# Сумма - ведущее число столбца amount ('2222 руб.'), как reports.amount_value
+SALES_TOTALS_ADD = (
+    "INSERT INTO sales_totals (event_id, status, orders, tickets, revenue) "
+    "VALUES (NEW.event_id, NEW.status, 1, CAST(NEW.ticket_count AS INTEGER), CAST(REPLACE(NEW.amount, ',', '.') AS REAL)) "
+    "ON CONFLICT(event_id, status) DO UPDATE SET orders = orders + 1, "
+    "tickets = tickets + excluded.tickets, revenue = revenue + excluded.revenue;"
+)
+SALES_TOTALS_REMOVE = (
+    "UPDATE sales_totals SET orders = orders - 1, tickets = tickets - CAST(OLD.ticket_count AS INTEGER), "
+    "revenue = revenue - CAST(REPLACE(OLD.amount, ',', '.') AS REAL) "
+    "WHERE event_id = OLD.event_id AND status = OLD.status;"
+)
+SALES_TOTALS_SCHEMA = (
+    'CREATE TABLE sales_totals (event_id TEXT NOT NULL, status TEXT NOT NULL, orders INTEGER NOT NULL, '
+    'tickets INTEGER NOT NULL, revenue REAL NOT NULL, PRIMARY KEY (event_id, status))',
+    f"CREATE TRIGGER sales_totals_insert AFTER INSERT ON registrations BEGIN {SALES_TOTALS_ADD} END",
+    f"CREATE TRIGGER sales_totals_delete AFTER DELETE ON registrations BEGIN {SALES_TOTALS_REMOVE} END",
+    'CREATE TRIGGER sales_totals_update AFTER UPDATE OF status, event_id, ticket_count, amount ON registrations '
+    f"BEGIN {SALES_TOTALS_REMOVE} {SALES_TOTALS_ADD} END",
+    "INSERT INTO sales_totals SELECT event_id, status, COUNT(*), SUM(CAST(ticket_count AS INTEGER)), "
+    "SUM(CAST(REPLACE(amount, ',', '.') AS REAL)) FROM registrations GROUP BY event_id, status",
+)
+
+
+def record_from_row(row):
+    """Строка в порядке GS_HEADERS -> запись {заголовок: значение}"""
+    record = dict(zip(GS_HEADERS, (str(value) for value in row)))
+    # Заказы, записанные до появления каталога, относятся к мероприятию по умолчанию
+    record['Мероприятие'] = record.get('Мероприятие') or DEFAULT_EVENT_ID
+    return record
+
+
+def row_from_record(record):
+    """Запись {заголовок: значение} -> строка в порядке GS_HEADERS"""
+    return [record.get(header, '') for header in GS_HEADERS]
+
+
+class RegistrationStorage(ABC):
+    """
+    Хранилище регистраций. Записи - словари с ключами из GS_HEADERS
+    ('User ID', 'Статус', 'Payment ID', ...), как строки Google Sheets.
+    Чтения синхронные и не ходят в сеть; записи асинхронные.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """listener(record, previous_status) вызывается после каждой записи"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, record, previous_status):
+        for listener in self._listeners:
+            try:
+                listener(record, previous_status)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика изменений хранилища: {e}", exc_info=True)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    def is_paid(self, user_id, event_id=None):
+        """Есть ли у пользователя оплаченный заказ (на мероприятие event_id или любое)"""
+
+    @abstractmethod
+    def paid_user_ids(self):
+        """user_id всех пользователей с оплаченным заказом"""
+
+    @abstractmethod
+    def get(self, payment_id):
+        """Запись по Payment ID или None"""
+
+    @abstractmethod
+    def pending_payments(self):
+        """Заказы, ожидающие оплаты: {payment_id: запись}"""
+
+    @abstractmethod
+    def canceled_since(self, since):
+        """Заказы, отмененные не раньше since (datetime в UTC): {payment_id: запись}"""
+
+    @abstractmethod
+    async def add_registration(self, row_values):
+        """Добавляет заказ (значения в порядке GS_HEADERS)"""
+
+    @abstractmethod
+    async def set_status(self, payment_id, status):
+        """
+        Меняет статус заказа, если его не изменил параллельный обработчик.
+        Возвращает True, если статус изменен этим вызовом.
+        """
+
+    @abstractmethod
+    def pending_sync(self):
+        """Сколько изменений еще не попало в Google Sheets"""
+
+    @abstractmethod
+    def tickets_sold(self):
+        """Сколько билетов в оплаченных заказах: {мероприятие: количество}"""
+
+    def sales_totals(self):
+        """
+        Готовые итоги продаж [(мероприятие, статус, заказов, билетов, рублей)]
+        или None: тогда сводка строится обходом iter_records().
+        """
+        return None
+
+    @abstractmethod
+    def iter_records(self):
+        """
+        Все заказы по одному в порядке добавления (генератор). Безопасен
+        для вызова из фонового потока - выгрузки не держат event loop.
+        """
+
+    async def set_statuses(self, statuses):
+        """Меняет статусы нескольких заказов: {payment_id: статус}"""
+        for payment_id, status in statuses.items():
+            await self.set_status(payment_id, status)
+
+    async def set_yookassa_payment_id(self, payment_id, yookassa_payment_id):
+        """Запоминает платеж ЮKassa заказа (для отмены брони на любом экземпляре)"""
+
+    def yookassa_payment_ids(self):
+        """Платежи ЮKassa заказов, ожидающих оплаты: {payment_id: yookassa_payment_id}"""
+        return {}
+
+    def yookassa_payment_id(self, payment_id):
+        """Платеж ЮKassa заказа с любым статусом или None, если не записан"""
+        return None
+
+
+class SQLiteStorage(RegistrationStorage):
+    """
+    Локальная SQLite - источник истины по регистрациям. Индексы по user_id,
+    статусу и payment_id (первичный ключ). Чтения идут по отдельному
+    соединению прямо в event loop (локальный индексный запрос - доли
+    миллисекунды), записи - в одном фоновом потоке.
+    Google Sheets зеркалирует таблицу через SheetsExporter: каждая запись
+    увеличивает version, экспортер догоняет exported_version.
+    """
+
+    def __init__(self, path=STORAGE_PATH):
+        super().__init__()
+        self.path = path
+        self._reader = None
+        self._writer = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
+
+    async def start(self):
+        await self._run(self._open_writer)
+        self._reader = sqlite3.connect(self.path)
+        self._reader.execute('PRAGMA query_only=ON')
+        logger.info(f"Хранилище SQLite открыто: {self.path}, заказов: {len(self)}")
+
+    async def stop(self):
+        if self._writer:
+            await self._run(self._writer.close)
+        self._executor.shutdown(wait=True)
+        if self._reader:
+            self._reader.close()
+
+    def _open_writer(self):
+        self._writer = sqlite3.connect(self.path, check_same_thread=False)
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer.execute('PRAGMA synchronous=FULL')
+        with self._writer:
+            self._writer.execute(
+                'CREATE TABLE IF NOT EXISTS registrations ('
+                'payment_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, username TEXT, name TEXT, phone TEXT, '
+                'ticket_count TEXT, amount TEXT, created_at TEXT, status TEXT NOT NULL, '
+                'updated_at REAL NOT NULL, version INTEGER NOT NULL DEFAULT 1, '
+                "exported_version INTEGER NOT NULL DEFAULT 0, event_id TEXT NOT NULL DEFAULT '')"
+            )
+            columns = {row[1] for row in self._writer.execute('PRAGMA table_info(registrations)')}
+            if 'event_id' not in columns:
+                # БД создана до появления каталога мероприятий
+                self._writer.execute("ALTER TABLE registrations ADD COLUMN event_id TEXT NOT NULL DEFAULT ''")
+            self._writer.execute("UPDATE registrations SET event_id = ? WHERE event_id = ''", (DEFAULT_EVENT_ID,))
+            if 'yookassa_payment_id' not in columns:
+                # Платеж ЮKassa в Google Sheets не выгружается, version не меняет
+                self._writer.execute('ALTER TABLE registrations ADD COLUMN yookassa_payment_id TEXT')
+            self._writer.execute('CREATE INDEX IF NOT EXISTS idx_registrations_user_status ON registrations (user_id, status)')
+            self._writer.execute('CREATE INDEX IF NOT EXISTS idx_registrations_status ON registrations (status)')
+            self._writer.execute('CREATE INDEX IF NOT EXISTS idx_registrations_event_status ON registrations (event_id, status)')
+            self._writer.execute(
+                'CREATE INDEX IF NOT EXISTS idx_registrations_status_updated ON registrations (status, updated_at)'
+            )
+            self._writer.execute(
+                'CREATE INDEX IF NOT EXISTS idx_registrations_unexported ON registrations (exported_version) '
+                'WHERE exported_version < version'
+            )
+        self._ensure_sales_totals()
+
+    def _ensure_sales_totals(self):
+        """Создает итоги продаж и заполняет их по уже записанным заказам (один раз на БД)"""
+        self._writer.execute('BEGIN IMMEDIATE')
+        try:
+            exists = self._writer.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sales_totals'"
+            ).fetchone()
+            if not exists:
+                for statement in SALES_TOTALS_SCHEMA:
+                    self._writer.execute(statement)
+            self._writer.commit()
+        except BaseException:
+            self._writer.rollback()
+            raise
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with stage('storage'):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def __len__(self):
+        return self._reader.execute('SELECT COUNT(*) FROM registrations').fetchone()[0]
+
+    # --- Чтение ---
+
+    def is_paid(self, user_id, event_id=None):
+        query = 'SELECT 1 FROM registrations WHERE user_id = ? AND status = ?'
+        params = [str(user_id), PAYMENT_STATUS_PAID]
+        if event_id is not None:
+            query += ' AND event_id = ?'
+            params.append(event_id)
+        return self._reader.execute(query + ' LIMIT 1', params).fetchone() is not None
+
+    def paid_user_ids(self):
+        rows = self._reader.execute(
+            'SELECT DISTINCT user_id FROM registrations WHERE status = ?', (PAYMENT_STATUS_PAID,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, payment_id):
+        row = self._reader.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM registrations WHERE payment_id = ?", (str(payment_id),)
+        ).fetchone()
+        return record_from_row(row) if row else None
+
+    def pending_payments(self):
+        rows = self._reader.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM registrations WHERE status = ?", (PAYMENT_STATUS_PENDING,)
+        ).fetchall()
+        return {row[PAYMENT_ID_POSITION]: record_from_row(row) for row in rows}
+
+    def canceled_since(self, since):
+        rows = self._reader.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM registrations WHERE status = ? AND updated_at >= ?",
+            (PAYMENT_STATUS_CANCELED, since.timestamp())
+        ).fetchall()
+        return {row[PAYMENT_ID_POSITION]: record_from_row(row) for row in rows}
+
+    def yookassa_payment_ids(self):
+        rows = self._reader.execute(
+            'SELECT payment_id, yookassa_payment_id FROM registrations WHERE status = ? AND yookassa_payment_id IS NOT NULL',
+            (PAYMENT_STATUS_PENDING,)
+        ).fetchall()
+        return dict(rows)
+
+    def yookassa_payment_id(self, payment_id):
+        row = self._reader.execute(
+            'SELECT yookassa_payment_id FROM registrations WHERE payment_id = ?', (str(payment_id),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def sales_totals(self):
+        rows = self._reader.execute(
+            'SELECT event_id, status, orders, tickets, revenue FROM sales_totals WHERE orders > 0'
+        ).fetchall()
+        return [(event_id, status, orders, tickets, int(revenue) if float(revenue).is_integer() else revenue)
+                for event_id, status, orders, tickets, revenue in rows]
+
+    def pending_sync(self):
+        return self._reader.execute('SELECT COUNT(*) FROM registrations WHERE exported_version < version').fetchone()[0]
+
+    def tickets_sold(self):
+        # Итоги ведут триггеры: запрос читает по строке на мероприятие, а не все
+        # оплаченные заказы (учет билетов реплик перечитывает его каждый проход)
+        rows = self._reader.execute(
+            'SELECT event_id, tickets FROM sales_totals WHERE status = ?', (PAYMENT_STATUS_PAID,)
+        ).fetchall()
+        return {event_id: count or 0 for event_id, count in rows}
+
+    def iter_records(self):
+        # Свое соединение: генератор может работать в другом потоке, а курсор
+        # читает строки по мере обхода, не загружая таблицу в память
+        connection = sqlite3.connect(self.path)
+        try:
+            cursor = connection.execute(f"SELECT {', '.join(COLUMNS)} FROM registrations ORDER BY rowid")
+            for row in cursor:
+                yield record_from_row(row)
+        finally:
+            connection.close()
+
+    def exported_payment_ids(self):
+        """Payment ID заказов, которые уже есть в Google Sheets"""
+        return [row[0] for row in self._reader.execute('SELECT payment_id FROM registrations WHERE exported_version > 0')]
+
+    def unexported(self, limit):
+        """Записи, изменения которых еще не в Google Sheets: [(запись, version)]"""
+        rows = self._reader.execute(
+            f"SELECT {', '.join(COLUMNS)}, version FROM registrations WHERE exported_version < version "
+            'ORDER BY rowid LIMIT ?', (limit,)
+        ).fetchall()
+        return [(record_from_row(row[:-1]), row[-1]) for row in rows]
+
+    # --- Запись ---
+
+    async def add_registration(self, row_values):
+        record = record_from_row(row_values)
+        await self._run(self._insert, record)
+        self._notify(record, None)
+
+    def _insert(self, record):
+        with self._writer:
+            self._writer.execute(
+                f"INSERT INTO registrations ({', '.join(COLUMNS)}, updated_at) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))}, ?) ON CONFLICT(payment_id) DO NOTHING",
+                (*row_from_record(record), time.time())
+            )
+
+    async def add_registration_within(self, row_values, capacity):
+        """
+        Добавляет заказ, только если билетов мероприятия хватает: в
+        оплаченных и ожидающих оплаты заказах вместе с новым не больше
+        capacity (0 - без ограничения). Проверка и вставка - одна
+        транзакция BEGIN IMMEDIATE, поэтому экземпляры бота с общей БД не
+        продадут лишнего. Возвращает False, если билетов не хватило;
+        уже записанный заказ - True.
+        """
+        record = record_from_row(row_values)
+        reserved, inserted = await self._run(self._insert_within, record, capacity)
+        if inserted:
+            self._notify(record, None)
+        return reserved
+
+    def _insert_within(self, record, capacity):
+        self._writer.execute('BEGIN IMMEDIATE')
+        try:
+            if self._writer.execute('SELECT 1 FROM registrations WHERE payment_id = ?', (record['Payment ID'],)).fetchone():
+                self._writer.commit()
+                return True, False
+            if capacity > 0:
+                taken = self._writer.execute(
+                    'SELECT COALESCE(SUM(CAST(ticket_count AS INTEGER)), 0) FROM registrations '
+                    'WHERE event_id = ? AND status IN (?, ?)',
+                    (record['Мероприятие'], PAYMENT_STATUS_PAID, PAYMENT_STATUS_PENDING)
+                ).fetchone()[0]
+                if taken + int(record['Количество билетов']) > capacity:
+                    self._writer.rollback()
+                    return False, False
+            self._writer.execute(
+                f"INSERT INTO registrations ({', '.join(COLUMNS)}, updated_at) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))}, ?)",
+                (*row_from_record(record), time.time())
+            )
+            self._writer.commit()
+            return True, True
+        except BaseException:
+            self._writer.rollback()
+            raise
+
+    async def set_status(self, payment_id, status):
+        record = self.get(payment_id)
+        if record is None:
+            return False
+        previous_status = record['Статус']
+        if previous_status == status:
+            return False
+        # Как в set_statuses: пока запись ждала потока, статус мог поменять другой
+        # обработчик (уведомление и "Проверить оплату"), тогда слушатели не вызываются
+        updated = await self._run(self._update_statuses, [(str(payment_id), previous_status, status)])
+        if not updated:
+            return False
+        record['Статус'] = status
+        self._notify(record, previous_status)
+        return True
+
+    async def set_statuses(self, statuses):
+        # Одна транзакция на всю пачку. Статус меняется, только если за время
+        # записи его не изменил другой обработчик (например, уведомление об оплате)
+        changes = []
+        for payment_id, status in statuses.items():
+            record = self.get(payment_id)
+            if record is not None:
+                changes.append((record, record['Статус'], status))
+        updated = await self._run(
+            self._update_statuses, [(record['Payment ID'], previous, status) for record, previous, status in changes]
+        )
+        for record, previous_status, status in changes:
+            if record['Payment ID'] in updated:
+                record['Статус'] = status
+                self._notify(record, previous_status)
+
+    def _update_statuses(self, updates):
+        now = time.time()
+        updated = set()
+        with self._writer:
+            for payment_id, previous_status, status in updates:
+                cursor = self._writer.execute(
+                    'UPDATE registrations SET status = ?, updated_at = ?, version = version + 1 '
+                    'WHERE payment_id = ? AND status = ?',
+                    (status, now, payment_id, previous_status)
+                )
+                if cursor.rowcount:
+                    updated.add(payment_id)
+        return updated
+
+    async def set_yookassa_payment_id(self, payment_id, yookassa_payment_id):
+        await self._run(self._set_yookassa_payment_id, str(payment_id), yookassa_payment_id)
+
+    def _set_yookassa_payment_id(self, payment_id, yookassa_payment_id):
+        with self._writer:
+            self._writer.execute(
+                'UPDATE registrations SET yookassa_payment_id = ? WHERE payment_id = ?', (yookassa_payment_id, payment_id)
+            )
+
+    async def mark_exported(self, versions):
+        """Отмечает выгруженные в Google Sheets версии записей: [(payment_id, version)]"""
+        await self._run(self._mark_exported, versions)
+
+    def _mark_exported(self, versions):
+        with self._writer:
+            self._writer.executemany(
+                'UPDATE registrations SET exported_version = MAX(exported_version, ?) WHERE payment_id = ?',
+                [(version, payment_id) for payment_id, version in versions]
+            )
+
+    async def apply_edits(self, edits):
+        """
+        Переносит правки из Google Sheets: {payment_id: {заголовок: значение}}.
+        Заказ с невыгруженными изменениями бота не трогаем - в таблицу скоро
+        попадет его версия. Правка считается выгруженной: она уже в таблице.
+        Возвращает список Payment ID, к которым правки применены.
+        """
+        previous = {payment_id: self.get(payment_id) for payment_id in edits}
+        applied = await self._run(self._apply_edits, [
+            (payment_id, fields) for payment_id, fields in edits.items() if previous[payment_id] is not None
+        ])
+        for payment_id in applied:
+            record = previous[payment_id]
+            previous_status = record['Статус']
+            record.update(edits[payment_id])
+            self._notify(record, previous_status)
+        return applied
+
+    def _apply_edits(self, edits):
+        now = time.time()
+        applied = []
+        with self._writer:
+            for payment_id, fields in edits:
+                assignments = ', '.join(f"{HEADER_COLUMNS[header]} = ?" for header in fields)
+                cursor = self._writer.execute(
+                    f"UPDATE registrations SET {assignments}, updated_at = ?, version = version + 1, "
+                    'exported_version = version + 1 WHERE payment_id = ? AND exported_version = version',
+                    (*fields.values(), now, payment_id)
+                )
+                if cursor.rowcount:
+                    applied.append(payment_id)
+        return applied
+
+    async def delete_records(self, payment_ids):
+        """Удаляет заказы, строки которых удалены из Google Sheets (кроме измененных ботом после выгрузки)"""
+        return await self._run(self._delete, list(payment_ids))
+
+    def _delete(self, payment_ids):
+        deleted = []
+        with self._writer:
+            for payment_id in payment_ids:
+                cursor = self._writer.execute(
+                    'DELETE FROM registrations WHERE payment_id = ? AND exported_version = version', (payment_id,)
+                )
+                if cursor.rowcount:
+                    deleted.append(payment_id)
+        return deleted
+
+    async def import_records(self, records):
+        """Первичная загрузка уже существующих в таблице заказов (считаются выгруженными)"""
+        await self._run(self._import, records)
+        logger.info(f"В SQLite импортировано заказов из Google Sheets: {len(records)}")
+
+    def _import(self, records):
+        now = time.time()
+        with self._writer:
+            self._writer.executemany(
+                f"INSERT INTO registrations ({', '.join(COLUMNS)}, updated_at, version, exported_version) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))}, ?, 1, 1) ON CONFLICT(payment_id) DO NOTHING",
+                [(*row_from_record(record), now) for record in records]
+            )
+
+
+class SheetsStorage(RegistrationStorage):
+    """
+    Google Sheets как хранилище: локальный индекс для чтений и отложенная
+    пакетная запись с журналом (SheetWriteBehind) для изменений.
+    """
+
+    def __init__(self, gateway):
+        super().__init__()
+        self.gateway = gateway
+        self.index = RegistrationIndex()
+        self.writer = None
+
+    async def start(self):
+        # Одно чтение таблицы целиком: и проверка заголовков, и локальный индекс
+        all_values = await self.gateway.get_all_values()
+        all_values = await ensure_headers(self.gateway, all_values)
+        self.index.load(all_values)
+        self.writer = SheetWriteBehind(self.gateway, self.index)
+        self.writer.start()
+
+    async def stop(self):
+        if self.writer:
+            await self.writer.stop()
+
+    def __len__(self):
+        return len(self.index)
+
+    def is_paid(self, user_id, event_id=None):
+        return self.index.is_paid(user_id, event_id)
+
+    def paid_user_ids(self):
+        return self.index.paid_user_ids()
+
+    def get(self, payment_id):
+        return self.index.get(payment_id)
+
+    def pending_payments(self):
+        return self.index.pending_payments()
+
+    def canceled_since(self, since):
+        # Время отмены таблица не хранит: берем время заказа, оно не позже отмены
+        canceled = {}
+        for record in self.index.records():
+            if record['Статус'] == PAYMENT_STATUS_CANCELED:
+                created = parse_order_time(record['Когда куплено'])
+                if created is None or created >= since:
+                    canceled[record['Payment ID']] = record
+        return canceled
+
+    def pending_sync(self):
+        return len(self.writer) if self.writer else 0
+
+    def tickets_sold(self):
+        sold = Counter()
+        for record in self.index.records():
+            if record['Статус'] == PAYMENT_STATUS_PAID:
+                try:
+                    sold[record['Мероприятие']] += int(record['Количество билетов'])
+                except ValueError:
+                    pass
+        return dict(sold)
+
+    def iter_records(self):
+        # Копия снимается сразу, на event loop: обходить ее можно из фонового
+        # потока, пока обработчики меняют индекс
+        return iter([dict(record) for record in self.index.records()])
+
+    async def add_registration(self, row_values):
+        await self.writer.enqueue_append(row_values)
+        self._notify(record_from_row(row_values), None)
+
+    async def set_status(self, payment_id, status):
+        record = self.index.get(payment_id)
+        if record is None:
+            return False
+        previous_status = record['Статус']
+        if previous_status == status:
+            return False
+        # Статус в индексе меняется до записи в журнал: параллельный вызов с тем же
+        # статусом (уведомление и "Проверить оплату") увидит его и ничего не сделает
+        self.index.set_status(payment_id, status)
+        try:
+            await self.writer.enqueue_status(payment_id, status)
+        except BaseException:
+            if record['Статус'] == status:
+                self.index.set_status(payment_id, previous_status)
+            raise
+        self._notify(record, previous_status)
+        return True
+
+
+async def ensure_headers(gateway, all_values):
+    """Проверяет заголовки таблицы (добавляет, если таблица пустая)"""
+    if not all_values or not all_values[0] or not all_values[0][0]:
+        logger.info("Заголовки в Google Sheets не найдены, добавляем новые.")
+        await gateway.append_row(GS_HEADERS)
+        return [list(GS_HEADERS)]
+    headers = all_values[0]
+    if len(headers) < len(GS_HEADERS) and headers == GS_HEADERS[:len(headers)]:
+        # Таблица создана до появления новых столбцов: дописываем их заголовки
+        await gateway.batch_update([{'range': 'A1', 'values': [GS_HEADERS]}])
+        logger.info(f"В Google Sheets добавлены заголовки: {GS_HEADERS[len(headers):]}")
+        return [list(GS_HEADERS)] + all_values[1:]
+    if headers != GS_HEADERS:
+        # Пока просто предупреждение: индекс ищет столбцы по названиям
+        logger.warning(f"Заголовки в таблице не совпадают. Ожидалось: {GS_HEADERS}, Получено: {all_values[0]}")
+    else:
+        logger.info("Заголовки в Google Sheets проверены и совпадают.")
+    return all_values
@@ -0,0 +1,16 @@
+"""
+Отрисовка QR-кодов в процессах TicketRenderer.
+
+Модуль импортирует только qrcode: его загружают процессы пула, и ни
+конфигурация, ни логирование, ни состояние бота им не нужны.
+"""
+import io
+
+
+def render_qr(data):
+    """PNG с QR-кодом"""
+    import qrcode
+    image = qrcode.make(data, box_size=10, border=4)
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
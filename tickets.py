@@ -0,0 +1,266 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import (
+    TICKET_SECRET, CHECKIN_PATH, TICKET_RENDER_WORKERS, TICKET_CACHE_SIZE, PAYMENT_STATUS_PAID,
+)
+from ticket_render import render_qr
+
+logger = logging.getLogger(__name__)
+
+# Параметр /start в ссылке из QR-кода: t.me/<бот>?start=t_<код>
+CHECKIN_PREFIX = 't_'
+SIGNATURE_BYTES = 10
+# Первый байт кода - формат Payment ID: UUID (16 байт) или произвольная строка
+FORMAT_UUID = b'\x01'
+FORMAT_TEXT = b'\x02'
+
+CHECKIN_OK = 'ok'
+CHECKIN_USED = 'used'
+CHECKIN_UNPAID = 'unpaid'
+CHECKIN_INVALID = 'invalid'
+
+
+def _sign(payload):
+    return hmac.new(TICKET_SECRET.encode('utf-8'), payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def ticket_code(payment_id):
+    """Подписанный код билета заказа (не длиннее 64 символов вместе с CHECKIN_PREFIX)"""
+    try:
+        payload = FORMAT_UUID + uuid.UUID(payment_id).bytes
+    except ValueError:
+        payload = FORMAT_TEXT + payment_id.encode('utf-8')
+    return base64.urlsafe_b64encode(payload + _sign(payload)).rstrip(b'=').decode('ascii')
+
+
+def parse_ticket_code(text):
+    """
+    Payment ID из кода билета или None, если код поврежден или подделан.
+    Принимает сам код, 't_<код>' и ссылку из QR-кода.
+    """
+    code = text.strip().rsplit('start=', 1)[-1]
+    if code.startswith(CHECKIN_PREFIX):
+        code = code[len(CHECKIN_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(code + '=' * (-len(code) % 4))
+    except (ValueError, TypeError):
+        return None
+    payload, signature = raw[:-SIGNATURE_BYTES], raw[-SIGNATURE_BYTES:]
+    if len(payload) < 2 or not hmac.compare_digest(signature, _sign(payload)):
+        return None
+    if payload[:1] == FORMAT_UUID and len(payload) == 17:
+        return str(uuid.UUID(bytes=payload[1:]))
+    if payload[:1] == FORMAT_TEXT:
+        return payload[1:].decode('utf-8', errors='replace')
+    return None
+
+
+class TicketRenderer:
+    """
+    Отрисовка QR-билетов в пуле процессов: построение изображения - чистая
+    работа CPU, и в event loop она задерживала бы всех пользователей.
+    Процессы запускаются через spawn и импортируют только ticket_render;
+    стартовый модуль (main.py, loadtest.py) в них импортируется повторно
+    как __mp_main__, поэтому бот он загружает только под __main__.
+    PNG кешируются по Payment ID (LRU на TICKET_CACHE_SIZE), одновременные
+    запросы одного билета ждут одну отрисовку. После первой отправки
+    запоминается file_id Telegram, и повторная отправка не требует ни
+    отрисовки, ни загрузки файла.
+    """
+
+    def __init__(self, workers=TICKET_RENDER_WORKERS, cache_size=TICKET_CACHE_SIZE):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._pool = None
+        self._png = OrderedDict()   # payment_id -> PNG
+        self._rendering = {}        # payment_id -> Future отрисовки
+        self._file_ids = {}         # payment_id -> file_id Telegram
+
+    def start(self):
+        """
+        Запускает процессы заранее: запуск интерпретатора занимает сотни
+        миллисекунд, и первые билеты не должны его ждать
+        """
+        pool = self._get_pool()
+        for _ in range(self.workers):
+            pool.submit(render_qr, '')
+
+    def _get_pool(self):
+        if self._pool is None:
+            # spawn, а не fork: копия процесса с потоками бота (журнал, SQLite) может зависнуть
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def render(self, payment_id, data):
+        png = self._png.get(payment_id)
+        if png is not None:
+            self._png.move_to_end(payment_id)
+            return png
+        future = self._rendering.get(payment_id)
+        if future is None:
+            pool = self._get_pool()
+            loop = asyncio.get_running_loop()
+            future = self._rendering[payment_id] = asyncio.ensure_future(loop.run_in_executor(pool, render_qr, data))
+            future.add_done_callback(lambda _: self._rendering.pop(payment_id, None))
+        png = await asyncio.shield(future)
+        self._png[payment_id] = png
+        while len(self._png) > self.cache_size:
+            self._png.popitem(last=False)
+        return png
+
+    def file_id(self, payment_id):
+        return self._file_ids.get(payment_id)
+
+    def remember_file_id(self, payment_id, file_id):
+        self._file_ids[payment_id] = file_id
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class TicketIndex:
+    """
+    Оплаченные заказы и отметки о проходе для контроля на входе.
+    Проверка кода - поиск в словаре, отметка "использован" делается без
+    await между проверкой и записью в память, поэтому из двух
+    одновременных сканирований одного билета проходит только первое.
+    Отметки сохраняются в CHECKIN_PATH (INSERT без перезаписи): после
+    перезапуска билет остается использованным, а в режиме реплик
+    повторный проход на другом экземпляре отклоняет сама SQLite.
+    """
+
+    def __init__(self, path=CHECKIN_PATH):
+        self.path = path
+        self.storage = None
+        self._paid = {}       # payment_id -> запись оплаченного заказа
+        self._by_user = {}    # user_id -> {payment_id}
+        self._used = {}       # payment_id -> время прохода
+        self._changes = None  # изменения хранилища во время load()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkins')
+        # БД открывается при первой загрузке (load, в потоке checkins), а не при создании бота
+        self._db = None
+
+    def _open(self):
+        if self._db is not None:
+            return
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checkins (payment_id TEXT PRIMARY KEY, used_at REAL NOT NULL, staff_id INTEGER)'
+        )
+        self._db.commit()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def load(self, storage):
+        """
+        Строит индекс оплаченных заказов по хранилищу. Обход заказов идет в
+        фоновом потоке, готовый индекс подменяет старый; изменения хранилища
+        за время обхода применяются к нему повторно.
+        """
+        self.storage = storage
+        self._changes = []
+        try:
+            paid, used = await self._run(self._build, storage.iter_records())
+        finally:
+            changes, self._changes = self._changes, None
+        self._paid.clear()
+        self._by_user.clear()
+        for record in paid:
+            self._add(record)
+        self._used.update(used)
+        for record, previous_status in changes:
+            self.on_storage_change(record, previous_status)
+        logger.info(f"Билеты: оплаченных заказов {len(self._paid)}, проходов отмечено {len(self._used)}.")
+
+    def _build(self, records):
+        self._open()
+        paid = [record for record in records if record['Статус'] == PAYMENT_STATUS_PAID]
+        return paid, dict(self._db.execute('SELECT payment_id, used_at FROM checkins').fetchall())
+
+    def _add(self, record):
+        payment_id = record['Payment ID']
+        self._paid[payment_id] = record
+        self._by_user.setdefault(str(record['User ID']), set()).add(payment_id)
+
+    def _remove(self, payment_id):
+        record = self._paid.pop(payment_id, None)
+        if record:
+            self._by_user.get(str(record['User ID']), set()).discard(payment_id)
+
+    def on_storage_change(self, record, previous_status):
+        """Слушатель хранилища: оплаченный заказ получает билет, отмена оплаты - лишает"""
+        if self._changes is not None:
+            self._changes.append((dict(record), previous_status))
+        if record['Статус'] == PAYMENT_STATUS_PAID:
+            self._add(dict(record))
+        elif previous_status == PAYMENT_STATUS_PAID:
+            self._remove(record['Payment ID'])
+
+    def paid_orders(self, user_id):
+        """Payment ID оплаченных заказов пользователя"""
+        return sorted(self._by_user.get(str(user_id), ()))
+
+    def _lookup(self, payment_id):
+        record = self._paid.get(payment_id)
+        if record is None and self.storage is not None:
+            # Заказ мог оплатить другой экземпляр бота: проверяем общее хранилище
+            record = self.storage.get(payment_id)
+            if record is None or record['Статус'] != PAYMENT_STATUS_PAID:
+                return None
+            self._add(record)
+        return record
+
+    async def check_in(self, code, staff_id):
+        """Проверяет код и отмечает проход. Возвращает (результат, запись заказа, время прохода)."""
+        payment_id = parse_ticket_code(code)
+        if payment_id is None:
+            return CHECKIN_INVALID, None, None
+        record = self._lookup(payment_id)
+        if record is None:
+            return CHECKIN_UNPAID, None, None
+        used_at = self._used.get(payment_id)
+        if used_at is not None:
+            return CHECKIN_USED, record, used_at
+        used_at = self._used[payment_id] = time.time()
+        try:
+            stored_at = await self._run(self._insert, payment_id, used_at, staff_id)
+        except BaseException:
+            # Отметка не сохранена: билет не должен остаться "использованным" только в памяти
+            if self._used.get(payment_id) == used_at:
+                del self._used[payment_id]
+            raise
+        if stored_at != used_at:
+            # Билет уже отметили на другом экземпляре
+            self._used[payment_id] = stored_at
+            return CHECKIN_USED, record, stored_at
+        return CHECKIN_OK, record, used_at
+
+    def _insert(self, payment_id, used_at, staff_id):
+        with self._db:
+            self._db.execute(
+                'INSERT INTO checkins (payment_id, used_at, staff_id) VALUES (?, ?, ?) ON CONFLICT(payment_id) DO NOTHING',
+                (payment_id, used_at, staff_id)
+            )
+            return self._db.execute('SELECT used_at FROM checkins WHERE payment_id = ?', (payment_id,)).fetchone()[0]
+
+    def stats(self):
+        return {'paid_orders': len(self._paid), 'checked_in': len(self._used)}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from telegram.ext import BaseUpdateProcessor
+from config import CALLBACK_DEDUP_WINDOW
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка апдейтов разных пользователей с сохранением
+    порядка для каждого пользователя: апдейты одного user_id выполняются
+    под его собственным asyncio.Lock, поэтому обработчики могут менять
+    context.user_data без гонок.
+    Повторные одинаковые нажатия inline-кнопки в пределах
+    CALLBACK_DEDUP_WINDOW секунд схлопываются в одно.
+    shared - SharedPersistence в режиме нескольких реплик: апдейт
+    дополнительно выполняется под блокировкой пользователя в общем
+    хранилище, а сессия записывается до ее снятия.
+    Слот из max_concurrent_updates апдейт занимает только после
+    блокировок пользователя: иначе очередь апдейтов одного пользователя
+    (или зависший обработчик) заняла бы все слоты, и остальные
+    пользователи ждали бы его.
+    """
+
+    def __init__(self, max_concurrent_updates, dedup_window=CALLBACK_DEDUP_WINDOW, shared=None):
+        super().__init__(max_concurrent_updates)
+        self.dedup_window = dedup_window
+        self.shared = shared
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}                      # user_id -> [Lock, число ожидающих]
+        self._recent_callbacks = OrderedDict()  # (user_id, message_id, data) -> время нажатия
+        self.duplicates_suppressed = 0
+
+    def busy(self, user_id):
+        """Есть ли у пользователя апдейты в работе или в очереди"""
+        return user_id in self._locks
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_update(self, update, coroutine):
+        # Базовая реализация берет слот до вызова do_process_update, то есть до
+        # блокировки пользователя; здесь слот берется в _run_in_slot
+        await self.do_process_update(update, coroutine)
+
+    async def _run_in_slot(self, coroutine):
+        """Выполняет апдейт, заняв один из max_concurrent_updates слотов"""
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        try:
+            await coroutine
+        finally:
+            self._slots.release()
+
+    async def do_process_update(self, update, coroutine):
+        if self._is_duplicate_callback(update):
+            # Обработчик не запускаем, только убираем "часики" на кнопке
+            coroutine.close()
+            self.duplicates_suppressed += 1
+            try:
+                await update.callback_query.answer()
+            except Exception:
+                pass
+            return
+
+        user = update.effective_user
+        if user is None:
+            await self._run_in_slot(coroutine)
+            return
+
+        async with self.user_lock(user.id):
+            if self.shared is None:
+                await self._run_in_slot(coroutine)
+            else:
+                await self._process_shared(user.id, coroutine)
+
+    @asynccontextmanager
+    async def user_lock(self, user_id):
+        """
+        Блокировка апдейтов пользователя. Ее же берут обработчики вне апдейтов
+        (уведомления ЮKassa), чтобы не работать параллельно с его апдейтами.
+        """
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Блокировки живут только пока у пользователя есть апдейты в работе
+                del self._locks[user_id]
+
+    async def _process_shared(self, user_id, coroutine):
+        lock = self.shared.store.lock(f'user:{user_id}')
+        try:
+            await lock.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        try:
+            await self._run_in_slot(coroutine)
+        finally:
+            try:
+                await self.shared.save_session(user_id)
+            finally:
+                await lock.release()
+
+    def _is_duplicate_callback(self, update):
+        query = update.callback_query
+        if query is None or self.dedup_window <= 0:
+            return False
+        now = time.monotonic()
+        # Записи упорядочены по времени: выбрасываем устаревшие с начала
+        while self._recent_callbacks:
+            key, pressed_at = next(iter(self._recent_callbacks.items()))
+            if now - pressed_at < self.dedup_window:
+                break
+            self._recent_callbacks.popitem(last=False)
+
+        message_id = query.message.message_id if query.message else query.inline_message_id
+        key = (query.from_user.id, message_id, query.data)
+        if key in self._recent_callbacks:
+            logger.info(f"Повторное нажатие '{query.data}' пользователем {query.from_user.id} пропущено.")
+            return True
+        self._recent_callbacks[key] = now
+        return False
@@ -0,0 +1,168 @@
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import marshal
+import pstats
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from config import SLOW_UPDATE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+# Разбивка текущего апдейта по этапам; None вне обработчика апдейта
+_current = ContextVar('update_timings', default=None)
+
+# Сколько строк pstats попадает в текстовую сводку профиля
+PROFILE_SUMMARY_LINES = 25
+
+
+class UpdateTimings:
+    """Время обработки одного апдейта по именованным этапам"""
+
+    __slots__ = ('started', 'stages')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, elapsed):
+        self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def breakdown(self, total):
+        """{этап: сек.}, включая 'other' - время вне отмеченных этапов"""
+        result = {name: round(elapsed, 4) for name, elapsed in self.stages.items()}
+        result['other'] = round(max(total - sum(self.stages.values()), 0.0), 4)
+        return result
+
+
+@contextmanager
+def stage(name):
+    """
+    Отмечает этап обработки апдейта: with stage('sheets'): ...
+    Вне апдейта (фоновые задачи) ничего не делает. Время считается по
+    часам, включая ожидание в await, - это то, что видит пользователь.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def staged(name):
+    """Декоратор: весь вызов функции или корутины - этап name"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed_update(handler_name, user_id=None, threshold=SLOW_UPDATE_THRESHOLD):
+    """
+    Собирает разбивку апдейта по этапам и пишет в лог апдейты дольше
+    threshold секунд вместе с разбивкой.
+    """
+    timings = UpdateTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+        total = time.perf_counter() - timings.started
+        if threshold and total >= threshold:
+            breakdown = timings.breakdown(total)
+            logger.warning(
+                f"Медленный апдейт: {handler_name}, User ID {user_id}, {total:.3f} сек.: "
+                + ', '.join(f"{name}={elapsed}" for name, elapsed in breakdown.items()),
+                extra={'handler': handler_name, 'user_id': user_id, 'duration': round(total, 4), 'stages': breakdown}
+            )
+
+
+class ProfileReport:
+    """Результат профилирования: файл pstats и текстовая сводка"""
+
+    def __init__(self, data, summary, updates, duration, chat_id):
+        self.data = data            # содержимое .prof (формат pstats.Stats.dump_stats)
+        self.summary = summary
+        self.updates = updates
+        self.duration = duration
+        self.chat_id = chat_id
+
+
+class UpdateProfiler:
+    """
+    Профилирование cProfile следующих N апдейтов по команде администратора.
+    Апдейты обрабатываются конкурентно в одном потоке, а cProfile
+    профилирует поток целиком, поэтому профилировщик один: он включается
+    в начале первого апдейта и выключается после N-го. Статистика -
+    сумма по всему, что event loop делал в этом окне.
+    """
+
+    def __init__(self):
+        self._profile = None
+        self._chat_id = None
+        self._started = None
+        self.remaining = 0
+        self.captured = 0
+
+    @property
+    def armed(self):
+        return self._profile is not None
+
+    def arm(self, count, chat_id):
+        """Включает захват следующих count апдейтов; False, если захват уже идет"""
+        if self.armed:
+            return False
+        self._profile = cProfile.Profile()
+        self._chat_id = chat_id
+        self._started = None
+        self.remaining = count
+        self.captured = 0
+        return True
+
+    def disarm(self):
+        """Прерывает захват без отчета"""
+        if self._started is not None:
+            self._profile.disable()
+        self._profile = None
+
+    def begin_update(self):
+        if self._profile is not None and self._started is None:
+            self._started = time.perf_counter()
+            self._profile.enable()
+
+    def end_update(self):
+        """Учитывает завершенный апдейт. Возвращает ProfileReport после N-го апдейта."""
+        if self._profile is None or self._started is None:
+            return None
+        self.captured += 1
+        self.remaining -= 1
+        if self.remaining > 0:
+            return None
+        profile, self._profile = self._profile, None
+        profile.disable()
+        duration = time.perf_counter() - self._started
+        stats = pstats.Stats(profile)
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        logger.info(f"Профилирование завершено: {self.captured} апдейтов за {duration:.1f} сек.")
+        return ProfileReport(marshal.dumps(stats.stats), summary.getvalue(), self.captured, duration, self._chat_id)
@@ -0,0 +1,185 @@
+import hmac
+import ipaddress
+import logging
+from aiohttp import web
+from telegram import Update
+from metrics import REGISTRY
+from shared_state import REPLICA
+from config import (
+    PORT, YOOKASSA_WEBHOOK_PATH, YOOKASSA_WEBHOOK_SECRET, YOOKASSA_WEBHOOK_CHECK_IP, WEBHOOK_PROXY_HOPS,
+    TELEGRAM_MODE, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET, STATUS_TOKEN,
+)
+
+logger = logging.getLogger(__name__)
+
+# Адреса, с которых ЮKassa отправляет уведомления (https://yookassa.ru/developers/using-api/webhooks)
+YOOKASSA_NETWORKS = [
+    ipaddress.ip_network(network) for network in (
+        '185.71.76.0/27',
+        '185.71.77.0/27',
+        '77.75.153.0/25',
+        '77.75.156.11/32',
+        '77.75.156.35/32',
+        '77.75.154.128/25',
+        '2a02:5180::/32',
+    )
+]
+
+
+def client_ip(request):
+    """IP клиента с учетом прокси перед ботом (X-Forwarded-For дописывается справа)"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded and WEBHOOK_PROXY_HOPS > 0:
+        hops = [part.strip() for part in forwarded.split(',') if part.strip()]
+        if len(hops) >= WEBHOOK_PROXY_HOPS:
+            return hops[-WEBHOOK_PROXY_HOPS]
+    return request.remote
+
+
+def is_yookassa_ip(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except (TypeError, ValueError):
+        return False
+    return any(address in network for network in YOOKASSA_NETWORKS)
+
+
+def is_authorized_notification(request):
+    """Проверка уведомления ЮKassa: секрет в URL и/или IP из списка ЮKassa"""
+    if YOOKASSA_WEBHOOK_SECRET:
+        token = request.query.get('token', '')
+        if not hmac.compare_digest(token.encode(), YOOKASSA_WEBHOOK_SECRET.encode()):
+            return False
+    if YOOKASSA_WEBHOOK_CHECK_IP and not is_yookassa_ip(client_ip(request)):
+        return False
+    return True
+
+
+def is_authorized_status(request):
+    """Проверка токена /status: ?token=<токен> или Authorization: Bearer <токен>"""
+    token = request.query.get('token', '')
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        token = header[len('Bearer '):]
+    return bool(STATUS_TOKEN) and hmac.compare_digest(token.encode(), STATUS_TOKEN.encode())
+
+
+async def health(request):
+    """Liveness: процесс жив. Состояние готовности - в теле ответа."""
+    return web.Response(text=f"Bot is running ({request.app['matrix_bot'].readiness})")
+
+
+async def health_json(request):
+    """Состояние бота: starting / ready / degraded"""
+    matrix_bot = request.app['matrix_bot']
+    return web.json_response({
+        'status': matrix_bot.readiness,
+        'degraded': matrix_bot.degraded_dependencies(),
+        'startup_timings': matrix_bot.startup_timings,
+    })
+
+
+async def ready(request):
+    """Readiness: 200 только когда таблица загружена и бот полностью готов"""
+    matrix_bot = request.app['matrix_bot']
+    return web.json_response({'status': matrix_bot.readiness}, status=200 if matrix_bot.readiness == 'ready' else 503)
+
+
+async def metrics(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(body=REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def status(request):
+    """Состояние фоновых задач в JSON (только с STATUS_TOKEN)"""
+    if not is_authorized_status(request):
+        logger.warning(f"Отклонен запрос /status без верного токена, адрес {client_ip(request)}")
+        return web.Response(status=403)
+    matrix_bot = request.app['matrix_bot']
+    return web.json_response({
+        'status': matrix_bot.readiness,
+        'reconciler': {
+            'last_run': matrix_bot.reconciler.last_run,
+            'total_reconciled': matrix_bot.reconciler.total_reconciled,
+        },
+        'pending_sheet_writes': matrix_bot.storage.pending_sync() if matrix_bot.storage else 0,
+        'sheets_quota': matrix_bot.sheets.stats() if matrix_bot.sheets else None,
+        'sheet_sync': matrix_bot.sheet_sync.stats() if matrix_bot.sheet_sync else None,
+        'tickets': matrix_bot.inventory.stats(),
+        'checkin': matrix_bot.tickets.stats() if matrix_bot.tickets else None,
+        'sessions': matrix_bot.session_reaper.stats(),
+        'circuits': {
+            'sheets': matrix_bot.sheets_breaker.stats(),
+            'yookassa': matrix_bot.yookassa_breaker.stats(),
+        },
+        'replica': {
+            'id': REPLICA,
+            'leader': matrix_bot.leader.is_leader if matrix_bot.leader else True,
+        },
+    })
+
+
+async def yookassa_webhook(request):
+    """Прием уведомлений ЮKassa о статусе платежа"""
+    if not is_authorized_notification(request):
+        logger.warning(f"Отклонено уведомление ЮKassa с адреса {client_ip(request)}")
+        return web.Response(status=403)
+    try:
+        notification = await request.json()
+        event = notification['event']
+        payment = notification['object']
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Некорректное тело уведомления ЮKassa")
+        return web.Response(status=400)
+
+    matrix_bot = request.app['matrix_bot']
+    try:
+        await matrix_bot.handle_payment_notification(event, payment)
+    except Exception as e:
+        # Не 200 - ЮKassa повторит уведомление позже
+        logger.error(f"Ошибка обработки уведомления ЮKassa {event}: {e}", exc_info=True)
+        return web.Response(status=500)
+    return web.Response(status=200)
+
+
+async def telegram_webhook(request):
+    """Прием апдейтов Telegram: кладем в очередь Application и сразу отвечаем"""
+    # build_application не запускает webhook без секрета; пустой секрет отклоняет все апдейты
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not TELEGRAM_WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+        logger.warning(f"Отклонен апдейт Telegram с неверным secret token, адрес {client_ip(request)}")
+        return web.Response(status=403)
+    application = request.app['matrix_bot'].application
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Некорректное тело апдейта Telegram")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response(status=200)
+
+
+def create_web_app(matrix_bot):
+    app = web.Application()
+    app['matrix_bot'] = matrix_bot
+    app.router.add_get('/', health)
+    app.router.add_get('/health', health_json)
+    app.router.add_get('/ready', ready)
+    if STATUS_TOKEN:
+        app.router.add_get('/status', status)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post(YOOKASSA_WEBHOOK_PATH, yookassa_webhook)
+    if TELEGRAM_MODE == 'webhook':
+        app.router.add_post(TELEGRAM_WEBHOOK_PATH, telegram_webhook)
+    return app
+
+
+async def start_web_server(matrix_bot, port=PORT):
+    """Запуск HTTP-сервера в event loop бота. Возвращает runner для остановки."""
+    runner = web.AppRunner(create_web_app(matrix_bot))
+    await runner.setup()
+    site = web.TCPSite(runner, '0.0.0.0', port)
+    await site.start()
+    logger.info(f"HTTP-сервер запущен на порту {port}")
+    return runner
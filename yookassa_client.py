@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import random
+import time
+import aiohttp
+from config import (
+    YOOKASSA_API_URL, YOOKASSA_TIMEOUT, YOOKASSA_MAX_RETRIES, YOOKASSA_POOL_SIZE,
+)
+from metrics import DEPENDENCY_LATENCY, DEPENDENCY_ERRORS
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from update_timing import stage
+
+logger = logging.getLogger(__name__)
+
+# 202 - запрос с этим Idempotence-Key еще обрабатывается, ЮKassa просит повторить
+RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+
+
+class YooKassaError(Exception):
+    """Ошибка API ЮKassa"""
+
+    def __init__(self, status, code=None, description=None):
+        self.status = status
+        self.code = code
+        self.description = description
+        super().__init__(f"ЮKassa API {status}: {code or ''} {description or ''}".strip())
+
+
+class YooKassaUnavailable(YooKassaError):
+    """ЮKassa отключена предохранителем: запрос не отправлялся"""
+
+    def __init__(self):
+        super().__init__(0, 'circuit_open', 'ЮKassa временно недоступна')
+
+
+def is_outage(error):
+    """Сбой самой ЮKassa (сеть, таймаут, 5xx, 429), а не ошибка в запросе"""
+    return isinstance(error, YooKassaError) and (error.status == 0 or error.status in RETRY_STATUSES)
+
+
+def idempotence_key(payment_id, operation='create'):
+    """Idempotence-Key для операции над нашим заказом: повтор не создаст второй платеж"""
+    return f"{operation}-{payment_id}"
+
+
+class YooKassaClient:
+    """
+    Асинхронный клиент API ЮKassa на общей keep-alive сессии aiohttp.
+    Повторяет запросы при 5xx/429 с экспоненциальной паузой; POST-запросы
+    безопасно повторять, так как они всегда идут с Idempotence-Key.
+    Запросы идут через предохранитель: пока ЮKassa недоступна, они сразу
+    завершаются YooKassaUnavailable.
+    """
+
+    def __init__(self, shop_id, secret_key, api_url=YOOKASSA_API_URL, timeout=YOOKASSA_TIMEOUT,
+                 max_retries=YOOKASSA_MAX_RETRIES, pool_size=YOOKASSA_POOL_SIZE, breaker=None):
+        self.breaker = breaker or CircuitBreaker('yookassa')
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._auth = aiohttp.BasicAuth(shop_id or '', secret_key or '')
+        self._session = None
+
+    def _get_session(self):
+        # Сессия создается лениво: ей нужен запущенный event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                auth=self._auth,
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, operation, method, path, payload=None, params=None, idempotence_key=None):
+        try:
+            with stage('yookassa'):
+                return await self.breaker.call(
+                    self._measured_request, operation, method, path, payload, params, idempotence_key, is_failure=is_outage
+                )
+        except CircuitOpenError:
+            raise YooKassaUnavailable() from None
+
+    async def _measured_request(self, operation, method, path, payload, params, idempotence_key):
+        started = time.perf_counter()
+        try:
+            return await self._request_with_retries(operation, method, path, payload, params, idempotence_key)
+        except Exception:
+            DEPENDENCY_ERRORS.inc(dependency='yookassa', operation=operation)
+            raise
+        finally:
+            DEPENDENCY_LATENCY.observe(time.perf_counter() - started, dependency='yookassa', operation=operation)
+
+    async def _request_with_retries(self, operation, method, path, payload, params, idempotence_key):
+        headers = {}
+        if idempotence_key:
+            headers['Idempotence-Key'] = idempotence_key
+        url = f"{self.api_url}{path}"
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                async with self._get_session().request(method, url, json=payload, params=params, headers=headers) as response:
+                    try:
+                        data = await response.json(content_type=None)
+                    except ValueError:
+                        data = None
+                    if response.status < 300 and response.status != 202:
+                        return data
+                    data = data or {}
+                    last_error = YooKassaError(response.status, data.get('code'), data.get('description'))
+                    if response.status not in RETRY_STATUSES:
+                        raise last_error
+                    retry_after = data.get('retry_after') or response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = YooKassaError(0, 'network_error', str(e) or type(e).__name__)
+
+            if attempt < self.max_retries:
+                if retry_after:
+                    # ЮKassa отдает retry_after в миллисекундах, заголовок Retry-After - в секундах
+                    delay = float(retry_after) / (1000 if isinstance(retry_after, (int, float)) else 1)
+                else:
+                    delay = 0.3 * 2 ** attempt + random.uniform(0, 0.2)
+                logger.warning(f"ЮKassa {method} {path}: {last_error}. Повтор {attempt + 1}/{self.max_retries} через {delay:.2f} сек.")
+                await asyncio.sleep(delay)
+        raise last_error
+
+    async def create_payment(self, payload, idempotence_key):
+        return await self._request('create_payment', 'POST', '/payments', payload=payload, idempotence_key=idempotence_key)
+
+    async def get_payment(self, yookassa_payment_id):
+        return await self._request('get_payment', 'GET', f'/payments/{yookassa_payment_id}')
+
+    async def cancel_payment(self, yookassa_payment_id, idempotence_key):
+        return await self._request('cancel_payment', 'POST', f'/payments/{yookassa_payment_id}/cancel',
+                                   payload={}, idempotence_key=idempotence_key)
+
+    async def list_payments(self, params):
+        return await self._request('list_payments', 'GET', '/payments', params=params)